@@ -1,23 +1,72 @@
 """Function to dump a covid dataframe for use downstream"""
+import hashlib
 import json
 import logging
+import numpy as np
 import os
 import pandas as pd
 import pickle
+import re
 import requests
-from collections import defaultdict
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from multiprocessing import Pool
 
 from polyglot.detect import Detector
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 import summarization
 import topic_modeling
 from utils.constants import *
+from utils.embedding_utils import EMBEDDINGS_CSV_PATH, load_embedding_matrix
+from utils.instrumentation_utils import save_run_report, start_run, track_stage
+from utils.parallel_utils import get_num_cores, parallelize_dataframe
+from utils.stage_utils import *
+from utils.term_filter_utils import COVID_FILTER, COVID_TERMS, TermFilter
+from utils.token_store_utils import TOKEN_FIELDS, TokenStore
+from utils.topic_evaluation_utils import get_topic_agreement
 from utils.web_utils import *
 
 DF_COVID_PATH = "df_covid.pkl"
 DF_COVID_TEXT_ONLY_PATH = "df_covid_with_text.pkl"
+DF_COVID_DATASET = "df_covid.parquet"
+DF_COVID_TEXT_ONLY_DATASET = "df_covid_with_text.parquet"
+# id columns that pandas would otherwise parse as floats in some chunks and strings in others
+METADATA_DTYPES = {
+    "pubmed_id": str, "mag_id": str, "who_covidence_id": str, "arxiv_id": str, "s2_id": str
+}
+# columns needed to build the website data
+WEB_COLUMNS = [
+    "cord_uid", "title", "abstract", "url", "authors", "journal", "publish_date",
+    "publish_date_for_web", "scibert_summary_short", "scibert_summary_short_cleaned",
+    "topics", "top_keywords", "is_peer_reviewed", "is_clinical_paper", "summary_length",
+] + [f"topic_{topic}" for topic in topic_modeling.TOPICS.keys()]
+METADATA_CHUNKSIZE = 50000
+TEXT_LOADER_WORKERS = 32
+LANGUAGE_SAMPLE_CHARS = 5000
+LANGUAGE_CACHE_PATH = "sha_to_language.pkl"
+# content and source hashes of papers dropped as non-English, which aren't in the snapshot
+NON_ENGLISH_HASHES_PATH = "non_english_content_hashes.pkl"
+CONTENT_HASH_COLUMNS = ["title", "abstract", "text"]
+# inputs of a paper's content that are cheap to read. Parse files are hashed by path, size and mtime
+SOURCE_HASH_COLUMNS = ["sha", "title", "abstract"]
+# columns computed by the expensive stages that can be reused for unchanged papers
+REUSED_COLUMNS = ["language", "topics", "top_keywords"] + [
+    f"topic_{topic}" for topic in topic_modeling.TOPICS_V4b.keys()
+]
+# share of the papers with text held out to measure the embedding topics on, and the seed of the split
+EMBEDDING_TOPICS_HOLDOUT = 0.2
+EMBEDDING_TOPICS_SEED = 0
+COVID_START_DATE = "2019-12-01"
+PIPELINE_STAGES = [
+    "ingest", "texts", "language", "tokens", "topics", "clinical", "keywords", "embedding_topics",
+    "summaries", "publish"
+]
 
 def save_data_for_website(save_local=True, save_aws=False):
     """Save data for use with website
@@ -30,21 +79,29 @@ def save_data_for_website(save_local=True, save_aws=False):
         whether to save the data to aws
 
     """
-    df = load_covid_data(text_only=True)
-    to_dump = get_data_for_web(df)
+    df = load_covid_data(text_only=True, columns=WEB_COLUMNS)
+    to_dump = get_data_for_web(df, text_loader=load_covid_texts)
     if save_local:
         save_web_data_local(to_dump, "web_data_v2.pkl")
     if save_aws:
         save_web_data_aws(to_dump, "web_data_v2.pkl")
 
 
-def load_covid_data(text_only=False):
+def load_covid_data(text_only=False, columns=None, filters=None):
     """Load covid data
 
+    Reads the columnar dataset if there is one, which only reads the requested
+    columns and partitions. Falls back to the pickled DataFrame otherwise, and
+    applies the filters to it in memory.
+
     Parameters
     ----------
     text_only: bool
         whether to load the DataFrame for which we have full text only
+    columns: list[str]
+        columns to load. Loads every column if None.
+    filters: list[tuple]
+        pyarrow filters on rows, e.g. [("publish_month", ">=", "2020-06")]
 
     Returns
     -------
@@ -52,139 +109,622 @@ def load_covid_data(text_only=False):
         a dataframe of covid research papers
 
     """
-    if text_only:
-        with open(os.path.join(DATA_DIR, DF_COVID_TEXT_ONLY_PATH), "rb") as f:
-            return pickle.load(f)
-    else:
-        with open(os.path.join(DATA_DIR, DF_COVID_PATH), "rb") as f:
-            return pickle.load(f)
+    dataset_path = os.path.join(
+        DATA_DIR, DF_COVID_TEXT_ONLY_DATASET if text_only else DF_COVID_DATASET)
+    if os.path.exists(dataset_path):
+        df = pd.read_parquet(dataset_path, columns=columns, filters=filters)
+        if "publish_month" in df.columns and (columns is None or "publish_month" not in columns):
+            df = df.drop(columns=["publish_month"])
+        # list columns come back as arrays, which elasticsearch and flask cannot serialize
+        for col in df.columns:
+            values = df[col].dropna()
+            if len(values) > 0 and isinstance(values.iloc[0], np.ndarray):
+                df[col] = df[col].apply(lambda l: l.tolist() if isinstance(l, np.ndarray) else l)
+        if "publish_date" in df.columns:
+            df = df.sort_values(by="publish_date", ascending=False, kind="mergesort")
+        return df
+
+    with open(os.path.join(DATA_DIR, DF_COVID_TEXT_ONLY_PATH if text_only else DF_COVID_PATH), "rb") as f:
+        df = pickle.load(f)
+    if filters is not None:
+        df = df[_get_filter_mask(df, filters)]
+    return df if columns is None else df[columns]
+
+
+def _get_filter_mask(df, filters):
+    """Get which rows pass all of the pyarrow-style filters, for DataFrames without a columnar dataset"""
+    ops = {
+        "==": lambda s, v: s == v, "=": lambda s, v: s == v, "!=": lambda s, v: s != v,
+        "<": lambda s, v: s < v, "<=": lambda s, v: s <= v, ">": lambda s, v: s > v, ">=": lambda s, v: s >= v,
+        "in": lambda s, v: s.isin(v), "not in": lambda s, v: ~s.isin(v),
+    }
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        if op not in ops:
+            raise ValueError(f"Unknown filter operator {op}. Operators are {list(ops)}")
+        if col == "publish_month" and col not in df.columns:
+            values = df["publish_date"].dt.strftime("%Y-%m")
+        else:
+            values = df[col]
+        mask &= ops[op](values, value).to_numpy()
+    return mask.to_numpy()
 
 
-def save_covid_only_data():
-    """Save a set of research papers that only discuss COVID-19
+def load_covid_texts(cord_uids):
+    """Load the full text of the given papers only
+
+    Parameters
+    ----------
+    cord_uids: iterable
+        cord_uids of the papers of interest
+
+    Returns
+    -------
+    Series
+        the text of each paper, indexed by cord_uid
 
-    Add on embeddings and text where relevant
     """
-    # load metadata
-    df_meta = pd.read_csv(os.path.join(DATA_DIR, "metadata.csv"))
-    df_meta["publish_date"] = pd.to_datetime(
-        df_meta["publish_time"], infer_datetime_format=True
+    df = load_covid_data(
+        text_only=True,
+        columns=["cord_uid", "text"],
+        filters=[("cord_uid", "in", list(cord_uids))]
     )
-    # add whether paper was peer reviewed
-    df_meta["is_peer_reviewed"] = is_peer_reviewed(df_meta)
-    logging.info(f"Starting with {len(df_meta)} documents")
+    return df.drop_duplicates(subset=["cord_uid"]).set_index("cord_uid")["text"]
 
-    # load embeddings
-    logging.info("Adding embeddings")
-    df_embeddings = pd.read_csv(
-        os.path.join(DATA_DIR, "cord_19_embeddings.csv"), header=None
-    )
-    df_embeddings.set_index([0], inplace=True)
-
-    # add embeddings to df_meta
-    embedding_map = df_embeddings.to_dict()
-    doc_to_embedding = defaultdict(list)
-    for i in embedding_map.keys():
-        dim_i = embedding_map[i]
-        for doc_id in dim_i.keys():
-            doc_to_embedding[doc_id].append(dim_i[doc_id])
-    df_meta["embedding"] = df_meta["cord_uid"].map(doc_to_embedding)
-    del df_embeddings, doc_to_embedding
-
-    # filter to covid-only data
-    logging.info("Filtering to Covid-only")
-    def col_contains_covid(df, col):
-        """Returns a flag if the given column mentions the coronavirus"""
-        return (
-            df[col].str.lower().str.contains("covid")
-            | df[col].str.lower().str.contains("coronavirus")
-            | df[col].str.lower().str.contains("sars-cov-2")
-            | df[col].str.lower().str.contains("corona")
-            | df[col].str.lower().str.contains("wuhan")
-        )
 
-    # we only want documents after covid was a thing, and before the current date
-    logging.info("Filtering by date")
-    date_flag = (
-        df_meta["publish_date"] > datetime.strptime(
-            "2019-12-01", "%Y-%m-%d")
-    ) & (df_meta["publish_date"] < datetime.now())
-    df_recent = df_meta[date_flag]
-    df_covid = apply_text_filter(df_recent, col_contains_covid)
-    del df_recent, df_meta
+def save_covid_data(df, text_only=False):
+    """Save covid data as a columnar dataset partitioned by publish month
 
-    # get a subset of covid papers that contain the text
-    logging.info("Adding text")
-    df_covid_with_texts = df_covid.dropna(subset=["sha"])
-    df_covid_with_texts["pdf_filename"] = (
-        df_covid_with_texts["pdf_json_files"].fillna("")
-        + ";"
-        + df_covid_with_texts["pmc_json_files"].fillna("")
-    )
-    df_covid_with_texts["text"] = df_covid_with_texts["pdf_filename"].apply(
-        add_texts)
+    Parameters
+    ----------
+    df: DataFrame
+        dataframe of covid research papers
+    text_only: bool
+        whether this is the DataFrame for which we have full text only
+
+    """
+    dataset_path = os.path.join(
+        DATA_DIR, DF_COVID_TEXT_ONLY_DATASET if text_only else DF_COVID_DATASET)
+    # partitioned writes add files to existing partitions, so start fresh
+    if os.path.exists(dataset_path):
+        shutil.rmtree(dataset_path)
+    df.assign(
+        publish_month=df["publish_date"].dt.strftime("%Y-%m")
+    ).to_parquet(dataset_path, partition_cols=["publish_month"])
+
+
+def save_covid_only_data(
+        chunksize=METADATA_CHUNKSIZE, incremental=False, stages=None, resume_from=None, embedding_topics=False):
+    """Save a set of research papers that only discuss COVID-19
+
+    Add on text where relevant
+
+    The work is split into the stages in PIPELINE_STAGES. Each stage saves its
+    output keyed by a hash of its inputs and parameters, and stages whose output
+    already exists are skipped, so a rerun after a failure picks up where the
+    last run stopped. Once the data is published, the artifacts of the earlier
+    stages are removed, since each holds a copy of the corpus. Stages before
+    the last published one are then skipped, and forcing one of them needs the
+    stages before it to be rerun as well.
+
+    Parameters
+    ----------
+    chunksize: int
+        number of metadata rows to read at a time. If None, reads the full
+        metadata file at once.
+    incremental: bool
+        whether to only send new or changed papers through language detection,
+        topics and keywords, reusing the previous snapshot for everything else
+    stages: list[str]
+        if set, only runs these stages, even if their output already exists
+    resume_from: str
+        if set, runs this stage and every stage after it, even if their output
+        already exists
+    embedding_topics: bool
+        whether to label the papers in df_covid with topics from their
+        embeddings. The papers with text keep their regex topics, which the
+        embedding topics are trained on. Otherwise the embedding_topics stage
+        leaves all topics unchanged.
+
+    """
+    params = {
+        "ingest": {
+            "chunksize": chunksize,
+            "terms": COVID_TERMS,
+            "inputs": get_file_fingerprint(["metadata.csv", EMBEDDINGS_CSV_PATH]),
+        },
+        "texts": {
+            "incremental": incremental,
+            "inputs": get_file_fingerprint(
+                ["document_parses/pdf_json", "document_parses/pmc_json"]
+                + ([DF_COVID_TEXT_ONLY_DATASET, DF_COVID_TEXT_ONLY_PATH] if incremental else [])
+            ),
+        },
+        "language": {"sample_chars": LANGUAGE_SAMPLE_CHARS},
+        "tokens": {"fields": TOKEN_FIELDS},
+        "topics": {"topics": topic_modeling.TOPICS_V4b},
+        "clinical": {"inputs": get_file_fingerprint([topic_modeling.CLINICAL_PATHS_PATH])},
+        "keywords": {"incremental": incremental},
+        "embedding_topics": {"topics": topic_modeling.TOPICS_V4b, "enabled": embedding_topics},
+        "summaries": {},
+        "publish": {},
+    }
+    for stage in (stages or []) + ([resume_from] if resume_from else []):
+        if stage not in PIPELINE_STAGES:
+            raise ValueError(f"Unknown stage {stage}. Stages are {PIPELINE_STAGES}")
+
+    keys = []
+    for stage in PIPELINE_STAGES:
+        keys.append(get_stage_key(keys[-1] if keys else "", stage, params[stage]))
+
+    start_run("save_covid_only_data")
+    state = None
+    # the report is saved even if a stage fails, with the failed stage last
+    try:
+        for i, stage in enumerate(PIPELINE_STAGES):
+            if stages is not None and stage not in stages:
+                continue
+            is_forced = stages is not None or (
+                resume_from is not None and i >= PIPELINE_STAGES.index(resume_from))
+            # keys depend on every earlier stage, so a later artifact means this stage is done too
+            is_done = any(
+                has_stage_artifact(PIPELINE_STAGES[j], keys[j]) for j in range(i, len(PIPELINE_STAGES)))
+            if not is_forced and is_done:
+                logging.info(f"Skipping stage {stage}, its inputs are unchanged")
+                state = None
+                continue
+
+            if state is None:
+                state = {} if i == 0 else load_stage_artifact(PIPELINE_STAGES[i - 1], keys[i - 1])
+            logging.info(f"Running stage {stage}")
+            with track_stage(stage, rows_in=_count_papers(state)) as stats:
+                state = PIPELINE_STAGE_FUNCTIONS[stage](state, **params[stage])
+                stats.rows_out = _count_papers(state)
+            save_stage_artifact(stage, keys[i], state)
+            if stage == PIPELINE_STAGES[-1]:
+                remove_stage_artifacts(PIPELINE_STAGES[:-1])
+    finally:
+        save_run_report(os.path.join(DATA_DIR, STAGE_DIR))
+
+
+def _count_papers(state):
+    """Count the papers in a stage's state, preferring the papers with text"""
+    for name in ["df_covid_with_texts", "df_covid"]:
+        if name in state:
+            return len(state[name]) + len(state.get("df_reused", []))
+    return None
+
+
+def _run_ingest_stage(state, chunksize, terms, inputs):
+    """Load covid metadata, and make sure the embedding matrix is up to date"""
+    # load metadata
+    df_covid = load_metadata(chunksize, terms)
+
+    # embeddings stay in the memory-mapped matrix, and are read by cord_uid where needed
+    load_embedding_matrix()
 
-    logging.info("Filtering papers")
-    
     # filter out papers with no title
     df_covid = df_covid.dropna(subset=["title"])
-    df_covid_with_texts = df_covid_with_texts.dropna(subset=["title"])
 
-    # filter out papers that are not in English
-    df_covid_with_texts["language"] = df_covid_with_texts["text"].apply(
-        detect_language)
-    df_covid_with_texts = df_covid_with_texts[
-        df_covid_with_texts["language"] == "English"
-    ]
-
-    logging.info("Adding metadata")
     # add useful metadata for EDA
     df_covid["title_length"] = df_covid["title"].str.split(" ").str.len()
     df_covid["abstract_length"] = df_covid["abstract"].str.split(" ").str.len()
+
+    # sort data by publish date
+    df_covid = df_covid.sort_values(by="publish_date", ascending=False)
+
+    # add useful metadata for web
+    df_covid["publish_date_for_web"] = df_covid["publish_date"].dt.strftime(
+        '%b %d, %Y')
+    return {"df_covid": df_covid}
+
+
+def _run_texts_stage(state, incremental, inputs):
+    """Add full texts to the papers that have them"""
+    # get a subset of covid papers that contain the text
+    df_covid_with_texts = state["df_covid"].dropna(subset=["sha"])
+    df_covid_with_texts["pdf_filename"] = (
+        df_covid_with_texts["pdf_json_files"].fillna("")
+        + ";"
+        + df_covid_with_texts["pmc_json_files"].fillna("")
+    )
+    df_covid_with_texts["source_hash"] = get_source_hashes(df_covid_with_texts)
+
+    # only read the parse files of papers whose sources are new or changed if we can
+    df_prev, non_english_hashes = None, set()
+    if incremental:
+        df_prev, non_english_hashes = load_previous_snapshot(), load_non_english_hashes()
+        df_covid_with_texts = df_covid_with_texts[~df_covid_with_texts["source_hash"].isin(non_english_hashes)].copy()
+    is_known = get_unchanged_sources(df_covid_with_texts, df_prev)
+    logging.info(f"Reading {(~is_known).sum()} texts from parse files, {is_known.sum()} from the previous snapshot")
+    df_covid_with_texts["text"] = None
+    df_covid_with_texts.loc[~is_known, "text"] = load_texts(df_covid_with_texts.loc[~is_known, "pdf_filename"])
+    if is_known.any():
+        df_known_texts = load_covid_data(
+            text_only=True,
+            columns=["source_hash", "text"],
+            filters=[("source_hash", "in", list(df_covid_with_texts.loc[is_known, "source_hash"]))]
+        ).drop_duplicates(subset=["source_hash"]).set_index("source_hash")["text"]
+        df_covid_with_texts.loc[is_known, "text"] = df_covid_with_texts.loc[is_known, "source_hash"].map(
+            df_known_texts)
+    df_covid_with_texts["content_hash"] = get_content_hashes(df_covid_with_texts)
     df_covid_with_texts["text_length"] = (
         df_covid_with_texts["text"].str.split(" ").str.len()
     )
 
+    # only process new or changed papers if we can
+    state["df_reused"], state["stale_cord_uids"] = df_covid_with_texts.iloc[0:0], None
+    if incremental:
+        state["df_reused"], df_covid_with_texts, state["stale_cord_uids"] = split_changed_papers(
+            df_covid_with_texts, df_prev, non_english_hashes)
+        logging.info(
+            f"Reusing {len(state['df_reused'])} papers, processing {len(df_covid_with_texts)} new or changed papers")
+    state["df_covid_with_texts"] = df_covid_with_texts
+    return state
+
+
+def _run_language_stage(state, sample_chars):
+    """Filter out papers that are not in English"""
+    df_covid_with_texts = state["df_covid_with_texts"]
+    df_covid_with_texts["language"] = detect_languages(
+        df_covid_with_texts, sample_chars=sample_chars)
+    is_english = df_covid_with_texts["language"] == "English"
+    save_non_english_hashes(
+        list(df_covid_with_texts.loc[~is_english, "content_hash"])
+        + list(df_covid_with_texts.loc[~is_english, "source_hash"]))
+    state["df_covid_with_texts"] = df_covid_with_texts[is_english]
+    return state
+
+
+def _run_tokens_stage(state, fields):
+    """Tokenize new or changed papers into the token store, which the later stages read from"""
+    n_papers = TokenStore().add_docs(state["df_covid_with_texts"], fields)
+    logging.info(f"Tokenized {n_papers} new or changed papers")
+    return state
+
+
+def _run_topics_stage(state, topics):
+    """Add topics"""
+    if len(state["df_covid_with_texts"]) > 0:
+        state["df_covid_with_texts"] = parallelize_dataframe(
+            state["df_covid_with_texts"],
+            partial(topic_modeling.add_topics, drug_re=topic_modeling.get_drug_regex())
+        )
+    return state
+
+
+def _run_clinical_stage(state, inputs):
+    """Add is_clinical. The list of trial results changes daily, so this covers every paper"""
+    matcher = topic_modeling.get_clinical_matcher()
+    for name in ["df_covid_with_texts", "df_reused"]:
+        if len(state[name]) > 0:
+            topic_modeling.add_is_clinical(state[name], matcher=matcher)
+    return state
+
+
+def _run_keywords_stage(state, incremental):
+    """Add keywords and merge the processed papers back with the reused papers"""
+    df_covid_with_texts = state["df_covid_with_texts"]
+    if len(df_covid_with_texts) > 0:
+        topic_modeling.add_keywords(df_covid_with_texts, incremental=incremental)
+    df_reused = state.pop("df_reused")
+    if len(df_reused) > 0:
+        df_covid_with_texts = pd.concat([df_reused, df_covid_with_texts])
+
     # sort data by publish date
-    df_covid = df_covid.sort_values(by="publish_date", ascending=False)
     df_covid_with_texts = df_covid_with_texts.sort_values(
         by="publish_date", ascending=False)
-
     # add useful metadata for web
-    df_covid["publish_date_for_web"] = df_covid["publish_date"].dt.strftime(
-        '%b %d, %Y')
     df_covid_with_texts["publish_date_for_web"] = df_covid_with_texts["publish_date"].dt.strftime(
         '%b %d, %Y')
-    
-    # add topics
-    logging.info("Adding topics")
-    df_covid_with_texts = parallelize_dataframe(df_covid_with_texts, topic_modeling.add_topics)
-    
-    # add is_clinical
-    logging.info("Adding is_clinical")
-    topic_modeling.add_is_clinical(df_covid_with_texts)
-
-    # add keywords
-    logging.info("Adding keywords")
-    topic_modeling.add_keywords(df_covid_with_texts)
-    
-    # add summaries
-    logging.info("Adding summaries")
-    summarization.summarize_text(df_covid_with_texts)
+    state["df_covid_with_texts"] = df_covid_with_texts
+    return state
+
+
+def _run_embedding_topics_stage(state, topics, enabled):
+    """If enabled, add topics from embeddings to df_covid, seeded from the regex topics of the papers with text"""
+    if not enabled:
+        return state
+    embeddings, cord_uid_to_row = load_embedding_matrix()
+    df_covid_with_texts = state["df_covid_with_texts"]
+    df_regex = df_covid_with_texts.loc[df_covid_with_texts["cord_uid"].isin(cord_uid_to_row.keys())]
+    is_holdout = np.random.RandomState(EMBEDDING_TOPICS_SEED).rand(len(df_regex)) < EMBEDDING_TOPICS_HOLDOUT
+    classifier = topic_modeling.fit_topic_classifier(df_regex[~is_holdout], embeddings, cord_uid_to_row)
+
+    # report how well the embedding topics agree with the regex topics on papers the classifier hasn't seen
+    topic_cols = [f"topic_{topic}" for topic in classifier["topics"]]
+    df_holdout = df_regex[is_holdout]
+    df_predicted = topic_modeling.add_topics_from_embeddings(
+        df_holdout[["cord_uid"]].copy(), classifier, embeddings, cord_uid_to_row)
+    agreement = get_topic_agreement(df_holdout[topic_cols], df_predicted[topic_cols])
+    logging.info(
+        f"Agreement of embedding topics with regex topics on {len(df_holdout)} held-out papers:\n"
+        + agreement.to_string(float_format="{:.2f}".format))
+
+    topic_modeling.add_topics_from_embeddings(state["df_covid"], classifier, embeddings, cord_uid_to_row)
+    return state
+
+
+def _run_summaries_stage(state):
+    """Add summaries"""
+    df_covid_with_texts = state["df_covid_with_texts"]
+    summarization.summarize_text(df_covid_with_texts, stale_cord_uids=state["stale_cord_uids"])
     summarization.clean_summaries(df_covid_with_texts)
     df_covid_with_texts["summary_length"] = df_covid_with_texts["scibert_summary_short_cleaned"].str.len()
+    return state
+
 
-    # save the data to disk
+def _run_publish_stage(state):
+    """Save the data to disk and s3"""
     logging.info("Saving to disk")
-    with open(os.path.join(DATA_DIR, DF_COVID_PATH), "wb") as f:
-        pickle.dump(df_covid, f)
-    with open(os.path.join(DATA_DIR, DF_COVID_TEXT_ONLY_PATH), "wb") as f:
-        pickle.dump(df_covid_with_texts, f)
-    
-    # save the data to s3
+    save_covid_data(state["df_covid"])
+    save_covid_data(state["df_covid_with_texts"], text_only=True)
+
     logging.info("Saving to s3")
-    save_web_data_aws(df_covid, DF_COVID_PATH)
-    save_web_data_aws(df_covid_with_texts, DF_COVID_TEXT_ONLY_PATH)
+    save_web_data_aws(state["df_covid"], DF_COVID_PATH)
+    save_web_data_aws(state["df_covid_with_texts"], DF_COVID_TEXT_ONLY_PATH)
+    # the data now lives in the published files
+    return {}
+
+
+PIPELINE_STAGE_FUNCTIONS = {
+    "ingest": _run_ingest_stage,
+    "texts": _run_texts_stage,
+    "language": _run_language_stage,
+    "tokens": _run_tokens_stage,
+    "topics": _run_topics_stage,
+    "clinical": _run_clinical_stage,
+    "keywords": _run_keywords_stage,
+    "embedding_topics": _run_embedding_topics_stage,
+    "summaries": _run_summaries_stage,
+    "publish": _run_publish_stage,
+}
+
+
+def load_metadata(chunksize=METADATA_CHUNKSIZE, terms=COVID_TERMS):
+    """Load metadata for recent papers that discuss COVID-19
+
+    Streams metadata.csv in chunks and only keeps the rows that survive the
+    date and COVID-19 filters, so peak memory depends on the chunk size rather
+    than the size of the full metadata file.
+
+    Parameters
+    ----------
+    chunksize: int
+        number of rows to read at a time. If None, reads the full file at once.
+    terms: list[str]
+        a paper is kept if its title or abstract mentions any of these terms
+
+    Returns
+    -------
+    DataFrame
+        a dataframe of covid research paper metadata
+
+    """
+    path = os.path.join(DATA_DIR, "metadata.csv")
+    term_filter = TermFilter(terms)
+    if chunksize is None:
+        df_meta = pd.read_csv(path, dtype=METADATA_DTYPES)
+        logging.info(f"Starting with {len(df_meta)} documents")
+        df_covid = filter_metadata(df_meta, term_filter)
+    else:
+        num_docs = 0
+        chunks = []
+        for df_chunk in pd.read_csv(path, dtype=METADATA_DTYPES, chunksize=chunksize):
+            num_docs += len(df_chunk)
+            chunks.append(filter_metadata(df_chunk, term_filter))
+        logging.info(f"Starting with {num_docs} documents")
+        df_covid = pd.concat(chunks)
+    logging.info(f"Kept {len(df_covid)} Covid-only documents")
+    return df_covid
+
+
+def filter_metadata(df_meta, term_filter=None):
+    """Filter metadata to papers published since COVID-19 that discuss COVID-19
+
+    Parameters
+    ----------
+    df_meta: DataFrame
+        raw metadata, or a chunk of it
+    term_filter: TermFilter
+        filter for the title and abstract. Defaults to the COVID-19 terms.
+
+    Returns
+    -------
+    DataFrame
+        the filtered metadata with publish dates and peer review flags
+
+    """
+    if term_filter is None:
+        term_filter = COVID_FILTER
+    df_meta["publish_date"] = pd.to_datetime(
+        df_meta["publish_time"], infer_datetime_format=True
+    )
+
+    # we only want documents after covid was a thing, and before the current date
+    date_flag = (
+        df_meta["publish_date"] > datetime.strptime(
+            COVID_START_DATE, "%Y-%m-%d")
+    ) & (df_meta["publish_date"] < datetime.now())
+    df_recent = df_meta[date_flag]
+    is_covid = term_filter.contains(df_recent, "title") | term_filter.contains(df_recent, "abstract")
+    df_covid = df_recent[is_covid]
+
+    # add whether paper was peer reviewed
+    df_covid["is_peer_reviewed"] = is_peer_reviewed(df_covid)
+    return df_covid
+
+
+def col_contains_covid(df, col):
+    """Returns a flag if the given column mentions the coronavirus"""
+    return COVID_FILTER.contains(df, col)
+
+
+def get_content_hashes(df, cols=CONTENT_HASH_COLUMNS):
+    """Get a hash of the content of each paper
+
+    Parameters
+    ----------
+    df: DataFrame
+        dataframe of papers
+    cols: list[str]
+        columns that make up the content of a paper
+
+    Returns
+    -------
+    Series
+        an md5 hex digest for each paper
+
+    """
+    values = df[cols].fillna("").astype(str).values
+    return pd.Series(
+        [hashlib.md5("\x1f".join(row).encode()).hexdigest() for row in values],
+        index=df.index
+    )
+
+
+def get_source_hashes(df, cols=SOURCE_HASH_COLUMNS):
+    """Get a hash of the inputs of each paper's content that are cheap to read
+
+    Parse files are hashed by their path, size and modification time instead
+    of their contents, so no file is opened.
+
+    Parameters
+    ----------
+    df: DataFrame
+        dataframe of papers with a pdf_filename column of parse files separated by semicolons
+    cols: list[str]
+        other columns that make up the inputs of a paper
+
+    Returns
+    -------
+    Series
+        an md5 hex digest for each paper
+
+    """
+    def _get_file_stats(paths):
+        stats = []
+        for path in paths.split(";"):
+            path = path.strip()
+            if len(path) > 0:
+                stat = os.stat(os.path.join(DATA_DIR, path))
+                stats.append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+        return ";".join(stats)
+
+    values = df[cols].fillna("").astype(str).values
+    file_stats = [_get_file_stats(paths) for paths in df["pdf_filename"].fillna("")]
+    return pd.Series(
+        [hashlib.md5("\x1f".join(list(row) + [stats]).encode()).hexdigest()
+         for row, stats in zip(values, file_stats)],
+        index=df.index
+    )
+
+
+def get_unchanged_sources(df, df_prev):
+    """Get which papers have the same source hash as in the previous snapshot
+
+    Parameters
+    ----------
+    df: DataFrame
+        papers with source hashes
+    df_prev: DataFrame
+        previous snapshot of processed papers, or None
+
+    Returns
+    -------
+    array
+        boolean flag for each paper
+
+    """
+    if df_prev is None or "source_hash" not in df_prev.columns:
+        return np.zeros(len(df), dtype=bool)
+    return df["source_hash"].isin(set(df_prev["source_hash"].dropna())).to_numpy()
+
+
+def load_previous_snapshot():
+    """Load the previous processed snapshot of papers with text
+
+    Returns
+    -------
+    DataFrame
+        the previous snapshot, or None if there is no usable snapshot
+
+    """
+    has_snapshot = any(
+        os.path.exists(os.path.join(DATA_DIR, path))
+        for path in [DF_COVID_TEXT_ONLY_DATASET, DF_COVID_TEXT_ONLY_PATH]
+    )
+    if not has_snapshot:
+        logging.info("No previous snapshot found")
+        return None
+    columns = ["cord_uid", "content_hash"] + REUSED_COLUMNS
+    try:
+        return load_covid_data(text_only=True, columns=columns + ["source_hash"])
+    except (KeyError, ValueError):
+        pass
+    try:
+        # snapshots from before source hashes were kept, whose texts are all read from the parse files
+        return load_covid_data(text_only=True, columns=columns)
+    except (KeyError, ValueError):
+        logging.info("Previous snapshot has no content hashes")
+        return None
+
+
+def load_non_english_hashes():
+    """Load the content and source hashes of papers previously dropped as non-English"""
+    path = os.path.join(DATA_DIR, NON_ENGLISH_HASHES_PATH)
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def save_non_english_hashes(hashes):
+    """Add content and source hashes of non-English papers to the saved ones"""
+    non_english_hashes = load_non_english_hashes()
+    if set(hashes) <= non_english_hashes:
+        return
+    non_english_hashes.update(hashes)
+    with open(os.path.join(DATA_DIR, NON_ENGLISH_HASHES_PATH), "wb") as f:
+        pickle.dump(non_english_hashes, f)
+
+
+def split_changed_papers(df, df_prev, non_english_hashes=None):
+    """Split papers into those unchanged since the previous snapshot and the rest
+
+    Unchanged papers get the processed columns of the previous snapshot.
+    Unchanged papers that were dropped as non-English are reused too, which
+    leaves them out of both sets, as the language stage would.
+
+    Parameters
+    ----------
+    df: DataFrame
+        papers with text and content hashes
+    df_prev: DataFrame
+        previous snapshot of processed papers. If None, every paper is treated as new.
+    non_english_hashes: set
+        content hashes of papers previously dropped as non-English
+
+    Returns
+    -------
+    DataFrame, DataFrame, set
+        the unchanged papers, the new or changed papers, and the cord_uids of papers
+        whose content changed since the previous snapshot
+
+    """
+    if df_prev is None:
+        return df.iloc[0:0], df, set()
+
+    df_prev = df_prev.drop_duplicates(subset=["cord_uid"]).set_index("cord_uid")
+    prev_hashes = df["cord_uid"].map(df_prev["content_hash"])
+    is_unchanged = df["content_hash"] == prev_hashes
+    is_changed = prev_hashes.notnull() & ~is_unchanged
+    is_non_english = df["content_hash"].isin(non_english_hashes or set()) & ~is_unchanged
+
+    df_unchanged = df[is_unchanged].copy()
+    for col in REUSED_COLUMNS:
+        df_unchanged[col] = df_unchanged["cord_uid"].map(df_prev[col])
+    return df_unchanged, df[~is_unchanged & ~is_non_english].copy(), set(df.loc[is_changed, "cord_uid"])
 
 
 def save_drug_data():
@@ -220,6 +760,9 @@ def save_drug_data():
             name_to_aliases[name] = [name]
     df["aliases"] = df["name"].map(name_to_aliases).apply(lambda d: d if isinstance(d, list) else [])
 
+    # save the published results, to match clinical papers against in the next run
+    topic_modeling.save_clinical_paper_paths(df["published_results"].dropna().tolist())
+
     # count drug mentions
     logging.info("Count drug mentions")
     es = Elasticsearch(ES_URL)
@@ -250,13 +793,61 @@ def save_drug_data():
 
 
 
-def detect_language(text):
+def detect_languages(df, n_workers=None, sample_chars=LANGUAGE_SAMPLE_CHARS):
+    """Detect the language of each paper's text.
+
+    Runs across a process pool and caches results by the paper's sha, so
+    unchanged papers are never re-detected.
+
+    Parameters
+    ----------
+    df: DataFrame
+        papers with sha and text columns
+    n_workers: int
+        number of processes to use. Defaults to the number of CPUs.
+    sample_chars: int
+        number of characters to classify before falling back to the full text
+
+    Returns
+    -------
+    Series
+        language of each paper
+
+    """
+    cache_path = os.path.join(DATA_DIR, LANGUAGE_CACHE_PATH)
+    sha_to_language = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            sha_to_language = pickle.load(f)
+
+    df_missing = df[~df["sha"].isin(sha_to_language)].drop_duplicates(subset=["sha"])
+    logging.info(f"Detecting language for {len(df_missing)} papers, {len(df) - len(df_missing)} cached")
+    if len(df_missing) > 0:
+        with track_stage("language.detect", rows_in=len(df_missing)) as stats, \
+                Pool(n_workers or get_num_cores()) as pool:
+            languages = pool.map(
+                partial(detect_language, sample_chars=sample_chars),
+                df_missing["text"],
+                chunksize=64
+            )
+            stats.rows_out = len(languages)
+            stats.add_count("docs", len(languages))
+        sha_to_language.update(zip(df_missing["sha"], languages))
+        with open(cache_path, "wb") as f:
+            pickle.dump(sha_to_language, f)
+    return df["sha"].map(sha_to_language)
+
+
+def detect_language(text, sample_chars=None):
     """Detect the language of the text. 
 
     Parameters
     ----------
     text: str
         text for which to detect language
+    sample_chars: int
+        if set, classifies the first sample_chars characters first and only
+        falls back to the full text if that is not confident
 
     Returns
     -------
@@ -264,15 +855,23 @@ def detect_language(text):
         language of the text. Returns English if not confident.
 
     """
-    detector = Detector(text, quiet=True)
+    if sample_chars is not None and len(text) > sample_chars:
+        language = _get_confident_language(Detector(text[:sample_chars], quiet=True))
+        if language is not None:
+            return language
+    language = _get_confident_language(Detector(text, quiet=True))
     # return English by default
+    return "English" if language is None else language
+
+
+def _get_confident_language(detector):
+    """Get the detected language if there is > 90% confidence, otherwise None"""
     if not detector.reliable:
-        return "English"
+        return None
     for language in detector.languages:
-        # return if there is > 90% confidence
         if language.confidence > 90:
             return language.name
-    return "English"
+    return None
 
 def is_peer_reviewed(df):
     """Adds column for whether the paper is peer reviewed.
@@ -348,7 +947,10 @@ def load_text(path):
         the loaded text
 
     """
-    with open(os.path.join(DATA_DIR, path)) as f:
+    with open(os.path.join(DATA_DIR, path), "rb") as f:
+        # stream only the body text if we can rather than decoding the whole parse
+        if ijson is not None:
+            return "\n".join(ijson.items(f, "body_text.item.text"))
         sample_text = json.load(f)
         return "\n".join([body["text"] for body in sample_text["body_text"]])
 
@@ -382,22 +984,45 @@ def add_texts(paths):
             text = path_text
     return text
 
-def parallelize_dataframe(df, func, n_cores=16):
-    """Parallelize a function over the dataframe
-    
+def load_texts(paths, max_workers=TEXT_LOADER_WORKERS):
+    """Load texts for many documents concurrently.
+
+    Loading is I/O bound, so parse files are fetched with a bounded thread pool.
+    Unlike add_texts, only one parse per document is decoded: the largest file
+    on disk, which is a cheap stand-in for the longest text.
+
     Parameters
     ----------
-    df: DataFrame
-        dataframe of interest
-    func: function
-        function of interest
-    n_cores: int
-        number of cores to use
+    paths: Series
+        paths to load for each document, separated by semicolon
+    max_workers: int
+        maximum number of files to load at once
+
+    Returns
+    -------
+    Series
+        the loaded text for each document
 
     """
-    df_split = np.array_split(df, n_cores)
-    pool = Pool(n_cores)
-    df = pd.concat(pool.map(func, df_split))
-    pool.close()
-    pool.join()
-    return df
\ No newline at end of file
+    with track_stage("texts.load", rows_in=len(paths)) as stats, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_load_largest_text, paths))
+        stats.rows_out = len(results)
+        stats.add_count("files", sum(1 for text, num_bytes in results if num_bytes > 0))
+        stats.add_count("bytes", sum(num_bytes for text, num_bytes in results))
+    return pd.Series([text for text, num_bytes in results], index=paths.index)
+
+
+def _load_largest_text(paths):
+    """Load the text of the largest parse in paths. Returns the text and file size"""
+    largest_path, largest_size = None, 0
+    for path in paths.split(";"):
+        path = path.strip()
+        if len(path) == 0:
+            continue
+        size = os.path.getsize(os.path.join(DATA_DIR, path))
+        if largest_path is None or size > largest_size:
+            largest_path, largest_size = path, size
+    if largest_path is None:
+        return "", 0
+    return load_text(largest_path), largest_size
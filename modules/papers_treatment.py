@@ -1,16 +1,17 @@
 """Get documents on treatments"""
-import nltk
+import numpy as np
 import os
 import pickle
 import re
 from collections import Counter, defaultdict
 
 
-from covid_docs import load_covid_data
-from utils.topic_extraction_utils import *
+from covid_docs import WEB_COLUMNS, load_covid_data
+from utils.token_store_utils import TokenStore
 from utils.web_utils import *
 
 RE_TOPIC = "treat[a-z]*"
+COLUMNS = WEB_COLUMNS + ["text"]
 FNAME = "web_data_treatment_papers.pkl"
 
 def save_data_for_website(save_local=True, save_aws=False):
@@ -26,7 +27,9 @@ def save_data_for_website(save_local=True, save_aws=False):
     """
     df_treatment = get_papers()
 
-    to_dump = get_data_for_web(df_treatment, RE_TOPIC)
+    # compare treatment topics against the whole corpus, not just the treatment papers
+    baseline = get_corpus_baseline(load_covid_data(text_only=True, columns=["cord_uid"])["cord_uid"])
+    to_dump = get_data_for_web(df_treatment, baseline=baseline)
 
     drug_counts, paper_counts = count_drugs_mentions(df_treatment)
     most_common_drugs = [drug for drug, count in drug_counts.most_common(n=10)]
@@ -64,19 +67,23 @@ def count_drugs_mentions(df):
 
     """
     drug_alias_to_name = get_drug_names()
+    store = TokenStore()
+    store.add_docs(df, fields=["text"])
+
+    # map each token id to its drug name, so papers are counted from their token ids
+    # NOTE: this only works with single-word aliases
+    token_drugs = np.array(
+        [drug_alias_to_name.get(token.lower()) for token in store.vocab], dtype=object)
+    is_drug = np.array([drug is not None for drug in token_drugs], dtype=bool)
 
     drug_counts = Counter()
     paper_counts = defaultdict(Counter)
-    for cord_uid, row in df.iterrows():
-        sentences = nltk.sent_tokenize(row["text"])
-        for sent in sentences:
-            for token in nltk.word_tokenize(sent):
-                token = token.lower()
-                if token in drug_alias_to_name:
-                    # NOTE: this only works with single-word aliases
-                    drug_name = drug_alias_to_name[token]
-                    drug_counts[drug_name] += 1
-                    paper_counts[drug_name][cord_uid] += 1
+    for cord_uid, text in zip(df["cord_uid"], df["text"]):
+        token_ids = store.get_doc_token_ids(cord_uid, "text", text)
+        drug_token_ids = token_ids[is_drug[token_ids]]
+        for drug_name in token_drugs[drug_token_ids]:
+            drug_counts[drug_name] += 1
+            paper_counts[drug_name][cord_uid] += 1
     return drug_counts, paper_counts
 
 
@@ -89,10 +96,9 @@ def get_papers():
         dataframe of treatment documents
 
     """
-    def count_treatments(df):
-        # TODO: normalize by text length?
-        return df["text"].str.count(RE_TOPIC)
-    return filter_docs_by_count(count_treatments, 10)
+    df = load_covid_data(text_only=True, columns=COLUMNS).set_index("cord_uid", drop=False)
+    # TODO: normalize by text length?
+    return df[df["text"].str.count(RE_TOPIC) >= 10]
 
 
 def get_drug_names():
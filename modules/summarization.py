@@ -1,23 +1,40 @@
+import logging
 import nltk
 import numpy as np
 import os
+import pandas as pd
 import pickle
 import re
 import shutil
-import torch
-from transformers import AutoModel
-from transformers import AutoConfig
-from transformers import AutoTokenizer
-from summarizer import Summarizer
 import sklearn
+import threading
 
 # Config
 from utils.constants import DATA_DIR
+from utils.embedding_cache_utils import SentenceEmbeddingCache, get_sentence_key
+from utils.instrumentation_utils import track_stage
+from utils.token_store_utils import TokenStore
 PATH_SCIBERT_MODEL = os.path.join(DATA_DIR, 'scibert_scivocab_uncased')
+SUMMARY_TARGET_CHARS = 500
+# number of sentences in each forward pass
+SUMMARY_BATCH_SIZE = 32
+# number of papers whose sentences are embedded together, which bounds memory
+SUMMARY_DOCS_PER_CHUNK = 64
+# path of the weights of each model BertSummarizer can load by name
+MODEL_PATHS = {
+    'allenai/scibert_scivocab_uncased': PATH_SCIBERT_MODEL,
+}
+
+# models loaded so far, shared by every BertSummarizer in the process. torch,
+# transformers and summarizer are also only imported once a model is needed,
+# so importing this module stays cheap for jobs that never summarize
+_MODEL_REGISTRY = {}
+_MODEL_REGISTRY_LOCK = threading.Lock()
 
 # for interaction with the main script
-def discard_sentence(sentence):
-    words = set(nltk.word_tokenize(sentence))
+def discard_sentence(sentence, words=None):
+    if words is None:
+        words = set(nltk.word_tokenize(sentence))
     boilerplate_sentence_words = ["license", "CC-BY-NC-ND", "medRxiv", "manuscript"]
     for word in boilerplate_sentence_words:
         if word in words:
@@ -45,23 +62,37 @@ def clean_text(text):
     text = re_space.sub(" ", text)
     return text.strip()
 
-def clean_summaries(df):
-    """Clean summaries in the dataframe"""
+def clean_summaries(df, store=None):
+    """Clean summaries in the dataframe
+
+    Summaries are tokenized through the token store, so only new or changed
+    summaries are tokenized again.
+    """
+    store = store or TokenStore()
+    store.add_docs(df, fields=["scibert_summary_short"])
     new_summaries = []
-    for summary in df["scibert_summary_short"]:
-        s = nltk.sent_tokenize(summary)
+    for cord_uid, summary in zip(df["cord_uid"], df["scibert_summary_short"]):
+        s = store.get_sentence_texts(cord_uid, "scibert_summary_short", summary)
+        sentence_tokens = store.get_sentences(cord_uid, "scibert_summary_short", summary)
         new_summary = []
-        for sentence in s:
-            if not discard_sentence(sentence):
+        for sentence, tokens in zip(s, sentence_tokens):
+            if not discard_sentence(sentence, set(tokens)):
                 new_summary.append(clean_text(sentence))
         new_summaries.append(" ".join(new_summary))
     df["scibert_summary_short_cleaned"] = new_summaries
 
     
-def summarize_text(df):
+def summarize_text(
+        df, stale_cord_uids=None, batch_size=SUMMARY_BATCH_SIZE, n_threads=None, quantized=False,
+        max_tokens=512):
     """Summarize the text in the dataframe. Uses cache where possible
 
-    Fills in the gaps otherwise. 
+    Fills in the gaps otherwise. Papers in stale_cord_uids have changed since
+    they were summarized, so their cached summaries are regenerated. Missing
+    summaries are generated with batch_size sentences per forward pass, on
+    n_threads torch threads (defaults to torch's own setting). quantized and
+    max_tokens select a faster SciBERT mode, see BertSummarizer and
+    scripts/compare_summarization_modes.py.
 
     Performs this replacement in-place.
 
@@ -69,34 +100,48 @@ def summarize_text(df):
     ID_TO_SUMMARY_PATH = "cord_uid_to_summaries_short.pkl"
     with open(os.path.join(DATA_DIR, ID_TO_SUMMARY_PATH), "rb") as f:
         cord_uid_to_summary = pickle.load(f)
+    for cord_uid in stale_cord_uids or []:
+        cord_uid_to_summary.pop(cord_uid, None)
     df["scibert_summary_short"] = df["cord_uid"].map(cord_uid_to_summary).fillna("")
 
     df_missing_summaries = df[df["scibert_summary_short"].str.len() == 0]
     num_missing_summaries = len(df_missing_summaries)
 
     if num_missing_summaries > 0:
-        print(f"Found {num_missing_summaries} missing summaries")
+        logging.info(f"Found {num_missing_summaries} missing summaries")
 
         with open(os.path.join(DATA_DIR, "df_missing_summaries.pkl"), "wb") as f:
             pickle.dump(df_missing_summaries, f)
+        import torch
         # load model to fill in missing summaries
-        model = BertSummarizer()
-
-        def f(text):
-            target_chars = 500
-            if len(text) < 1000: # "papers" with fewer than 1000 characters are often mis-parses. There are 155 such papers.
-                return "No summary available."
-            if len(text) < target_chars:
-                return text
-            try:
-                summary = model.summarize_text(text, ratio=target_chars/len(text), use_first=True)
-                if len(summary) == 0:
-                    return "No summary available."
-                return summary
-            except IndexError:
-                return "No summary available."
-        additional_summaries = df_missing_summaries.set_index("cord_uid")[
-            "text"].apply(f)
+        cache = SentenceEmbeddingCache()
+        try:
+            model = BertSummarizer(cache=cache, quantized=quantized, max_tokens=max_tokens)
+            if n_threads is not None:
+                torch.set_num_threads(n_threads)
+
+            with track_stage("summaries.generate", rows_in=num_missing_summaries) as stats:
+                stats.extra.update({
+                    "batch_size": batch_size,
+                    "threads": torch.get_num_threads(),
+                    "quantized": quantized,
+                    "max_tokens": max_tokens,
+                })
+                texts = df_missing_summaries["text"].fillna("").tolist()
+                summaries = []
+                for start in range(0, len(texts), SUMMARY_DOCS_PER_CHUNK):
+                    chunk_summaries, num_sentences = model.summarize_texts(
+                        texts[start:start + SUMMARY_DOCS_PER_CHUNK], SUMMARY_TARGET_CHARS, batch_size)
+                    summaries.extend(chunk_summaries)
+                    stats.add_count("sentences", num_sentences)
+                additional_summaries = pd.Series(summaries, index=df_missing_summaries["cord_uid"])
+                stats.rows_out = len(additional_summaries)
+                stats.add_count("docs", len(additional_summaries))
+                stats.add_count("chars", int(df_missing_summaries["text"].str.len().sum()))
+                stats.extra["cache_hit_rate"] = cache.hit_rate
+            logging.info(f"Sentence embedding cache hit rate: {cache.hit_rate}")
+        finally:
+            cache.close()
         cord_uid_to_summary.update(additional_summaries)
 
         # backup old summary dictionary
@@ -110,8 +155,8 @@ def summarize_text(df):
         # sanity check - not always true because sometimes new papers get added
         # assert(len(cord_uid_to_summary) == len(df))
 
-        # fill in missing summaries
-        df["scibert_summary"] = df["cord_uid"].map(cord_uid_to_summary)
+        # fill in missing and regenerated summaries
+        df["scibert_summary_short"] = df["cord_uid"].map(cord_uid_to_summary)
 
 
 # Helpers
@@ -165,30 +210,67 @@ def calculate_sentence_scores(text_string, frequency_table):
     return sentence_scores
 
 
-def build_scibert_objects():
+def build_scibert_objects(path=PATH_SCIBERT_MODEL):
 
     # Build SciBert model objects so it can be cached when making many summaries
+    from transformers import AutoConfig, AutoModel, AutoTokenizer
 
-    scibert_config = AutoConfig.from_pretrained(PATH_SCIBERT_MODEL)
+    scibert_config = AutoConfig.from_pretrained(path)
     scibert_config.output_hidden_states = True
-    scibert_tokenizer = AutoTokenizer.from_pretrained(PATH_SCIBERT_MODEL)
+    scibert_tokenizer = AutoTokenizer.from_pretrained(path)
     scibert_model = AutoModel.from_pretrained(
-        PATH_SCIBERT_MODEL, config=scibert_config)
+        path, config=scibert_config)
 
     return scibert_model, scibert_tokenizer
 
 
-class BertSummarizer(object):
+def get_model(model='allenai/scibert_scivocab_uncased', quantized=False):
+    """Get a model and its tokenizer by name, loading them on first use
+
+    Parameters
+    ----------
+    model: str
+        name of the model, a key of MODEL_PATHS
+    quantized: bool
+        whether to get the model with dynamically quantized int8 linear layers,
+        which runs faster on CPU. Unless the full-precision model was already
+        loaded, it is quantized in place and not kept.
+
+    Returns
+    -------
+    tuple
+        the model and its tokenizer
 
     """
-    Base handler for BERT models.
-    """
+    with _MODEL_REGISTRY_LOCK:
+        if (model, quantized) in _MODEL_REGISTRY:
+            return _MODEL_REGISTRY[(model, quantized)]
+        if model not in MODEL_PATHS:
+            raise ValueError(f"Unknown model {model}. Models are {list(MODEL_PATHS)}")
+
+        is_loaded = (model, False) in _MODEL_REGISTRY
+        if not is_loaded:
+            logging.info(f"Loading {model} from {MODEL_PATHS[model]}")
+        base_model, tokenizer = _MODEL_REGISTRY.get((model, False)) or build_scibert_objects(MODEL_PATHS[model])
+        if quantized:
+            import torch
+            logging.info(f"Quantizing {model}")
+            # a model that isn't shared is quantized in place, so only the int8 copy is kept
+            _MODEL_REGISTRY[(model, True)] = (
+                torch.quantization.quantize_dynamic(
+                    base_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=not is_loaded),
+                tokenizer,
+            )
+        else:
+            _MODEL_REGISTRY[(model, False)] = (base_model, tokenizer)
+        return _MODEL_REGISTRY[(model, quantized)]
+
 
-    scibert_model, scibert_tokenizer = build_scibert_objects()
+class BertSummarizer(object):
 
-    MODELS = {
-        'allenai/scibert_scivocab_uncased': (scibert_model, scibert_tokenizer)
-    }
+    """
+    Base handler for BERT models. Models are loaded on first use through get_model.
+    """
 
     summarizer = None
 
@@ -197,29 +279,37 @@ class BertSummarizer(object):
         model: str = 'allenai/scibert_scivocab_uncased',
         custom_model=None,
         custom_tokenizer=None,
-        use_coreference_handling: bool = False
+        use_coreference_handling: bool = False,
+        cache: SentenceEmbeddingCache = None,
+        quantized: bool = False,
+        max_tokens: int = 512
     ):
         """
         :param model: Model is the string path for the bert weights. If given a keyword, the s3 path will be used
         :param custom_model: This is optional if a custom bert model is used
         :param custom_tokenizer: Place to use custom tokenizer
         :param use_coreference_handling: whether to use coreference handling
+        :param cache: cache that batched sentence embeddings are read from and added to, if any
+        :param quantized: whether to use int8 dynamically quantized linear layers, which run faster on CPU
+        :param max_tokens: maximum number of tokens of each sentence in batched embeddings
         """
 
-        base_model, base_tokenizer = self.MODELS.get(model, (None, None))
-
         if custom_model is not None:
             self.model = custom_model
         else:
-            self.model = base_model
+            self.model = get_model(model, quantized)[0]
 
         if custom_tokenizer is not None:
             self.tokenizer = custom_tokenizer
         else:
-            self.tokenizer = base_tokenizer
+            self.tokenizer = get_model(model, quantized)[1]
 
         self.model.eval()
+        # quantized embeddings differ slightly, so they are cached separately
+        self.model_name = f"{model}:int8" if quantized else model
+        self.max_tokens = max_tokens
         self.use_coreference_handling = use_coreference_handling
+        self.cache = cache
 
     # for interaction with the main script
     def discard_sentence(sentence):
@@ -237,6 +327,7 @@ class BertSummarizer(object):
         :params kwargs: kwargs to pass to tokenizer
         """
         if self.summarizer is None:
+            from summarizer import Summarizer
             summarizer_kwargs = {
                 "custom_model": self.model,
                 "custom_tokenizer": self.tokenizer
@@ -248,7 +339,7 @@ class BertSummarizer(object):
             self.summarizer = Summarizer(**summarizer_kwargs)
         return self.summarizer(text, **kwargs)
 
-    def tokenize_input(self, text: str, max_tokens=512) -> torch.tensor:
+    def tokenize_input(self, text: str, max_tokens=512) -> 'torch.tensor':
         """
         Tokenizes the text input.
         :param text: Text to tokenize
@@ -257,13 +348,151 @@ class BertSummarizer(object):
         """
         # add cls and sep identifiers - unsure if this will help or not
         # text = '{} {} {}'.format('[CLS]', text, '[SEP]')
+        import torch
+        return torch.tensor([self._get_token_ids(text, max_tokens)])
+
+    def _get_token_ids(self, text: str, max_tokens=512):
+        """Get the token ids of the text, truncated to max_tokens"""
         tokenized_text = self.tokenizer.tokenize(text)
         # check if input is too long
         if len(tokenized_text) > max_tokens:
             tokenized_text = tokenized_text[:max_tokens]
             # tokenized_text.append('[SEP]')
-        indexed_tokens = self.tokenizer.convert_tokens_to_ids(tokenized_text)
-        return torch.tensor([indexed_tokens])
+        return self.tokenizer.convert_tokens_to_ids(tokenized_text)
+
+    def embed_sentences(
+        self,
+        sentences,
+        batch_size: int = SUMMARY_BATCH_SIZE,
+        hidden: int = -2,
+        max_tokens: int = None
+    ):
+        """
+        Extracts the embeddings of many sentences in batches
+
+        Sentences are sorted by length so each batch holds sentences of similar
+        lengths, and each batch is only padded to its longest sentence. Padding
+        is masked out, so a sentence gets the same embedding as from
+        _extract_sentence_embedding with the mean reduce option.
+
+        :param sentences: The sentences to extract embeddings for.
+        :param batch_size: The number of sentences in each forward pass
+        :param hidden: The hidden layer to use for a readout handler
+        :param max_tokens: maximum number of tokens of each sentence. Defaults to self.max_tokens.
+        :return: A (n_sentences x hidden size) float32 numpy array
+        """
+        max_tokens = max_tokens or self.max_tokens
+        if self.cache is None:
+            return self._embed_sentences(sentences, batch_size, hidden, max_tokens)
+
+        # only embed each sentence that isn't cached once
+        keys = [
+            get_sentence_key(sentence, f"{self.model_name}:{max_tokens}", hidden)
+            for sentence in sentences
+        ]
+        cached = self.cache.get_many(keys)
+        key_to_sentence = {key: sentence for key, sentence in zip(keys, sentences) if key not in cached}
+        if len(key_to_sentence) > 0:
+            new_embeddings = self._embed_sentences(
+                list(key_to_sentence.values()), batch_size, hidden, max_tokens)
+            self.cache.put_many(list(key_to_sentence.keys()), new_embeddings)
+            cached.update(zip(key_to_sentence.keys(), new_embeddings))
+        embeddings = np.zeros((len(sentences), self.model.config.hidden_size), dtype=np.float32)
+        for i, key in enumerate(keys):
+            embeddings[i] = cached[key]
+        return embeddings
+
+    def _embed_sentences(self, sentences, batch_size, hidden, max_tokens):
+        """Run the model on sentences in length-sorted, padded batches"""
+        import torch
+        token_ids = [self._get_token_ids(sentence, max_tokens) for sentence in sentences]
+        embeddings = np.zeros((len(sentences), self.model.config.hidden_size), dtype=np.float32)
+        order = np.argsort([len(ids) for ids in token_ids], kind="stable")
+        pad_id = self.tokenizer.pad_token_id or 0
+        with torch.no_grad():
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                max_len = max(len(token_ids[i]) for i in batch)
+                input_ids = torch.full((len(batch), max_len), pad_id, dtype=torch.long)
+                attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+                for row, i in enumerate(batch):
+                    input_ids[row, :len(token_ids[i])] = torch.tensor(token_ids[i], dtype=torch.long)
+                    attention_mask[row, :len(token_ids[i])] = 1
+                pooled, hidden_states = self.model(input_ids, attention_mask=attention_mask)[-2:]
+                if -1 > hidden > -12:
+                    mask = attention_mask.unsqueeze(-1).to(hidden_states[hidden].dtype)
+                    pooled = (hidden_states[hidden] * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+                embeddings[batch] = pooled.numpy()
+        return embeddings
+
+    def select_sentences(
+        self,
+        texts,
+        target_chars: int = SUMMARY_TARGET_CHARS,
+        batch_size: int = SUMMARY_BATCH_SIZE,
+        min_length: int = 40,
+        max_length: int = 600
+    ):
+        """
+        Selects the summary sentences of many texts, embedding the sentences of all of them in shared batches
+
+        Selects the same sentences as summarize_text with
+        ratio=target_chars/len(text) and use_first=True, i.e. the sentences
+        closest to the kmeans clusters of the sentence embeddings, plus the
+        first sentence.
+
+        :param texts: The texts to summarize
+        :param target_chars: The number of characters to aim for in each summary
+        :param batch_size: The number of sentences in each forward pass
+        :param min_length: The minimum number of characters of a sentence
+        :param max_length: The maximum number of characters of a sentence
+        :return: The selected sentences of each text, and the number of sentences that were embedded
+        """
+        from summarizer.cluster_features import ClusterFeatures
+        from summarizer.sentence_handler import SentenceHandler
+
+        sentence_handler = SentenceHandler()
+        doc_sentences = []
+        for text in texts:
+            # "papers" with fewer than 1000 characters are often mis-parses. There are 155 such papers.
+            if len(text) < 1000:
+                doc_sentences.append([])
+            else:
+                doc_sentences.append(sentence_handler.process(text, min_length, max_length))
+        offsets = np.cumsum([0] + [len(sentences) for sentences in doc_sentences])
+        embeddings = self.embed_sentences(
+            [sentence for sentences in doc_sentences for sentence in sentences], batch_size)
+
+        selected_sentences = []
+        for i, (text, sentences) in enumerate(zip(texts, doc_sentences)):
+            selected_sentences.append([])
+            if len(sentences) > 0:
+                try:
+                    selected = ClusterFeatures(
+                        embeddings[offsets[i]:offsets[i + 1]], "kmeans", random_state=12345
+                    ).cluster(target_chars / len(text))
+                    if selected[0] != 0:
+                        selected.insert(0, 0)
+                    selected_sentences[-1] = [sentences[j] for j in selected]
+                except IndexError:
+                    pass
+        return selected_sentences, int(offsets[-1])
+
+    def summarize_texts(self, texts, target_chars=SUMMARY_TARGET_CHARS, batch_size=SUMMARY_BATCH_SIZE):
+        """
+        Summarizes many texts, see select_sentences
+
+        :param texts: The texts to summarize
+        :param target_chars: The number of characters to aim for in each summary
+        :param batch_size: The number of sentences in each forward pass
+        :return: The summaries, and the number of sentences that were embedded
+        """
+        selected_sentences, num_sentences = self.select_sentences(texts, target_chars, batch_size)
+        summaries = [
+            " ".join(sentences) if len(sentences) > 0 else "No summary available."
+            for sentences in selected_sentences
+        ]
+        return summaries, num_sentences
 
     def _extract_sentence_embedding(
         self,
@@ -327,6 +556,42 @@ class BertSummarizer(object):
                 sentence, hidden, squeeze, reduce_option))
         return np.mean(sentence_embeddings, axis=0)
 
+    def extract_doc_embeddings(
+        self,
+        texts,
+        batch_size: int = SUMMARY_BATCH_SIZE,
+        hidden: int = -2
+    ):
+        """
+        Extracts the embeddings of many texts, like extract_doc_embedding with the mean reduce option
+
+        The kept sentences of all texts are embedded together in padded
+        batches, then averaged per text. Texts with no kept sentences get
+        zero embeddings.
+
+        :param texts: The texts to extract embeddings for.
+        :param batch_size: The number of sentences in each forward pass
+        :param hidden: The hidden layer to use for a readout handler
+        :return: A (n_texts x hidden size) float32 numpy array
+        """
+        sentences, num_sentences = [], []
+        for text in texts:
+            kept = [sentence for sentence in nltk.sent_tokenize(text) if not discard_sentence(sentence)]
+            sentences.extend(kept)
+            num_sentences.append(len(kept))
+        sentence_embeddings = self.embed_sentences(sentences, batch_size, hidden)
+
+        num_sentences = np.array(num_sentences)
+        has_sentences = num_sentences > 0
+        starts = np.concatenate([[0], np.cumsum(num_sentences)[:-1]])[has_sentences]
+        doc_embeddings = np.zeros((len(texts), sentence_embeddings.shape[1]), dtype=np.float32)
+        if len(starts) > 0:
+            doc_embeddings[has_sentences] = (
+                np.add.reduceat(sentence_embeddings, starts, axis=0)
+                / num_sentences[has_sentences, None]
+            )
+        return doc_embeddings
+
     def create_matrix(
         self,
         content,
@@ -335,15 +600,17 @@ class BertSummarizer(object):
     ):
         """
         Create matrix from the embeddings
-        :param content: The list of sentences
+        :param content: The list of texts
         :param hidden: Which hidden layer to use
         :param reduce_option: The reduce option to run.
         :return: A numpy array matrix of the given content.
         """
+        if reduce_option == 'mean':
+            return self.extract_doc_embeddings(content, hidden=hidden)
 
         return np.asarray([
             np.squeeze(self.extract_doc_embedding(t, hidden=hidden,
-                                                  reduce_option=reduce_option).data.numpy())
+                                                  reduce_option=reduce_option))
             for t in content
         ])
 
@@ -0,0 +1,49 @@
+"""Test code used to classify papers by embedding centroids"""
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils.centroid_utils import fit_centroid_classifier, normalize_rows, predict_labels
+from utils.topic_evaluation_utils import get_topic_agreement
+
+
+class TestCentroidUtils(unittest.TestCase):
+    """Test code used to classify papers by embedding centroids"""
+
+    def test_normalize_rows(self):
+        """Test that rows get unit norms and zero rows stay zero"""
+        unit_vectors = normalize_rows(np.array([[3.0, 4.0], [0.0, 0.0]]))
+        np.testing.assert_allclose(unit_vectors, [[0.6, 0.8], [0.0, 0.0]])
+
+    def test_separable_labels(self):
+        """Test that labels of well separated clusters are recovered, in chunks"""
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(3, 16)) * 5
+        labels = np.zeros((300, 3), dtype=bool)
+        labels[np.arange(300), np.arange(300) % 3] = True
+        embeddings = labels.astype(float) @ centers + rng.normal(size=(300, 16))
+        classifier = fit_centroid_classifier(embeddings, labels, chunk_rows=64)
+        np.testing.assert_array_equal(predict_labels(classifier, embeddings, chunk_rows=64), labels)
+
+    def test_unused_label(self):
+        """Test that a label no seed paper has is never predicted"""
+        embeddings = np.random.default_rng(0).normal(size=(20, 4))
+        labels = np.zeros((20, 2), dtype=bool)
+        labels[:10, 0] = True
+        classifier = fit_centroid_classifier(embeddings, labels)
+        self.assertFalse(predict_labels(classifier, embeddings)[:, 1].any())
+
+    def test_topic_agreement(self):
+        """Test the agreement between two engines"""
+        is_topic_a = pd.DataFrame({"vaccine": [True, True, False, False]})
+        is_topic_b = pd.DataFrame({"vaccine": [True, False, True, False]})
+        agreement = get_topic_agreement(is_topic_a, is_topic_b).loc["vaccine"]
+        self.assertAlmostEqual(agreement["agreement"], 0.5)
+        self.assertAlmostEqual(agreement["kappa"], 0.0)
+        self.assertAlmostEqual(agreement["precision"], 0.5)
+        self.assertAlmostEqual(agreement["recall"], 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Test code used to cache sentence embeddings"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from utils.embedding_cache_utils import SentenceEmbeddingCache, get_sentence_key
+
+
+class TestEmbeddingCacheUtils(unittest.TestCase):
+    """Test code used to cache sentence embeddings"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_sentence_key(self):
+        """Test that keys ignore whitespace but depend on the model and layer"""
+        key = get_sentence_key("Masks reduce  transmission. ", "scibert", -2)
+        self.assertEqual(key, get_sentence_key("Masks reduce\ntransmission.", "scibert", -2))
+        self.assertNotEqual(key, get_sentence_key("Masks reduce transmission.", "scibert", -1))
+        self.assertNotEqual(key, get_sentence_key("Masks reduce transmission.", "bert", -2))
+
+    def test_round_trip_and_hit_rate(self):
+        """Test that stored embeddings are found again, also after reopening the cache"""
+        cache = SentenceEmbeddingCache(self.path)
+        embeddings = np.random.default_rng(0).normal(size=(2, 4)).astype(np.float32)
+        self.assertIsNone(cache.hit_rate)
+        self.assertDictEqual(cache.get_many(["a", "b"]), {})
+        cache.put_many(["a", "b"], embeddings)
+        cache.close()
+
+        cache = SentenceEmbeddingCache(self.path)
+        found = cache.get_many(["b", "c", "b"])
+        np.testing.assert_array_equal(found["b"], embeddings[1])
+        self.assertNotIn("c", found)
+        self.assertAlmostEqual(cache.hit_rate, 2 / 3)
+        cache.close()
+
+    def test_least_recently_used_eviction(self):
+        """Test that the least recently used embeddings are evicted first"""
+        cache = SentenceEmbeddingCache(self.path, max_entries=2)
+        cache.put_many(["a"], np.zeros((1, 4)))
+        cache.put_many(["b"], np.zeros((1, 4)))
+        cache.get_many(["a"])
+        cache.put_many(["c"], np.zeros((1, 4)))
+        self.assertEqual(len(cache), 2)
+        self.assertListEqual(sorted(cache.get_many(["a", "b", "c"])), ["a", "c"])
+        cache.close()
+
+    def test_length(self):
+        """Test that the number of entries is kept up to date through replaced and duplicate keys"""
+        cache = SentenceEmbeddingCache(self.path, max_entries=3)
+        cache.put_many(["a", "b", "a"], np.zeros((3, 4)))
+        self.assertEqual(len(cache), 2)
+        cache.put_many(["b", "c", "d"], np.zeros((3, 4)))
+        self.assertEqual(len(cache), 3)
+        cache.close()
+        cache = SentenceEmbeddingCache(self.path, max_entries=3)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(len(cache.get_many(["a", "b", "c", "d"])), 3)
+        cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
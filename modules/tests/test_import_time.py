@@ -0,0 +1,65 @@
+"""Test that importing the pipeline modules is cheap"""
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+MODULES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# seconds covid_docs may take to import, in a fresh interpreter
+IMPORT_TIME_BUDGET = 10.0
+# modules that are only needed to summarize, so should not be imported up front
+LAZY_MODULES = ["transformers", "summarizer"]
+
+IMPORT_SCRIPT = """
+import json
+import sys
+import time
+start = time.perf_counter()
+try:
+    import {module}
+except ImportError as e:
+    print(json.dumps({{"missing": str(e)}}))
+    sys.exit()
+seconds = time.perf_counter() - start
+import summarization
+print(json.dumps({{
+    "seconds": seconds,
+    "loaded_models": list(summarization._MODEL_REGISTRY),
+    "lazy_modules": [name for name in {lazy_modules} if name in sys.modules],
+}}))
+"""
+
+
+def time_import(module):
+    """Import a module in a fresh interpreter, and get how long it took and what it loaded"""
+    script = IMPORT_SCRIPT.format(module=module, lazy_modules=LAZY_MODULES)
+    output = subprocess.run(
+        [sys.executable, "-c", script], cwd=MODULES_DIR, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class TestImportTime(unittest.TestCase):
+    """Test that importing the pipeline modules is cheap"""
+
+    def check_import(self, module):
+        """Check that importing the module loads no model and stays within the budget"""
+        result = time_import(module)
+        if "missing" in result:
+            self.skipTest(f"{module} has missing dependencies: {result['missing']}")
+        self.assertListEqual(result["loaded_models"], [])
+        self.assertListEqual(result["lazy_modules"], [])
+        self.assertLess(result["seconds"], IMPORT_TIME_BUDGET)
+
+    def test_summarization_import(self):
+        """Test that importing summarization does not load SciBERT"""
+        self.check_import("summarization")
+
+    def test_covid_docs_import(self):
+        """Test that importing covid_docs does not load SciBERT"""
+        self.check_import("covid_docs")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Test code used to measure pipeline stages"""
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+from utils import instrumentation_utils
+from utils.instrumentation_utils import StageStats, save_run_report, start_run, track_stage
+
+# MB allocated to raise the peak RSS of a stage
+ALLOC_MB = 200
+
+
+def _allocate(mb):
+    """Allocate and touch mb megabytes, then free them"""
+    array = np.ones(mb * 1024 * 1024 // 8)
+    del array
+
+
+def _can_reset_peak_rss():
+    """Whether the OS lets this process reset its peak RSS"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class TestInstrumentationUtils(unittest.TestCase):
+    """Test code used to measure pipeline stages"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        instrumentation_utils._CURRENT_RUN = None
+        self.directory.cleanup()
+
+    def test_to_dict_throughput(self):
+        """Test that counts are reported with their rate over the wall time"""
+        stats = StageStats("stage", rows_in=10)
+        stats.add_count("docs", 30)
+        stats.add_count("docs", 10)
+        stats.wall_time = 2.0
+        stats.extra["batch_size"] = 8
+        report = stats.to_dict()
+        self.assertEqual(report["docs"], 40)
+        self.assertEqual(report["docs_per_sec"], 20.0)
+        self.assertEqual(report["rows_in"], 10)
+        self.assertEqual(report["batch_size"], 8)
+        stats.wall_time = 0
+        self.assertIsNone(stats.to_dict()["docs_per_sec"])
+
+    def test_nested_stages(self):
+        """Test that nested stages are reported before their parent, which includes their time and memory"""
+        start_run("test")
+        with track_stage("outer") as outer:
+            with track_stage("inner") as inner:
+                _allocate(ALLOC_MB)
+        self.assertGreaterEqual(outer.wall_time, inner.wall_time)
+        self.assertGreaterEqual(outer.peak_rss_mb, inner.peak_rss_mb)
+        self.assertGreaterEqual(inner.peak_rss_mb, ALLOC_MB)
+        stages = instrumentation_utils._CURRENT_RUN["stages"]
+        self.assertListEqual([stage["name"] for stage in stages], ["inner", "outer"])
+
+    @unittest.skipUnless(_can_reset_peak_rss(), "peak RSS can't be reset on this OS")
+    def test_peak_rss_is_per_stage(self):
+        """Test that a stage's peak RSS doesn't include memory freed by an earlier stage"""
+        with track_stage("big") as big:
+            _allocate(ALLOC_MB)
+        with track_stage("small") as small:
+            pass
+        self.assertLess(small.peak_rss_mb, big.peak_rss_mb - ALLOC_MB / 2)
+
+    def test_report_saved_when_stage_fails(self):
+        """Test that a failing stage is recorded with its error, and the report can still be saved"""
+        start_run("test")
+        with self.assertRaises(ValueError):
+            try:
+                with track_stage("ok") as stats:
+                    stats.add_count("docs", 1)
+                with track_stage("broken"):
+                    raise ValueError("bad input")
+            finally:
+                path = save_run_report(self.directory.name)
+        with open(path) as f:
+            report = json.load(f)
+        self.assertListEqual([stage["name"] for stage in report["stages"]], ["ok", "broken"])
+        self.assertIn("bad input", report["stages"][1]["error"])
+        self.assertIn("finished_at", report)
+        self.assertIsNone(save_run_report(self.directory.name))
+
+
+if __name__ == "__main__":
+    unittest.main()
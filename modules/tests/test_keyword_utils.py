@@ -0,0 +1,85 @@
+"""Test code used to select the top keywords of documents"""
+import unittest
+
+import numpy as np
+from scipy.sparse import csr_matrix, random as sparse_random
+
+from utils.keyword_utils import KeywordModel, get_top_keywords
+from utils.parallel_utils import map_row_blocks
+
+
+class TestKeywordUtils(unittest.TestCase):
+    """Test code used to select the top keywords of documents"""
+
+    def setUp(self):
+        self.X = sparse_random(50, 200, density=0.2, format="csr", random_state=0)
+        self.feature_names = [f"word{i}" for i in range(200)]
+        self.keep_mask = np.arange(200) % 3 != 0
+
+    def test_same_keywords_as_dense_sort(self):
+        """Test that keywords match a full sort of each dense row"""
+        top_keywords = get_top_keywords(self.X, self.feature_names, self.keep_mask, num_keywords=5)
+        dense = self.X.toarray()
+        for row, keywords in zip(dense, top_keywords):
+            columns = [col for col in np.argsort(-row, kind="stable") if self.keep_mask[col] and row[col] > 0]
+            self.assertListEqual(keywords, [self.feature_names[col] for col in columns[:5]])
+
+    def test_ties_and_short_rows(self):
+        """Test that ties are broken by column and rows with few nonzeros get fewer keywords"""
+        X = csr_matrix(np.array([[0.5, 0.5, 0.5, 0.1], [0, 0, 0.2, 0]]))
+        self.assertListEqual(get_top_keywords(X, ["a", "b", "c", "d"], num_keywords=2), [["a", "b"], ["c"]])
+
+    def test_parallel_row_blocks(self):
+        """Test that row blocks are put back together in order"""
+        func = lambda start, end: get_top_keywords(self.X, self.feature_names, self.keep_mask, 5, start, end)
+        self.assertListEqual(
+            map_row_blocks(func, self.X.shape[0], n_cores=3, block_rows=7),
+            get_top_keywords(self.X, self.feature_names, self.keep_mask, 5)
+        )
+
+    def test_keyword_model_scores(self):
+        """Test that scores follow TfidfVectorizer's smoothed idf and l2 norm"""
+        docs = ["Virus spread spread fast", "virus vaccine", "a vaccine trial"]
+        model = KeywordModel()
+        model.update(["a", "b", "c"], docs)
+        X = model.transform(docs[:1]).toarray()[0]
+        self.assertEqual(X.dtype, np.float32)
+        columns = {word: model.vocab[word] for word in ["virus", "spread", "fast"]}
+        scores = np.array([
+            1 * (np.log(4 / 3) + 1), 2 * (np.log(4 / 2) + 1), 1 * (np.log(4 / 2) + 1)])
+        np.testing.assert_allclose(
+            X[[columns["virus"], columns["spread"], columns["fast"]]],
+            scores / np.linalg.norm(scores), rtol=1e-6)
+        self.assertAlmostEqual(float(X.sum()), float((scores / np.linalg.norm(scores)).sum()), places=5)
+
+    def test_keyword_model_update(self):
+        """Test that updating with changed docs gives the same statistics as a fresh fit"""
+        model = KeywordModel()
+        model.update(["a", "b"], ["virus spread", "virus vaccine"])
+        model.update(["b", "c"], ["mask mandate", "vaccine trial"])
+        fresh = KeywordModel()
+        fresh.update(["a", "b", "c"], ["virus spread", "mask mandate", "vaccine trial"])
+        self.assertEqual(model.n_docs, 3)
+        for word in fresh.vocab:
+            self.assertEqual(model.doc_freq[model.vocab[word]], fresh.doc_freq[fresh.vocab[word]])
+        self.assertEqual(model.doc_freq[model.vocab["virus"]], 1)
+
+    def test_keyword_model_hashing(self):
+        """Test that hashing caps the number of columns"""
+        model = KeywordModel(n_features=8)
+        model.update(["a", "b"], [" ".join(f"word{i}" for i in range(100)), "word1 other"])
+        self.assertEqual(len(model.feature_names), 8)
+        self.assertEqual(model.transform(["word1 word2"]).shape, (1, 8))
+        self.assertEqual(len(model.vocab), 0)
+
+    def test_keyword_model_hashing_names(self):
+        """Test that a hashed column is named after its most frequent word, not the first one seen"""
+        model = KeywordModel(n_features=1)
+        model.update(["a", "b", "c", "d"], ["rare common", "common", "common other", "common"])
+        self.assertListEqual(model.feature_names, ["common"])
+        model.update(["e"], ["rare rare rare"])
+        self.assertListEqual(model.feature_names, ["common"])
+
+
+if __name__ == "__main__":
+    unittest.main()
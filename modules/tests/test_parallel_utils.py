@@ -0,0 +1,89 @@
+"""Test code used to run DataFrame stages in parallel"""
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils import parallel_utils
+from utils.parallel_utils import get_balanced_chunks, imap_dataframe, map_row_blocks, parallelize_dataframe
+
+
+def _add_text_length(df):
+    """Add the length of each text"""
+    df["text_length"] = df["text"].str.len()
+    return df
+
+
+def _get_titles(df):
+    """Get the titles of the chunk"""
+    return df["title"].tolist()
+
+
+def _add_upper_title(df):
+    """Add the upper-cased title in-place"""
+    df["upper_title"] = df["title"].str.upper()
+
+
+class TestParallelUtils(unittest.TestCase):
+    """Test code used to run DataFrame stages in parallel"""
+
+    def setUp(self):
+        texts = ["x" * length for length in [5000, 10, 10, 10, 4000, 10, 0, 10, 10, 3000]]
+        self.df = pd.DataFrame(
+            {"title": [f"title {i}" for i in range(len(texts))], "text": texts},
+            index=[f"doc{i}" for i in range(len(texts))]
+        )
+
+    def test_balanced_chunks_cover_all_rows(self):
+        """Test that chunks are contiguous and cover every row once"""
+        chunks = get_balanced_chunks(np.array([5, 1, 1, 1, 4, 1, 1, 1, 1, 3]), 4)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], 10)
+        for (_, end), (start, _) in zip(chunks[:-1], chunks[1:]):
+            self.assertEqual(end, start)
+
+    def test_balanced_chunks_split_by_weight(self):
+        """Test that heavy rows do not share a chunk with many other rows"""
+        chunks = get_balanced_chunks(np.array([100, 1, 1, 1, 1, 1, 1, 1]), 2)
+        self.assertEqual(chunks, [(0, 1), (1, 8)])
+
+    def test_parallelize_dataframe_adds_new_columns(self):
+        """Test that new columns come back aligned with the input rows"""
+        df = parallelize_dataframe(self.df.copy(), _add_text_length, n_cores=3)
+        self.assertListEqual(df["text_length"].tolist(), self.df["text"].str.len().tolist())
+        self.assertListEqual(df.index.tolist(), self.df.index.tolist())
+
+    def test_parallelize_dataframe_in_place_function(self):
+        """Test functions that modify the chunk in-place"""
+        df = parallelize_dataframe(self.df.copy(), _add_upper_title, n_cores=2)
+        self.assertListEqual(df["upper_title"].tolist(), self.df["title"].str.upper().tolist())
+
+    def test_imap_dataframe_yields_in_order(self):
+        """Test that chunk results come back in row order with few chunks in flight"""
+        for n_cores in [1, 3]:
+            titles = [
+                title for chunk in imap_dataframe(self.df, _get_titles, n_cores=n_cores, chunk_rows=2, max_pending=2)
+                for title in chunk
+            ]
+            self.assertListEqual(titles, self.df["title"].tolist())
+
+    def test_interleaved_calls(self):
+        """Test that calls made while a generator is open don't change what it reads"""
+        df_other = self.df.assign(title=self.df["title"].str.upper())
+        first = imap_dataframe(self.df, _get_titles, n_cores=2, chunk_rows=2, max_pending=1)
+        titles = next(first)
+        second = imap_dataframe(df_other, _get_titles, n_cores=2, chunk_rows=2, max_pending=1)
+        other_titles = next(second)
+        df = parallelize_dataframe(df_other.copy(), _add_text_length, n_cores=2)
+        blocks = map_row_blocks(lambda start, end: list(range(start, end)), 10, n_cores=2, block_rows=3)
+        titles += [title for chunk in first for title in chunk]
+        other_titles += [title for chunk in second for title in chunk]
+        self.assertListEqual(titles, self.df["title"].tolist())
+        self.assertListEqual(other_titles, df_other["title"].tolist())
+        self.assertListEqual(df["text_length"].tolist(), self.df["text"].str.len().tolist())
+        self.assertListEqual(blocks, list(range(10)))
+        self.assertIsNone(parallel_utils._SHARED_DF)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Test code used to find mentions of terms in papers"""
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils.term_filter_utils import COVID_FILTER, TermFilter
+
+
+class TestTermFilterUtils(unittest.TestCase):
+    """Test code used to find mentions of terms in papers"""
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            "title": [
+                "COVID-19 in Children", "Outbreak in WUHAN", "Influenza vaccines", np.nan,
+                "SARS-CoV-2 spike protein", "SARS CoV 2 without hyphens",
+            ],
+            "abstract": [
+                np.nan, "A cluster of cases.", "No coronaviruses here? Coronavirus!", "A Corona discharge",
+                None, "Nothing relevant.",
+            ],
+        })
+
+    def test_contains(self):
+        """Test that contains ignores case, matches hyphenated terms and treats NaN as no match"""
+        self.assertListEqual(
+            COVID_FILTER.contains(self.df, "title").tolist(), [True, True, False, False, True, False])
+        self.assertListEqual(
+            COVID_FILTER.contains(self.df, "abstract").tolist(), [False, False, True, True, False, False])
+
+    def test_match(self):
+        """Test that match finds every term in any column, including terms within other terms"""
+        is_match, terms = COVID_FILTER.match(self.df, ["title", "abstract"])
+        self.assertListEqual(is_match.tolist(), [True, True, True, True, True, False])
+        self.assertListEqual(terms.tolist(), [
+            ["covid"], ["wuhan"], ["corona", "coronavirus"], ["corona"], ["sars-cov-2"], [],
+        ])
+
+    def test_contains_agrees_with_match(self):
+        """Test that or-ing contains over columns keeps the same rows as match"""
+        term_filter = TermFilter(["Vaccine", "spike-protein", "cases"])
+        is_match, _ = term_filter.match(self.df, ["title", "abstract"])
+        is_contained = term_filter.contains(self.df, "title") | term_filter.contains(self.df, "abstract")
+        self.assertListEqual(is_contained.tolist(), is_match.tolist())
+        self.assertListEqual(is_contained.tolist(), [False, True, True, False, False, False])
+
+
+if __name__ == "__main__":
+    unittest.main()
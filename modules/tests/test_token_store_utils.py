@@ -0,0 +1,82 @@
+"""Test code used to store tokenized papers"""
+import shutil
+import tempfile
+import unittest
+
+import nltk
+import pandas as pd
+
+from utils.token_store_utils import TokenStore
+
+
+class TestTokenStoreUtils(unittest.TestCase):
+    """Test code used to store tokenized papers"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.df = pd.DataFrame({
+            "cord_uid": ["a", "b", "c"],
+            "title": ["Remdesivir for COVID-19", "Masks reduce spread", None],
+            "abstract": ["We ran a trial. It worked!", None, "Short abstract."],
+            "text": ["Dr. Smith treated 20 patients. Results were good. See Fig. 2.", "", "One sentence"],
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_tokens_as_nltk(self):
+        """Test that stored sentences and tokens match tokenizing with nltk"""
+        store = TokenStore(self.directory)
+        self.assertEqual(store.add_docs(self.df, n_cores=2), 3)
+        store = TokenStore(self.directory)
+        for _, row in self.df.iterrows():
+            for field in ["title", "abstract", "text"]:
+                text = row[field] if isinstance(row[field], str) else ""
+                sentences = nltk.sent_tokenize(text)
+                self.assertListEqual(store.get_sentence_texts(row["cord_uid"], field, text), sentences)
+                self.assertListEqual(
+                    store.get_sentences(row["cord_uid"], field, row[field]),
+                    [nltk.word_tokenize(sentence) for sentence in sentences]
+                )
+
+    def test_only_changed_docs_are_tokenized(self):
+        """Test that docs are tokenized again only when their text changes"""
+        store = TokenStore(self.directory)
+        store.add_docs(self.df, n_cores=1)
+        self.assertEqual(store.add_docs(self.df, n_cores=1), 0)
+        df_changed = self.df.copy()
+        df_changed.loc[1, "text"] = "New text here."
+        self.assertEqual(store.add_docs(df_changed, n_cores=1), 1)
+        self.assertListEqual(store.get_sentences("b", "text", "New text here."), [["New", "text", "here", "."]])
+        self.assertListEqual(
+            store.get_sentences("a", "title", "Remdesivir for COVID-19"), [["Remdesivir", "for", "COVID-19"]])
+        self.assertIsNone(store.get_sentences("b", "text", ""))
+        self.assertIsNone(store.get_sentences("d", "title", "Remdesivir for COVID-19"))
+
+    def test_duplicate_cord_uids(self):
+        """Test that rows sharing a cord_uid keep their own tokens and aren't tokenized again"""
+        df_duplicated = pd.concat([self.df, self.df.iloc[[0]].assign(text="Another version.")])
+        store = TokenStore(self.directory)
+        self.assertEqual(store.add_docs(df_duplicated, n_cores=1), 4)
+        self.assertEqual(store.add_docs(df_duplicated, n_cores=1), 0)
+        self.assertListEqual(store.get_sentences("a", "text", "Another version."), [["Another", "version", "."]])
+        self.assertEqual(store.get_sentences("a", "text", self.df.loc[0, "text"])[0][0][:2], "Dr")
+
+    def test_replaced_docs_are_compacted(self):
+        """Test that replaced docs are dropped, and the arrays don't grow when texts keep changing"""
+        store = TokenStore(self.directory)
+        store.add_docs(self.df, n_cores=1)
+        n_sentences = len(store.sentences)
+        for i in range(5):
+            df_changed = self.df.copy()
+            df_changed.loc[0, "text"] = f"Version {i}. Dr. Smith treated 20 patients. Results were good."
+            store.add_docs(df_changed, n_cores=1)
+            self.assertIsNone(store.get_sentences("a", "text", self.df.loc[0, "text"]))
+            self.assertListEqual(store.get_sentences("c", "text", "One sentence"), [["One", "sentence"]])
+            self.assertEqual(
+                store.get_sentence_texts("a", "text", df_changed.loc[0, "text"])[0], f"Version {i}.")
+        self.assertLessEqual(len(store.sentences), 2 * (n_sentences + 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+"""Test code used to count topic terms"""
+import random
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils.topic_count_utils import TopicCounter, get_topic_lists, get_topic_prefixes
+
+TOPIC_REGEXES = [
+    "(diagno[a-z]*)|(test[a-z]*)|(detect[a-z]*)",
+    "(epidemio[a-z]*)|(model[a-z]*)",
+    "prevent[a-z]*",
+    "((transmi[a-z]*)|(spread[a-z]*))",
+    "((treat[a-z]*)|(drug[a-z]*))",
+    "(vacci[a-z]*)",
+]
+
+
+class TestTopicCountUtils(unittest.TestCase):
+    """Test code used to count topic terms"""
+
+    def test_topic_prefixes(self):
+        """Test that prefixes are only extracted from prefix-only regexes"""
+        self.assertListEqual(get_topic_prefixes(TOPIC_REGEXES[3]), ["transmi", "spread"])
+        self.assertListEqual(get_topic_prefixes(TOPIC_REGEXES[2]), ["prevent"])
+        self.assertIsNone(get_topic_prefixes("test[a-z]*ing"))
+        self.assertIsNone(get_topic_prefixes("(test[a-z]*model[a-z]*)"))
+
+    def test_same_counts_as_regex(self):
+        """Test that counts match counting each regex separately"""
+        random.seed(0)
+        words = ["test", "Testing", "contested", "detection", "diagnosis", "model-based", "epidemiology",
+                 "prevention", "transmits", "spread", "treat", "drugs", "vaccine", "testmodel", "covid-19",
+                 "vaccinés", "the", "of", "(treatment)", "spreadtest"]
+        texts = [" ".join(random.choices(words, k=random.randint(0, 50))) for _ in range(100)]
+        fields = [pd.Series(texts).str.lower(), pd.Series(texts[::-1] + [np.nan]).iloc[1:].str.lower()]
+        regexes = TOPIC_REGEXES + ["(?:ed|ing)\\b"]
+        counts = TopicCounter(regexes).count_matrix(fields)
+        self.assertEqual(counts.shape, (100, len(regexes), 2))
+        for i, regex in enumerate(regexes):
+            for j, texts in enumerate(fields):
+                expected = texts.str.count(regex).fillna(0).astype(int).tolist()
+                self.assertListEqual(counts[:, i, j].tolist(), expected)
+
+    def test_topic_lists(self):
+        """Test that topic lists follow the order of the topic names"""
+        is_topic = np.array([[True, False, True], [False, False, False]])
+        self.assertListEqual(get_topic_lists(is_topic, ["a", "b", "c"]), [["a", "c"], []])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Test code used to evaluate topics"""
+import os
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from scipy.spatial.distance import cdist
+
+from utils.topic_evaluation_utils import (
+    get_average_pairwise_distance, get_topic_cohesion, get_topic_precision_recall, load_topic_labels)
+
+EVAL_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "evaluation_data", "topic_modeling_eval.csv")
+
+
+class TestTopicEvaluationUtils(unittest.TestCase):
+    """Test code used to evaluate topics"""
+
+    def test_load_topic_labels(self):
+        """Test that labels are parsed into sets, with unlabelled papers having no topics"""
+        labelled = load_topic_labels(EVAL_PATH)
+        self.assertSetEqual(labelled["qfj1my37"], {"treatment", "prevention", "epidemiology"})
+        self.assertSetEqual(labelled["zxvim4t8"], set())
+
+    def test_precision_recall(self):
+        """Test per-topic precision and recall"""
+        labelled = pd.Series([{"a"}, {"a", "b"}, set()], index=["p1", "p2", "p3"])
+        predicted = pd.Series([["a"], ["b"], ["a"], ["a"]], index=["p1", "p2", "p3", "unlabelled"])
+        scores = get_topic_precision_recall(predicted, labelled, ["a", "b", "c"])
+        self.assertEqual(scores.loc["a", "precision"], 0.5)
+        self.assertEqual(scores.loc["a", "recall"], 0.5)
+        self.assertEqual(scores.loc["b", "precision"], 1)
+        self.assertTrue(np.isnan(scores.loc["c", "recall"]))
+
+    def test_cohesion_is_exact(self):
+        """Test that cohesion matches brute-force cosine distances"""
+        rng = np.random.RandomState(0)
+        embeddings = rng.normal(size=(60, 8)).astype(np.float32)
+        embeddings[5] = 0
+        rows = rng.permutation(60)[:40]
+        groups = pd.DataFrame({"a": rng.rand(40) > 0.5, "all": True})
+        cohesion = get_topic_cohesion(embeddings, groups, rows=rows, chunk_rows=7)
+        for group in groups.columns:
+            group_embeddings = embeddings[rows[groups[group].to_numpy()]]
+            group_embeddings = group_embeddings[np.linalg.norm(group_embeddings, axis=1) > 0]
+            distances = cdist(group_embeddings, group_embeddings, "cosine")
+            centroid = group_embeddings / np.linalg.norm(group_embeddings, axis=1, keepdims=True)
+            centroid = centroid.mean(axis=0, keepdims=True)
+            self.assertEqual(cohesion.loc[group, "n_docs"], len(group_embeddings))
+            self.assertAlmostEqual(cohesion.loc[group, "pairwise_distance"], distances.mean(), places=5)
+            self.assertAlmostEqual(
+                cohesion.loc[group, "centroid_spread"],
+                cdist(group_embeddings, centroid, "cosine").mean(), places=5)
+        self.assertAlmostEqual(
+            get_average_pairwise_distance(embeddings=embeddings[rows]), cohesion.loc["all", "pairwise_distance"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Test code used to add topics to papers"""
+import os
+import re
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+try:
+    import topic_modeling
+except ImportError:
+    topic_modeling = None
+
+from utils.trie_utils import build_trie_regex
+
+DRUG_NAMES = ["remdesivir", "hydroxychloroquine"]
+
+
+def get_expected_topics(df, drug_names):
+    """Get the topics of each paper by counting each topic's regex in each field"""
+    expected = {}
+    for topic, params in topic_modeling.TOPICS_V4b.items():
+        regexes = [params["regex"]] + ([re.escape(name) for name in drug_names] if topic == "treatment" else [])
+        weighted_counts = np.zeros(len(df))
+        for col, weight in topic_modeling.TOPIC_FIELDS.items():
+            texts = df[col].fillna("").str.lower()
+            weighted_counts += weight * np.array(
+                [sum(len(re.findall(regex, text)) for regex in regexes) for text in texts])
+        expected[topic] = weighted_counts >= params["min_count"]
+    return expected
+
+
+@unittest.skipIf(topic_modeling is None, "topic_modeling has missing dependencies")
+class TestTopicModeling(unittest.TestCase):
+    """Test code used to add topics to papers"""
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            "cord_uid": ["a", "b", "c", "d"],
+            "title": ["Treating COVID-19 with Remdesivir", "Vaccine trial", None, "Spread of SARS-CoV-2"],
+            "abstract": [
+                "Treatment with remdesivir and hydroxychloroquine.", "A vaccine. Vaccination " * 3,
+                "Testing and detection.", None,
+            ],
+            "text": [
+                "The drug was given. " * 4, "vaccines " * 5, "Diagnostic tests detect infection. " * 8,
+                "Transmission and spreading. " * 8,
+            ],
+        })
+
+    def test_add_topics(self):
+        """Test that topics come from the weighted counts of each topic in each field"""
+        df = topic_modeling.add_topics(self.df.copy(), drug_re=build_trie_regex(DRUG_NAMES))
+        expected = get_expected_topics(self.df, DRUG_NAMES)
+        for topic, is_topic in expected.items():
+            self.assertListEqual(df[f"topic_{topic}"].tolist(), is_topic.tolist(), topic)
+        self.assertListEqual(df["topics"].tolist(), [
+            [topic for topic in topic_modeling.TOPICS_V4b if expected[topic][i]] for i in range(len(df))
+        ])
+        self.assertListEqual(df["topics"].tolist(), [["treatment"], ["vaccine"], ["diagnosis"], ["transmission"]])
+
+    def test_get_drug_regex(self):
+        """Test that drug names and their aliases match lowercased text in any case"""
+        hits = [{"_source": {"name": "Remdesivir, Favipiravir", "aliases": ["GS-5734", "Veklury"]}},
+                {"_source": {"name": "unnamed", "aliases": []}}]
+        with mock.patch.object(topic_modeling, "Elasticsearch") as es:
+            es.return_value.search.return_value = {"hits": {"hits": hits}}
+            drug_re = re.compile(topic_modeling.get_drug_regex())
+        text = "Remdesivir (GS-5734, sold as Veklury) and favipiravir. Unnamed drugs."
+        self.assertListEqual(
+            sorted(drug_re.findall(text.lower())), ["favipiravir", "gs-5734", "remdesivir", "veklury"])
+
+    def test_save_clinical_paper_paths(self):
+        """Test that published results given as ", "-joined strings give paths that match their papers"""
+        published_results = [
+            "https://www.nejm.org/doi/full/10.1056/NEJMoa2007764, https://doi.org/10.1016/S0140-6736(20)31022-9",
+            None,
+            "https://www.thelancet.com/journals/lancet/article/PIIS0140-6736(20)31042-4/fulltext",
+        ]
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(topic_modeling, "DATA_DIR", directory):
+            paths = topic_modeling.save_clinical_paper_paths(published_results)
+            self.assertTrue(os.path.exists(os.path.join(directory, topic_modeling.CLINICAL_PATHS_PATH)))
+            self.assertIn("nejmoa2007764", paths)
+            self.assertGreaterEqual(len(paths), 2)
+            df = pd.DataFrame({"url": ["https://www.nejm.org/doi/10.1056/NEJMoa2007764", "https://example.org/x"]})
+            topic_modeling.add_is_clinical(df)
+        self.assertListEqual(df["is_clinical_paper"].tolist(), [True, False])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+"""Test code used to match many literal strings at once"""
+import random
+import re
+import unittest
+
+from utils.trie_utils import build_trie_regex
+
+
+class TestTrieUtils(unittest.TestCase):
+    """Test code used to match many literal strings at once"""
+
+    def test_longest_word_wins(self):
+        """Test that the longest word starting at a position is matched"""
+        pattern = build_trie_regex(["ab", "abcd", "a"])
+        self.assertListEqual(re.findall(pattern, "abc abcd ax"), ["ab", "abcd", "a"])
+
+    def test_special_characters_are_literal(self):
+        """Test that regex characters in words are matched literally"""
+        pattern = build_trie_regex(["interferon-beta", "il-6 (tocilizumab)", "1.5"])
+        self.assertListEqual(
+            re.findall(pattern, "interferon-beta and il-6 (tocilizumab), 1.5 not 125"),
+            ["interferon-beta", "il-6 (tocilizumab)", "1.5"]
+        )
+
+    def test_no_words(self):
+        """Test that an empty word list matches nothing"""
+        self.assertIsNone(re.search(build_trie_regex([]), "anything"))
+
+    def test_same_counts_as_alternation(self):
+        """Test that counts match the alternation regex used before"""
+        random.seed(0)
+        letters = "abcdeiv"
+        words = list({"".join(random.choices(letters, k=random.randint(3, 8))) for _ in range(500)})
+        # the old regex tried words in list order, so put longer words first to compare
+        alternation = "(" + ")|(".join(sorted(words, key=len, reverse=True)) + ")"
+        trie = build_trie_regex(words)
+        for _ in range(50):
+            text = " ".join("".join(random.choices(letters, k=random.randint(1, 10))) for _ in range(200))
+            self.assertEqual(len(re.findall(trie, text)), len(re.findall(alternation, text)))
+
+
+if __name__ == "__main__":
+    unittest.main()
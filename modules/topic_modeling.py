@@ -3,18 +3,25 @@ import os
 import pickle
 import re
 import string
+from functools import partial
 from urllib.parse import urlparse
 
 import gensim
-import nltk
 import numpy as np
 import pandas as pd
 from elasticsearch import Elasticsearch
 from gensim.models.phrases import Phrases, Phraser
 from nltk.corpus import stopwords
-from sklearn.feature_extraction.text import TfidfVectorizer
 
+from utils.centroid_utils import fit_centroid_classifier, predict_labels
 from utils.constants import *
+from utils.embedding_utils import load_embedding_matrix
+from utils.instrumentation_utils import track_stage
+from utils.keyword_utils import KeywordModel, get_top_keywords
+from utils.parallel_utils import map_row_blocks, parallelize_dataframe
+from utils.token_store_utils import TOKEN_FIELDS, TokenStore
+from utils.topic_count_utils import TopicCounter, get_topic_lists
+from utils.trie_utils import build_trie_regex
 
 TOPICS = {
     "diagnosis": {"regex": "(diagno[a-z]*)|(test[a-z]*)", "min_count": 20},
@@ -34,24 +41,52 @@ TOPICS_V4b = {
     "vaccine": {"regex": "(vacci[a-z]*)", "min_count": 10}
 }
 
+TOPIC_CLASSIFIER_PATH = "topic_classifier.pkl"
+KEYWORD_MODEL_PATH = "keyword_model.pkl"
+# number of hashed columns of the keyword model, which caps its memory. None keeps every word
+KEYWORD_HASH_FEATURES = None
+
+# weight of a topic match in each field
+TOPIC_FIELDS = {"title": 5, "abstract": 3, "text": 1}
+
 
 def _get_drug_names():
-    """Get a list of drug names"""
+    """Get a list of drug names and their drugbank aliases"""
     es = Elasticsearch(ES_URL)
     def flatten(l): return [item for sublist in l for item in sublist]
-    drug_names = [x["_source"]["name"].split(", ") for x in es.search(
+    drug_names = [x["_source"]["name"].split(", ") + list(x["_source"].get("aliases") or []) for x in es.search(
         index=TREATMENT_ES_INDEX, size=300)["hits"]["hits"] if x["_source"]["name"] != "unnamed"]
     return list(set(flatten(drug_names)))
 
 flatten = lambda l: [item for sublist in l for item in sublist]
 
-def _get_clinical_paper_ids():
-    es = Elasticsearch(ES_URL)
-    res = es.search(index=TREATMENT_ES_INDEX, size=300)
-    paper_urls = [drug["_source"]["published_results"] for drug in res["hits"]["hits"]]
-    paper_urls = flatten(paper_urls)
-    url_re = re.compile(r"(?i)\b((?:https?:(?:/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)/)(?:[^\s()<>{}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{};:'.,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\b/?(?!@)))")
-    paper_urls_extracted = [url_re.findall(url) for url in paper_urls]
+URL_RE = re.compile(r"(?i)\b((?:https?:(?:/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)/)(?:[^\s()<>{}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{};:'.,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\b/?(?!@)))")
+# cleaned paths of published trial results, saved with the treatment data
+CLINICAL_PATHS_PATH = "clinical_paper_paths.pkl"
+
+
+def _get_clinical_paper_ids(paper_urls=None):
+    """Get the cleaned paths of published trial results
+
+    Parameters
+    ----------
+    paper_urls: list[str]
+        published results of each treatment, as urls or ", "-joined strings of
+        urls. Fetched from the treatment index if None.
+
+    Returns
+    -------
+    list[str]
+        cleaned paths, matched against the cleaned paths of paper urls
+
+    """
+    if paper_urls is None:
+        es = Elasticsearch(ES_URL)
+        res = es.search(index=TREATMENT_ES_INDEX, size=300)
+        paper_urls = [drug["_source"]["published_results"] for drug in res["hits"]["hits"]]
+        paper_urls = flatten(paper_urls)
+    paper_urls = flatten([urls.split(", ") for urls in paper_urls if isinstance(urls, str)])
+    paper_urls_extracted = [URL_RE.findall(url) for url in paper_urls]
     paper_urls_extracted = set(flatten(paper_urls_extracted))
     paper_paths = [urlparse(url).path.lower() for url in paper_urls_extracted]
     paper_paths = [path for path in paper_paths if len(path.split("-")) < 5] # remove non-research links
@@ -66,16 +101,71 @@ def _get_clinical_paper_ids():
         return leading_pii.sub("", leading_2020.sub("", leading_slash.sub("", path)))
     paper_paths_clean = [_clean_path(path) for path in paper_paths_clean]
     paper_paths_clean = [path for path in paper_paths_clean if len(path) > 8]
+    return sorted(set(paper_paths_clean))
+
+
+def save_clinical_paper_paths(paper_urls=None):
+    """Save the cleaned paths of published trial results
+
+    Parameters
+    ----------
+    paper_urls: list[str]
+        published results of each treatment, as urls or ", "-joined strings of
+        urls. Fetched from the treatment index if None.
+
+    Returns
+    -------
+    list[str]
+        the saved paths
+
+    """
+    paper_paths_clean = _get_clinical_paper_ids(paper_urls)
+    with open(os.path.join(DATA_DIR, CLINICAL_PATHS_PATH), "wb") as f:
+        pickle.dump(paper_paths_clean, f)
+    logging.info(f"Saved {len(paper_paths_clean)} clinical paper paths")
     return paper_paths_clean
 
-def _is_clinical_paper(urls, paper_paths_clean):
-    """Returns whether paper is a clinical paper"""
-    for url in urls:
-        path = urlparse(url).path.lower().replace(".","").replace(")", "").replace("(", "").replace("-", "")
-        for paper_path in paper_paths_clean:
-            if paper_path in path:
-                return True
-    return False
+
+def get_clinical_matcher():
+    """Get a regex that finds any published trial result in a cleaned url path
+
+    Uses the paths saved with the treatment data, or fetches and saves them if
+    there are none yet. The paths are merged into one trie-structured regex, so
+    matching a url costs about the same no matter how many trial results there are.
+
+    Returns
+    -------
+    Pattern
+        compiled regex to search cleaned url paths with
+
+    """
+    path = os.path.join(DATA_DIR, CLINICAL_PATHS_PATH)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            paper_paths_clean = pickle.load(f)
+    else:
+        paper_paths_clean = save_clinical_paper_paths()
+    return re.compile(build_trie_regex(paper_paths_clean))
+
+
+def _get_clean_url_paths(urls):
+    """Get the cleaned path of each url of each paper
+
+    Parameters
+    ----------
+    urls: Series
+        urls of each paper, separated by "; "
+
+    Returns
+    -------
+    Series
+        cleaned paths, one row per url, indexed by the position of the paper
+
+    """
+    urls = urls.reset_index(drop=True).fillna("").str.split("; ").explode()
+    paths = urls.map(lambda url: urlparse(url).path)
+    return paths.str.lower().str.replace(r"[.()\-]", "", regex=True)
+
 
 def _get_topic_list(row):
     row_topics = []
@@ -85,7 +175,29 @@ def _get_topic_list(row):
     return row_topics
 
 
-def add_topics(df):
+def get_drug_regex(drug_names=None):
+    """Get a regex that matches any of the drug names in lowercased text
+
+    Parameters
+    ----------
+    drug_names: list[str]
+        drug names to match, in any case. Fetched from the treatment index,
+        along with their aliases, if None.
+
+    Returns
+    -------
+    str
+        a trie-structured regex, which counts drug mentions in a single pass
+        no matter how many drug names there are
+
+    """
+    if drug_names is None:
+        drug_names = _get_drug_names()
+    # fields are lowercased before they're matched
+    return build_trie_regex(sorted({name.lower() for name in drug_names}))
+
+
+def add_topics(df, drug_re=None):
     """Add topics to the given dataframe
 
     Performs the addition in-place
@@ -94,30 +206,103 @@ def add_topics(df):
     ----------
     df: DataFrame
         source dataframe to add topics to
+    drug_re: str
+        regex for drug names, from get_drug_regex. Built if None.
 
     """
-    # get drug names for treatments
-    drug_names = _get_drug_names()
-    drug_names = [x.replace("(", "\(").replace(")", "\)").replace(
-        "-", "\-") for x in drug_names]
-    drug_re = "(" + ")|(".join(drug_names) + ")"
-    for topic, params in TOPICS_V4b.items():
-        title_counts = df["title"].str.lower().str.count(
-            params["regex"]).fillna(0)
-        abstract_counts = df["abstract"].str.lower(
-        ).str.count(params["regex"]).fillna(0)
-        text_counts = df["text"].str.lower().str.count(
-            params["regex"]).fillna(0)
-        topic_counts = 5 * title_counts + 3 * abstract_counts + text_counts
-        # special case to look for drugs. This might take a very long time
-        if topic == "treatment":
-            title_counts = df["title"].str.lower().str.count(drug_re).fillna(0)
-            abstract_counts = df["abstract"].str.lower(
-            ).str.count(drug_re).fillna(0)
-            text_counts = df["text"].str.lower().str.count(drug_re).fillna(0)
-            topic_counts += 5 * title_counts + 3 * abstract_counts + text_counts
-        df[f"topic_{topic}"] = topic_counts >= params["min_count"]
-    df["topics"] = df.apply(_get_topic_list, axis=1)
+    if drug_re is None:
+        drug_re = get_drug_regex()
+    topic_names = list(TOPICS_V4b.keys())
+    counter = TopicCounter([params["regex"] for params in TOPICS_V4b.values()])
+    drug_counter = re.compile(drug_re)
+
+    # lowercase each field once and count every topic in a single pass over it
+    fields = [df[col].str.lower() for col in TOPIC_FIELDS]
+    counts = counter.count_matrix(fields)
+    # special case to look for drugs
+    treatment = topic_names.index("treatment")
+    for j, texts in enumerate(fields):
+        counts[:, treatment, j] += [
+            len(drug_counter.findall(text)) if isinstance(text, str) else 0 for text in texts]
+
+    weighted_counts = counts @ np.array(list(TOPIC_FIELDS.values()))
+    min_counts = np.array([params["min_count"] for params in TOPICS_V4b.values()])
+    is_topic = weighted_counts >= min_counts
+    for i, topic in enumerate(topic_names):
+        df[f"topic_{topic}"] = is_topic[:, i]
+    df["topics"] = get_topic_lists(is_topic, topic_names)
+    return df
+
+
+def _get_paper_embeddings(df, embeddings=None, cord_uid_to_row=None):
+    """Get which papers have embeddings, and the embeddings of those that do"""
+    if embeddings is None or cord_uid_to_row is None:
+        embeddings, cord_uid_to_row = load_embedding_matrix()
+    rows = df["cord_uid"].map(cord_uid_to_row)
+    has_embedding = rows.notnull().to_numpy()
+    return has_embedding, embeddings[rows[has_embedding].astype(int).to_numpy()]
+
+
+def fit_topic_classifier(df, embeddings=None, cord_uid_to_row=None):
+    """Fit a nearest-centroid topic classifier on embeddings, seeded from regex topics
+
+    Saves the classifier to TOPIC_CLASSIFIER_PATH.
+
+    Parameters
+    ----------
+    df: DataFrame
+        papers with topic columns from add_topics
+    embeddings: ndarray
+        embedding matrix. Loaded from disk if None.
+    cord_uid_to_row: dict
+        map of cord_uid to row in the matrix. Loaded from disk if None.
+
+    Returns
+    -------
+    dict
+        the classifier, see utils.centroid_utils
+
+    """
+    topics = list(TOPICS_V4b.keys())
+    has_embedding, paper_embeddings = _get_paper_embeddings(df, embeddings, cord_uid_to_row)
+    labels = df.loc[has_embedding, [f"topic_{topic}" for topic in topics]].to_numpy(dtype=bool)
+    classifier = fit_centroid_classifier(paper_embeddings, labels)
+    classifier["topics"] = topics
+    with open(os.path.join(DATA_DIR, TOPIC_CLASSIFIER_PATH), "wb") as f:
+        pickle.dump(classifier, f)
+    logging.info(f"Fit topic classifier on {has_embedding.sum()} papers")
+    return classifier
+
+
+def add_topics_from_embeddings(df, classifier=None, embeddings=None, cord_uid_to_row=None):
+    """Add topics to the given dataframe from paper embeddings instead of text
+
+    This needs no text, so it also labels metadata-only papers, and scores
+    the whole corpus with one matrix product. Papers without embeddings get no
+    topics. Performs the addition in-place
+
+    Parameters
+    ----------
+    df: DataFrame
+        source dataframe to add topics to
+    classifier: dict
+        classifier from fit_topic_classifier. Loaded from TOPIC_CLASSIFIER_PATH if None.
+    embeddings: ndarray
+        embedding matrix. Loaded from disk if None.
+    cord_uid_to_row: dict
+        map of cord_uid to row in the matrix. Loaded from disk if None.
+
+    """
+    if classifier is None:
+        with open(os.path.join(DATA_DIR, TOPIC_CLASSIFIER_PATH), "rb") as f:
+            classifier = pickle.load(f)
+    topics = classifier["topics"]
+    has_embedding, paper_embeddings = _get_paper_embeddings(df, embeddings, cord_uid_to_row)
+    is_topic = np.zeros((len(df), len(topics)), dtype=bool)
+    is_topic[has_embedding] = predict_labels(classifier, paper_embeddings)
+    for i, topic in enumerate(topics):
+        df[f"topic_{topic}"] = is_topic[:, i]
+    df["topics"] = get_topic_lists(is_topic, topics)
     return df
 
 
@@ -138,12 +323,27 @@ def add_topics_v1(df):
     df["topics"] = df.apply(_get_topic_list, axis=1)
 
 
-def add_is_clinical(df):
-    """Add column to indicate whether a paper is a clinical result"""
-    df["is_clinical_paper"] = df.url.str.split("; ").apply(_is_clinical_paper, paper_paths_clean=_get_clinical_paper_ids())
-    
-    
-def add_keywords(df):
+def add_is_clinical(df, matcher=None):
+    """Add column to indicate whether a paper is a clinical result
+
+    Performs the addition in-place
+
+    Parameters
+    ----------
+    df: DataFrame
+        source dataframe to add the column to
+    matcher: Pattern
+        matcher from get_clinical_matcher. Built if None.
+
+    """
+    if matcher is None:
+        matcher = get_clinical_matcher()
+    is_clinical = _get_clean_url_paths(df["url"]).str.contains(matcher).fillna(False)
+    df["is_clinical_paper"] = is_clinical.groupby(level=0).any().reindex(
+        range(len(df)), fill_value=False).to_numpy()
+
+
+def add_keywords(df, incremental=False):
     """Add topics to the given dataframe
 
     Performs the addition in-place
@@ -152,15 +352,24 @@ def add_keywords(df):
     ----------
     df: DataFrame
         source dataframe to add topics to
+    incremental: bool
+        whether df only holds new or changed papers. If so, their vocabulary is
+        added to the existing phraser and the keywords are merged into the
+        existing keywords.
 
     """
-    retrain_phraser(df)
-    extract_keywords(df)
+    store = TokenStore()
+    with track_stage("keywords.phraser", rows_in=len(df)) as stats:
+        retrain_phraser(df, update=incremental, store=store)
+        stats.add_count("docs", len(df))
+    with track_stage("keywords.extract", rows_in=len(df)) as stats:
+        extract_keywords(df, update=incremental, store=store)
+        stats.add_count("docs", len(df))
 
     ID_TO_KEYWORD_PATH = "cord_uid_to_keywords.pkl"
     with open(os.path.join(DATA_DIR, ID_TO_KEYWORD_PATH), "rb") as f:
         cord_uid_to_top_keywords = pickle.load(f)
-    print("Keyword counts", len(cord_uid_to_top_keywords), len(df))
+    logging.info(f"Keyword counts {len(cord_uid_to_top_keywords)} {len(df)}")
     # assert(len(cord_uid_to_top_keywords) >= len(df))
     df["top_keywords"] = df["cord_uid"].map(
         cord_uid_to_top_keywords).fillna("")
@@ -170,69 +379,114 @@ def add_keywords(df):
         lambda l: [x.replace("_", " ") for x in l])
 
 
-def retrain_phraser(df):
+def iter_tokenized_sentences(df, store=None):
+    """Iterate over the lowercased, tokenized sentences of the papers
+
+    Tokens are read from the token store. Papers that aren't stored yet are
+    tokenized by a pool of workers first, and only one sentence is held in
+    memory at a time while iterating.
+
+    Parameters
+    ----------
+    df: DataFrame
+        papers with cord_uid, title, abstract and text columns
+    store: TokenStore
+        store to read tokens from. Defaults to the store in DATA_DIR.
+
+    Yields
+    ------
+    list[str]
+        tokens of a sentence, without punctuation
+
+    """
+    store = store or TokenStore()
+    store.add_docs(df)
+    lower_vocab = np.array([word.lower() for word in store.vocab], dtype=object)
+    punctuation = set(string.punctuation)
+    is_word = np.array([word not in punctuation for word in store.vocab], dtype=bool)
+    for cord_uid, *texts in zip(df["cord_uid"], *[df[field] for field in TOKEN_FIELDS]):
+        for field, text in zip(TOKEN_FIELDS, texts):
+            for token_ids in store.get_token_ids(cord_uid, field, text):
+                yield lower_vocab[token_ids[is_word[token_ids]]].tolist()
+
+
+def retrain_phraser(df, update=False, store=None):
     """Retrain phrase generator
 
     Parameters
     ----------
     df: DataFrame
         source dataframe to add topics to
+    update: bool
+        whether to add the vocabulary of df to the existing phraser instead of
+        training a new one. Used to refresh the phraser with new papers only.
+    store: TokenStore
+        store to read tokens from. Defaults to the store in DATA_DIR.
 
     """
-    all_sentences = []
-    for cord_id, row in df.iterrows():
-        title = row["title"]
-        abstract = row["abstract"]
-        full_text = row["text"]
-
-        # tokenize doc to sentences
-        for text in [title, abstract, full_text]:
-            if type(text) is str:
-                all_sentences += nltk.sent_tokenize(text)
-    logging.info("Obtained all sentences")
-
-    tokenized_sentences = []
-    for sentence in all_sentences:
-        tokenized_sentences.append([word.lower() for word in nltk.word_tokenize(
-            sentence) if word not in set(string.punctuation)])
-    logging.info("Tokenized sentences")
-
-    phrases = Phrases(tokenized_sentences, min_count=5,
-                      threshold=10, common_terms=set(stopwords.words("english")))
-    logging.info("Trained phraser")
-    with open(os.path.join(DATA_DIR, "phraser.pkl"), "wb") as f:
+    phraser_path = os.path.join(DATA_DIR, "phraser.pkl")
+    sentences = iter_tokenized_sentences(df, store)
+    if update and os.path.exists(phraser_path):
+        with open(phraser_path, "rb") as f:
+            phrases = pickle.load(f)
+        phrases.add_vocab(sentences)
+        logging.info("Updated phraser")
+    else:
+        phrases = Phrases(sentences, min_count=5,
+                          threshold=10, common_terms=set(stopwords.words("english")))
+        logging.info("Trained phraser")
+    with open(phraser_path, "wb") as f:
         pickle.dump(phrases, f)
 
 
-def extract_keywords(df):
-    """Extract keywords from the dataframe"""
+def _add_preprocessed_docs(df, phrases, store, vocab):
+    """Add the tokenized, phrased title, abstract and text of each paper"""
+    preprocessed_docs = []
+    for cord_uid, *texts in zip(df["cord_uid"], *[df[field] for field in TOKEN_FIELDS]):
+        preprocessed_doc = []
+        for field, text in zip(TOKEN_FIELDS, texts):
+            for token_ids in store.get_token_ids(cord_uid, field, text):
+                preprocessed_doc += phrases[vocab[token_ids].tolist()]
+        preprocessed_docs.append(" ".join(preprocessed_doc))
+    df["preprocessed_doc"] = preprocessed_docs
+    return df
+
+
+def extract_keywords(df, update=False, store=None):
+    """Extract keywords from the dataframe
+
+    If update is set, df only holds new or changed papers. Their terms are
+    added to the saved document frequencies, and their keywords are merged into
+    the existing keywords instead of replacing them. Tokens are read from
+    store, which defaults to the token store in DATA_DIR.
+    """
     num_keywords = 20
     with open(os.path.join(DATA_DIR, "phraser.pkl"), "rb") as f:
         phrases = pickle.load(f)
 
-    preprocessed_docs = []
-    for cord_id, row in df.iterrows():
-        title = "" if pd.isnull(row["title"]) else row["title"]
-        abstract = "" if pd.isnull(row["abstract"]) else row["abstract"]
-        full_text = "" if pd.isnull(row["text"]) else row["text"]
-
-        text = title + " " + abstract + " " + full_text
-
-        # tokenize doc to sentences
-        preprocessed_doc = []
-        text = text.replace("-", "_")
-        for sentence in nltk.sent_tokenize(text):
-            tokens = phrases[[word.lower()
-                              for word in nltk.word_tokenize(sentence)]]
-            preprocessed_doc += tokens
-        preprocessed_docs.append(" ".join(preprocessed_doc))
+    store = store or TokenStore()
+    store.add_docs(df)
+    store.load()
+    # hyphens become underscores so that hyphenated words stay one keyword
+    keyword_vocab = np.array([word.lower().replace("-", "_") for word in store.vocab], dtype=object)
+    df_docs = parallelize_dataframe(
+        df[["cord_uid", "title", "abstract", "text"]],
+        partial(_add_preprocessed_docs, phrases=phrases, store=store, vocab=keyword_vocab)
+    )
+    preprocessed_docs = df_docs["preprocessed_doc"].tolist()
+    del df_docs
     logging.info("Got preprocessed docs")
 
-    vectorizer = TfidfVectorizer(ngram_range=(1, 1))
-    X = vectorizer.fit_transform(preprocessed_docs)
-
-    with open(os.path.join(DATA_DIR, "keywords_intermediate.pkl"), "wb") as f:
-        pickle.dump({"sparse_results": X, "tfidf_vectorizer": vectorizer}, f)
+    # update the document frequencies with these docs only, or start over on a full run
+    model_path = os.path.join(DATA_DIR, KEYWORD_MODEL_PATH)
+    if update and os.path.exists(model_path):
+        with open(model_path, "rb") as f:
+            model = pickle.load(f)
+    else:
+        model = KeywordModel(n_features=KEYWORD_HASH_FEATURES)
+    model.update(df["cord_uid"].tolist(), preprocessed_docs)
+    with open(model_path, "wb") as f:
+        pickle.dump(model, f)
 
     bad_words = ["covid", "cov", "sars", "mers", "coronavirus", "et_al", "table", "authors", "author",
                  "appendix", "data", "june", "posted", "license", "version", "preprint", "medrxiv", "review",
@@ -256,23 +510,26 @@ def extract_keywords(df):
             len(word) > 3
         )
 
-    top_keywords = pd.Series([], dtype=str)
-    for start_index in range(0, X.shape[0], 1000):
-        logging.info(f"Extracting keywords {start_index} of {X.shape[0]}")
-        end_index = start_index + 1000
-        if end_index > X.shape[0]:
-            X_subset = X.tocsr()[start_index:, ].todense()
-        else:
-            X_subset = X.tocsr()[start_index:end_index, ].todense()
-        df_scores = pd.DataFrame(
-            X_subset, columns=vectorizer.get_feature_names())
-        df_scores = df_scores[filter(keep_word, df_scores.columns)]
-        top_keywords = top_keywords.append(df_scores.apply(lambda x: list(
-            x.sort_values(ascending=False).index[:num_keywords]), axis=1))
+    # the vocabulary is filtered once, and keywords come straight from the nonzeros of each row
+    feature_names = model.feature_names
+    keep_mask = np.array([word is not None and keep_word(word) for word in feature_names], dtype=bool)
+    logging.info(f"Extracting keywords from {len(preprocessed_docs)} of {model.n_docs} docs, "
+                 f"{keep_mask.sum()} of {len(feature_names)} words")
+
+    def get_block_keywords(start, end):
+        return get_top_keywords(
+            model.transform(preprocessed_docs[start:end]), feature_names, keep_mask, num_keywords)
+    top_keywords = map_row_blocks(get_block_keywords, len(preprocessed_docs))
 
     df3 = df[["cord_uid"]].reset_index(drop=True)
-    df3["top_keywords"] = top_keywords.reset_index(drop=True)
+    df3["top_keywords"] = top_keywords
     cord_uid_to_top_keywords = df3[["cord_uid", "top_keywords"]].set_index(
         "cord_uid").to_dict()["top_keywords"]
-    with open(os.path.join(DATA_DIR, "cord_uid_to_keywords.pkl"), "wb") as f:
+    keywords_path = os.path.join(DATA_DIR, "cord_uid_to_keywords.pkl")
+    if update and os.path.exists(keywords_path):
+        with open(keywords_path, "rb") as f:
+            existing_keywords = pickle.load(f)
+        existing_keywords.update(cord_uid_to_top_keywords)
+        cord_uid_to_top_keywords = existing_keywords
+    with open(keywords_path, "wb") as f:
         pickle.dump(cord_uid_to_top_keywords, f)
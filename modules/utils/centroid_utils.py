@@ -0,0 +1,98 @@
+"""Utilities for classifying papers by the nearest centroid of their embeddings"""
+import numpy as np
+
+
+def normalize_rows(embeddings):
+    """L2-normalize each row. All-zero rows stay zero"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return np.divide(embeddings, norms, out=np.zeros_like(embeddings), where=norms > 0)
+
+
+def fit_centroid_classifier(embeddings, labels, chunk_rows=100000):
+    """Fit a nearest-centroid classifier for each label
+
+    For each label, papers are scored by their cosine similarity to the
+    centroid of the papers with the label minus that to the centroid of the
+    papers without it. All labels are scored with one matrix product. The
+    threshold is set so that the classifier labels the same share of the
+    seed papers as the seed labels do.
+
+    Parameters
+    ----------
+    embeddings: ndarray
+        (n_docs x n_dims) embeddings of the seed papers
+    labels: ndarray
+        (n_docs x n_labels) boolean seed labels, e.g. from regex topics
+    chunk_rows: int
+        number of rows to normalize at a time
+
+    Returns
+    -------
+    dict
+        the classifier, with (n_dims x n_labels) weights and n_labels thresholds
+
+    """
+    labels = np.asarray(labels, dtype=np.float32)
+    positive_sums = np.zeros((labels.shape[1], embeddings.shape[1]), dtype=np.float64)
+    totals = np.zeros(embeddings.shape[1], dtype=np.float64)
+    for start in range(0, len(embeddings), chunk_rows):
+        unit_vectors = normalize_rows(embeddings[start:start + chunk_rows])
+        positive_sums += labels[start:start + chunk_rows].T @ unit_vectors
+        totals += unit_vectors.sum(axis=0)
+    negative_sums = totals[None, :] - positive_sums
+    weights = (normalize_rows(positive_sums) - normalize_rows(negative_sums)).T
+
+    scores = predict_scores({"weights": weights}, embeddings, chunk_rows)
+    prevalence = labels.mean(axis=0)
+    thresholds = np.array([
+        np.inf if share == 0 else np.quantile(scores[:, i], 1 - share)
+        for i, share in enumerate(prevalence)
+    ], dtype=np.float32)
+    return {"weights": weights.astype(np.float32), "thresholds": thresholds}
+
+
+def predict_scores(classifier, embeddings, chunk_rows=100000):
+    """Score papers with a classifier from fit_centroid_classifier
+
+    Parameters
+    ----------
+    classifier: dict
+        the classifier
+    embeddings: ndarray
+        (n_docs x n_dims) embeddings of the papers to score
+    chunk_rows: int
+        number of rows to normalize at a time
+
+    Returns
+    -------
+    ndarray
+        (n_docs x n_labels) scores. Higher means more likely to have the label.
+
+    """
+    weights = np.asarray(classifier["weights"], dtype=np.float32)
+    scores = np.zeros((len(embeddings), weights.shape[1]), dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_rows):
+        scores[start:start + chunk_rows] = normalize_rows(embeddings[start:start + chunk_rows]) @ weights
+    return scores
+
+
+def predict_labels(classifier, embeddings, chunk_rows=100000):
+    """Get the labels of papers from a classifier from fit_centroid_classifier
+
+    Parameters
+    ----------
+    classifier: dict
+        the classifier
+    embeddings: ndarray
+        (n_docs x n_dims) embeddings of the papers to label
+    chunk_rows: int
+        number of rows to normalize at a time
+
+    Returns
+    -------
+    ndarray
+        (n_docs x n_labels) boolean labels
+
+    """
+    return predict_scores(classifier, embeddings, chunk_rows) >= classifier["thresholds"]
@@ -0,0 +1,150 @@
+"""Utilities for caching sentence embeddings on disk, so repeated sentences are only embedded once"""
+import hashlib
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+from utils.constants import DATA_DIR
+
+SENTENCE_CACHE_PATH = "sentence_embedding_cache.sqlite"
+# about 1.5GB of 768-dimensional float32 embeddings
+SENTENCE_CACHE_MAX_ENTRIES = 500000
+
+# number of keys in each sqlite query, below sqlite's limit on query parameters
+_QUERY_KEYS = 500
+_SPACE_RE = re.compile(r"\s+")
+
+
+def get_sentence_key(sentence, model, hidden):
+    """Get the cache key of a sentence's embedding from a model's hidden layer
+
+    Sentences that only differ in whitespace share a key.
+
+    Parameters
+    ----------
+    sentence: str
+        the sentence
+    model: str
+        name of the model
+    hidden: int
+        hidden layer the embedding is read from
+
+    Returns
+    -------
+    str
+        the key
+
+    """
+    normalized = _SPACE_RE.sub(" ", sentence).strip()
+    return hashlib.sha1(f"{model}\t{hidden}\t{normalized}".encode()).hexdigest()
+
+
+class SentenceEmbeddingCache(object):
+
+    """
+    Sentence embeddings in an sqlite database, keyed by get_sentence_key.
+
+    Each entry records when it was last read or written. Once the cache holds
+    more than max_entries embeddings, the least recently used ones are
+    evicted. Hits and misses are counted over the life of the object.
+    """
+
+    def __init__(self, path=None, max_entries=SENTENCE_CACHE_MAX_ENTRIES):
+        """
+        :param path: path of the database. Defaults to SENTENCE_CACHE_PATH in DATA_DIR.
+        :param max_entries: maximum number of embeddings to keep
+        """
+        self.path = path or os.path.join(DATA_DIR, SENTENCE_CACHE_PATH)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, embedding BLOB, last_used INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS last_used_index ON embeddings (last_used)")
+        self._clock = self._conn.execute("SELECT COALESCE(MAX(last_used), 0) FROM embeddings").fetchone()[0]
+        # kept up to date by put_many, so the table is only counted once
+        self._n_entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @property
+    def hit_rate(self):
+        """Share of lookups that were found in the cache, or None before any lookup"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else None
+
+    def __len__(self):
+        return self._n_entries
+
+    def get_many(self, keys):
+        """Get the cached embeddings of the given keys
+
+        Parameters
+        ----------
+        keys: list[str]
+            keys from get_sentence_key
+
+        Returns
+        -------
+        dict
+            map of each key found in the cache to its float32 embedding
+
+        """
+        unique_keys = list(dict.fromkeys(keys))
+        found = {}
+        for start in range(0, len(unique_keys), _QUERY_KEYS):
+            query_keys = unique_keys[start:start + _QUERY_KEYS]
+            rows = self._conn.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(query_keys))})",
+                query_keys)
+            for key, embedding in rows:
+                found[key] = np.frombuffer(embedding, dtype=np.float32)
+        self.hits += sum(key in found for key in keys)
+        self.misses += sum(key not in found for key in keys)
+
+        if len(found) > 0:
+            self._clock += 1
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(self._clock, key) for key in found])
+            self._conn.commit()
+        return found
+
+    def put_many(self, keys, embeddings):
+        """Add embeddings to the cache, evicting the least recently used ones if it is full
+
+        Parameters
+        ----------
+        keys: list[str]
+            keys from get_sentence_key
+        embeddings: ndarray
+            (n_keys x n_dims) embeddings
+
+        """
+        unique_keys = list(dict.fromkeys(keys))
+        n_existing = 0
+        for start in range(0, len(unique_keys), _QUERY_KEYS):
+            query_keys = unique_keys[start:start + _QUERY_KEYS]
+            n_existing += self._conn.execute(
+                f"SELECT COUNT(*) FROM embeddings WHERE key IN ({','.join('?' * len(query_keys))})",
+                query_keys).fetchone()[0]
+
+        self._clock += 1
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)",
+            [(key, np.asarray(embedding, dtype=np.float32).tobytes(), self._clock)
+             for key, embedding in zip(keys, embeddings)])
+        self._n_entries += len(unique_keys) - n_existing
+        n_evict = self._n_entries - self.max_entries
+        if n_evict > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (n_evict,))
+            self._n_entries -= n_evict
+        self._conn.commit()
+
+    def close(self):
+        """Close the database"""
+        self._conn.close()
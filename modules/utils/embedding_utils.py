@@ -0,0 +1,86 @@
+"""Utilities for loading CORD-19 document embeddings"""
+import logging
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from utils.constants import DATA_DIR
+
+EMBEDDINGS_CSV_PATH = "cord_19_embeddings.csv"
+EMBEDDINGS_MATRIX_PATH = "cord_19_embeddings.npy"
+EMBEDDINGS_INDEX_PATH = "cord_19_embeddings_index.pkl"
+
+
+def build_embedding_matrix(chunksize=20000):
+    """Parse the embeddings csv into a float32 matrix and a cord_uid index
+
+    The csv is read in chunks and written straight into a memory-mapped
+    .npy file, so no per-dimension python objects are ever created.
+
+    Parameters
+    ----------
+    chunksize: int
+        number of rows to parse at a time
+
+    Returns
+    -------
+    ndarray, dict
+        the memory-mapped (n_docs x n_dims) matrix and a map of cord_uid to row
+
+    """
+    csv_path = os.path.join(DATA_DIR, EMBEDDINGS_CSV_PATH)
+    with open(csv_path) as f:
+        num_dims = len(f.readline().split(",")) - 1
+        num_docs = 1 + sum(1 for line in f if line.strip())
+    logging.info(f"Parsing {num_docs} embeddings with {num_dims} dimensions")
+
+    matrix = np.lib.format.open_memmap(
+        os.path.join(DATA_DIR, EMBEDDINGS_MATRIX_PATH),
+        mode="w+",
+        dtype=np.float32,
+        shape=(num_docs, num_dims),
+    )
+    dtypes = {i: np.float32 for i in range(1, num_dims + 1)}
+    dtypes[0] = str
+    cord_uid_to_row = {}
+    start_row = 0
+    for df_chunk in pd.read_csv(csv_path, header=None, dtype=dtypes, chunksize=chunksize):
+        end_row = start_row + len(df_chunk)
+        matrix[start_row:end_row] = df_chunk.iloc[:, 1:].to_numpy(dtype=np.float32)
+        cord_uid_to_row.update(zip(df_chunk[0], range(start_row, end_row)))
+        start_row = end_row
+    matrix.flush()
+
+    with open(os.path.join(DATA_DIR, EMBEDDINGS_INDEX_PATH), "wb") as f:
+        pickle.dump(cord_uid_to_row, f)
+    return matrix, cord_uid_to_row
+
+
+def load_embedding_matrix(mmap_mode="r"):
+    """Load the embedding matrix, building it if it is missing or out of date
+
+    Parameters
+    ----------
+    mmap_mode: str
+        memory-map mode passed to np.load. Use None to load into memory.
+
+    Returns
+    -------
+    ndarray, dict
+        the (n_docs x n_dims) float32 matrix and a map of cord_uid to row
+
+    """
+    csv_path = os.path.join(DATA_DIR, EMBEDDINGS_CSV_PATH)
+    matrix_path = os.path.join(DATA_DIR, EMBEDDINGS_MATRIX_PATH)
+    index_path = os.path.join(DATA_DIR, EMBEDDINGS_INDEX_PATH)
+    is_stale = not os.path.exists(matrix_path) or not os.path.exists(index_path) or (
+        os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(matrix_path)
+    )
+    if is_stale:
+        build_embedding_matrix()
+    with open(index_path, "rb") as f:
+        cord_uid_to_row = pickle.load(f)
+    return np.load(matrix_path, mmap_mode=mmap_mode), cord_uid_to_row
+
@@ -0,0 +1,192 @@
+"""Utilities for measuring the time and memory used by pipeline stages"""
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# the report of the run in progress, if any
+_CURRENT_RUN = None
+# stages in progress, outermost first
+_STAGE_STACK = []
+
+
+class StageStats(object):
+
+    """
+    Measurements for one stage of a run.
+    """
+
+    def __init__(self, name, rows_in=None):
+        """
+        :param name: name of the stage
+        :param rows_in: number of rows going into the stage
+        """
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.counts = {}
+        self.extra = {}
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_rss_mb = None
+        self.peak_child_rss_mb = None
+        # peak RSS of nested stages, which reset the peak when they start
+        self._nested_peak_rss_mb = 0
+
+    def add_count(self, unit, count):
+        """Add to the number of units processed, e.g. docs or sentences. Reported as units/sec"""
+        self.counts[unit] = self.counts.get(unit, 0) + count
+
+    def to_dict(self):
+        """Get the stats as a json-serializable dict"""
+        stats = {
+            "name": self.name,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "peak_rss_mb": self.peak_rss_mb,
+            "peak_child_rss_mb": self.peak_child_rss_mb,
+        }
+        for unit, count in self.counts.items():
+            stats[unit] = count
+            stats[f"{unit}_per_sec"] = count / self.wall_time if self.wall_time else None
+        stats.update(self.extra)
+        return stats
+
+
+def start_run(name):
+    """Start collecting stage stats for a new run
+
+    Parameters
+    ----------
+    name: str
+        name of the run, e.g. the pipeline being run
+
+    """
+    global _CURRENT_RUN
+    _CURRENT_RUN = {"name": name, "started_at": datetime.now().isoformat(), "stages": []}
+
+
+def save_run_report(directory):
+    """Save the stats of the current run as json and stop collecting
+
+    Parameters
+    ----------
+    directory: str
+        directory to save the report to
+
+    Returns
+    -------
+    str
+        path of the saved report, or None if no run was started
+
+    """
+    global _CURRENT_RUN
+    if _CURRENT_RUN is None:
+        return None
+    _CURRENT_RUN["finished_at"] = datetime.now().isoformat()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(
+        directory, f"run_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump(_CURRENT_RUN, f, indent=2)
+    _CURRENT_RUN = None
+    logging.info(f"Saved run report to {path}")
+    return path
+
+
+@contextmanager
+def track_stage(name, rows_in=None):
+    """Measure wall time, CPU time and peak memory of a block of code
+
+    The stats are logged and, if a run was started, added to its report.
+    CPU time includes finished child processes, e.g. multiprocessing pools.
+    If the block raises, the stats are still recorded, with the error.
+
+    Parameters
+    ----------
+    name: str
+        name of the stage
+    rows_in: int
+        number of rows going into the stage
+
+    Yields
+    ------
+    StageStats
+        stats of the stage, to record rows_out and counts on
+
+    """
+    stats = StageStats(name, rows_in)
+    if len(_STAGE_STACK) > 0:
+        _STAGE_STACK[-1]._nested_peak_rss_mb = max(
+            _STAGE_STACK[-1]._nested_peak_rss_mb, _get_peak_rss_mb())
+    _STAGE_STACK.append(stats)
+    _reset_peak_rss()
+    start_wall = time.perf_counter()
+    start_cpu = _get_cpu_time()
+    try:
+        yield stats
+    except BaseException as e:
+        stats.extra["error"] = repr(e)
+        raise
+    finally:
+        _STAGE_STACK.pop()
+        stats.wall_time = time.perf_counter() - start_wall
+        stats.cpu_time = _get_cpu_time() - start_cpu
+        stats.peak_rss_mb = max(_get_peak_rss_mb(), stats._nested_peak_rss_mb)
+        if len(_STAGE_STACK) > 0:
+            _STAGE_STACK[-1]._nested_peak_rss_mb = max(
+                _STAGE_STACK[-1]._nested_peak_rss_mb, stats.peak_rss_mb)
+        stats.peak_child_rss_mb = _to_mb(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        throughput = ", ".join(
+            f"{count / stats.wall_time:.1f} {unit}/sec"
+            for unit, count in stats.counts.items() if stats.wall_time > 0
+        )
+        logging.info(
+            f"Stage {name}: {stats.wall_time:.1f}s wall, {stats.cpu_time:.1f}s cpu, "
+            f"{stats.peak_rss_mb:.0f} MB peak, rows {stats.rows_in} -> {stats.rows_out}"
+            + (f", {throughput}" if throughput else "")
+        )
+        if _CURRENT_RUN is not None:
+            _CURRENT_RUN["stages"].append(stats.to_dict())
+
+
+def _get_cpu_time():
+    """Get the user and system time of this process and its finished children"""
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        usage_self.ru_utime + usage_self.ru_stime
+        + usage_children.ru_utime + usage_children.ru_stime
+    )
+
+
+def _to_mb(maxrss):
+    """Convert ru_maxrss to megabytes. It is in kilobytes on Linux and bytes on macOS"""
+    return maxrss / 1024 / 1024 if sys.platform == "darwin" else maxrss / 1024
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process where the OS allows it, so it is per stage"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _get_peak_rss_mb():
+    """Get the peak RSS of this process since the last reset"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return _to_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
@@ -0,0 +1,186 @@
+"""Utilities for selecting the top keywords of documents"""
+import re
+import zlib
+from collections import Counter
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# the default token pattern of sklearn's TfidfVectorizer
+TOKEN_RE = re.compile(r"(?u)\b\w\w+\b")
+
+
+def get_top_keywords(X, feature_names, keep_mask=None, num_keywords=20, start=0, end=None):
+    """Get the highest scoring words of each row of a sparse score matrix
+
+    Only the nonzeros of each row are considered, and only the top
+    num_keywords of them are fully sorted.
+
+    Parameters
+    ----------
+    X: csr_matrix
+        scores with shape (docs, words), e.g. TF-IDF
+    feature_names: list[str]
+        word of each column
+    keep_mask: array
+        boolean mask of the columns that may be keywords. All columns if None.
+    num_keywords: int
+        maximum number of keywords per row
+    start: int
+        first row to select keywords for
+    end: int
+        row to stop at. Defaults to the last row.
+
+    Returns
+    -------
+    list[list[str]]
+        keywords of each row, highest score first. Ties are broken by column
+        order. Rows with fewer nonzero scores get fewer keywords.
+
+    """
+    feature_names = np.asarray(feature_names, dtype=object)
+    end = X.shape[0] if end is None else end
+    top_keywords = []
+    for row in range(start, end):
+        row_start, row_end = X.indptr[row], X.indptr[row + 1]
+        indices = X.indices[row_start:row_end]
+        scores = X.data[row_start:row_end]
+        if keep_mask is not None:
+            is_kept = keep_mask[indices]
+            indices, scores = indices[is_kept], scores[is_kept]
+        is_nonzero = scores > 0
+        indices, scores = indices[is_nonzero], scores[is_nonzero]
+        if len(scores) > num_keywords:
+            # keep everything tied with the last keyword, so ties are broken by column below
+            threshold = np.partition(scores, len(scores) - num_keywords)[len(scores) - num_keywords]
+            is_top = scores >= threshold
+            indices, scores = indices[is_top], scores[is_top]
+        order = np.lexsort((indices, -scores))[:num_keywords]
+        top_keywords.append(feature_names[indices[order]].tolist())
+    return top_keywords
+
+
+class KeywordModel(object):
+
+    """
+    TF-IDF statistics that can be updated one batch of documents at a time.
+
+    Scores match sklearn's TfidfVectorizer with its defaults: lowercased
+    tokens of two or more word characters, raw term counts, smoothed idf and
+    l2-normalized rows. The unique terms of each document are kept, so that
+    document frequencies can be corrected when a document changes instead of
+    being refit on the whole corpus.
+
+    With n_features set, words are hashed into a fixed number of columns and no
+    vocabulary is kept, which caps memory on large corpora. Words that share a
+    column are counted as one. Each column is named by a majority vote over
+    the documents its words occur in, which keeps the most frequent word
+    whenever it makes up more than half of the column's occurrences.
+    """
+
+    def __init__(self, n_features=None):
+        """
+        :param n_features: number of hashed columns. If None, every word gets its own column.
+        """
+        self.n_features = n_features
+        self.vocab = {}
+        self.feature_names = [None] * n_features if n_features else []
+        # votes for the name of each hashed column
+        self.name_votes = np.zeros(n_features or 0, dtype=np.int64)
+        self.doc_freq = np.zeros(n_features or 0, dtype=np.int64)
+        self.doc_terms = {}
+
+    @property
+    def n_docs(self):
+        """Number of documents in the statistics"""
+        return len(self.doc_terms)
+
+    def _get_column(self, word, add=True):
+        """Get the column of a word, adding it if it is new and add is set. None if it is unknown"""
+        if self.n_features:
+            column = zlib.crc32(word.encode()) % self.n_features
+            if add:
+                self._vote_name(column, word)
+            return column
+        column = self.vocab.get(word)
+        if column is None and add:
+            column = self.vocab[word] = len(self.feature_names)
+            self.feature_names.append(word)
+        return column
+
+    def _vote_name(self, column, word):
+        """Count a document's vote for the name of a hashed column, like the Boyer-Moore majority vote"""
+        if self.feature_names[column] == word:
+            self.name_votes[column] += 1
+        elif self.name_votes[column] == 0:
+            self.feature_names[column] = word
+            self.name_votes[column] = 1
+        else:
+            self.name_votes[column] -= 1
+
+    def _count_terms(self, doc, add=True):
+        """Get the columns of a document's terms and how often each occurs"""
+        counts = Counter()
+        for word, count in Counter(TOKEN_RE.findall(doc.lower())).items():
+            column = self._get_column(word, add)
+            if column is not None:
+                counts[column] += count
+        columns = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        return columns, np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+
+    def update(self, cord_uids, docs):
+        """Add new documents to the statistics, or replace changed ones
+
+        Parameters
+        ----------
+        cord_uids: list[str]
+            id of each document
+        docs: list[str]
+            text of each document
+
+        """
+        new_terms = {cord_uid: self._count_terms(doc)[0] for cord_uid, doc in zip(cord_uids, docs)}
+        if len(self.feature_names) > len(self.doc_freq):
+            self.doc_freq = np.concatenate([
+                self.doc_freq, np.zeros(len(self.feature_names) - len(self.doc_freq), dtype=np.int64)])
+        for cord_uid, columns in new_terms.items():
+            if cord_uid in self.doc_terms:
+                np.subtract.at(self.doc_freq, self.doc_terms[cord_uid], 1)
+            np.add.at(self.doc_freq, columns, 1)
+            # columns fit in 32 bits, which halves the memory of the kept terms
+            self.doc_terms[cord_uid] = columns.astype(np.uint32)
+
+    def get_idf(self):
+        """Get the smoothed inverse document frequency of each column"""
+        return (np.log((1 + self.n_docs) / (1 + self.doc_freq)) + 1).astype(np.float32)
+
+    def transform(self, docs):
+        """Get the TF-IDF scores of documents
+
+        Words that were never added with update are ignored.
+
+        Parameters
+        ----------
+        docs: list[str]
+            text of each document
+
+        Returns
+        -------
+        csr_matrix
+            float32 scores with shape (docs, columns)
+
+        """
+        idf = self.get_idf()
+        data, indices, indptr = [], [], [0]
+        for doc in docs:
+            columns, counts = self._count_terms(doc, add=False)
+            scores = counts * idf[columns]
+            norm = np.linalg.norm(scores)
+            data.append(scores / norm if norm > 0 else scores)
+            indices.append(columns)
+            indptr.append(indptr[-1] + len(columns))
+        return csr_matrix(
+            (np.concatenate(data) if data else np.zeros(0, dtype=np.float32),
+             np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64), indptr),
+            shape=(len(docs), len(self.doc_freq)), dtype=np.float32
+        )
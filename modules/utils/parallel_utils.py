@@ -0,0 +1,215 @@
+"""Utilities for running DataFrame stages in parallel"""
+import logging
+import os
+from collections import deque
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+# set in each worker by the pool initializer. Workers are forked, so they get
+# these objects without a copy, and each pool's workers only see their own call's
+_SHARED_DF = None
+_SHARED_FUNC = None
+_SHARED_OUTPUT_COLS = None
+
+
+def get_num_cores():
+    """Get the number of CPUs available to this process"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_balanced_chunks(weights, n_chunks):
+    """Split rows into contiguous chunks with roughly equal total weight
+
+    Parameters
+    ----------
+    weights: array
+        weight of each row, e.g. its text length
+    n_chunks: int
+        maximum number of chunks
+
+    Returns
+    -------
+    list[tuple]
+        (start, end) row positions of each chunk
+
+    """
+    if len(weights) == 0:
+        return []
+    cumulative = np.cumsum(weights, dtype=np.float64)
+    targets = cumulative[-1] * np.arange(1, n_chunks) / n_chunks
+    boundaries = np.searchsorted(cumulative, targets, side="left") + 1
+    boundaries = np.unique(np.concatenate([[0], boundaries, [len(weights)]]).clip(0, len(weights)))
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def parallelize_dataframe(df, func, n_cores=None, weight_col="text", output_cols=None, chunks_per_core=4):
+    """Parallelize a function over the dataframe
+
+    Workers are forked with df, so they read it through copy-on-write memory
+    instead of receiving a pickled copy. Chunks are
+    balanced by the length of weight_col rather than by row count, and only
+    the columns added by func are sent back.
+
+    Parameters
+    ----------
+    df: DataFrame
+        dataframe of interest
+    func: function
+        function that accepts a chunk of df and adds columns to it. It can
+        return the chunk or modify it in-place.
+    n_cores: int
+        number of cores to use. Defaults to the number of available CPUs.
+    weight_col: str
+        column whose string length is used to balance chunks. If None or
+        missing, chunks are balanced by row count.
+    output_cols: list[str]
+        columns to bring back from the workers. Defaults to the new columns.
+    chunks_per_core: int
+        number of chunks per core, so that cores that finish early pick up more work
+
+    Returns
+    -------
+    DataFrame
+        df with the columns added by func
+
+    """
+    n_cores = n_cores or get_num_cores()
+    if len(df) == 0 or n_cores == 1:
+        result = func(df)
+        return df if result is None else result
+
+    weights = np.ones(len(df))
+    if weight_col is not None and weight_col in df.columns:
+        # the per-row overhead keeps chunks of short or empty texts from growing too large
+        weights += df[weight_col].str.len().fillna(0).to_numpy(dtype=np.float64) / 1000
+    chunks = get_balanced_chunks(weights, n_cores * chunks_per_core)
+    logging.info(f"Running {func.__name__ if hasattr(func, '__name__') else func} "
+                 f"on {len(df)} rows in {len(chunks)} chunks with {n_cores} cores")
+
+    with get_context("fork").Pool(n_cores, _init_worker, (df, func, output_cols)) as pool:
+        results = pool.map(_run_on_chunk, chunks, chunksize=1)
+
+    df_result = pd.concat(results)
+    df_result.index = df.index
+    for col in df_result.columns:
+        df[col] = df_result[col]
+    return df
+
+
+def imap_dataframe(df, func, n_cores=None, weight_col="text", chunk_rows=100, max_pending=None):
+    """Lazily apply a function to chunks of the dataframe in parallel
+
+    Like parallelize_dataframe, workers are forked and read df through
+    copy-on-write memory. Results are yielded in order as they are consumed,
+    and at most max_pending chunks are in flight, so memory stays bounded no
+    matter how large the total output is.
+
+    Parameters
+    ----------
+    df: DataFrame
+        dataframe of interest
+    func: function
+        function that accepts a chunk of df and returns a picklable result
+    n_cores: int
+        number of cores to use. Defaults to the number of available CPUs.
+    weight_col: str
+        column whose string length is used to balance chunks. If None or
+        missing, chunks are balanced by row count.
+    chunk_rows: int
+        average number of rows per chunk
+    max_pending: int
+        maximum number of chunks in flight. Defaults to twice the number of cores.
+
+    Yields
+    ------
+    object
+        result of func on each chunk, in row order
+
+    """
+    n_cores = n_cores or get_num_cores()
+    weights = np.ones(len(df))
+    if weight_col is not None and weight_col in df.columns:
+        weights += df[weight_col].str.len().fillna(0).to_numpy(dtype=np.float64) / 1000
+    chunks = get_balanced_chunks(weights, max(1, len(df) // chunk_rows))
+    if n_cores == 1:
+        for start, end in chunks:
+            yield func(df.iloc[start:end])
+        return
+
+    max_pending = max_pending or 2 * n_cores
+    with get_context("fork").Pool(n_cores, _init_worker, (df, func)) as pool:
+        pending = deque()
+        for bounds in chunks:
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(_apply_to_chunk, (bounds,)))
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+
+def map_row_blocks(func, n_rows, n_cores=None, block_rows=1000):
+    """Apply a function to blocks of rows in parallel and concatenate the results
+
+    Workers are forked, so func can be a closure over large objects such as a
+    sparse matrix without them being pickled.
+
+    Parameters
+    ----------
+    func: function
+        function that accepts the start and end row of a block and returns a list
+    n_rows: int
+        total number of rows
+    n_cores: int
+        number of cores to use. Defaults to the number of available CPUs.
+    block_rows: int
+        number of rows per block
+
+    Returns
+    -------
+    list
+        the results of all blocks, in row order
+
+    """
+    n_cores = n_cores or get_num_cores()
+    blocks = [(start, min(start + block_rows, n_rows)) for start in range(0, n_rows, block_rows)]
+    if n_cores == 1 or len(blocks) <= 1:
+        results = [func(start, end) for start, end in blocks]
+    else:
+        with get_context("fork").Pool(min(n_cores, len(blocks)), _init_worker, (None, func)) as pool:
+            results = pool.map(_apply_to_block, blocks, chunksize=1)
+    return [item for result in results for item in result]
+
+
+def _init_worker(df, func, output_cols=None):
+    """Set the dataframe and function of the pool this worker belongs to"""
+    global _SHARED_DF, _SHARED_FUNC, _SHARED_OUTPUT_COLS
+    _SHARED_DF, _SHARED_FUNC, _SHARED_OUTPUT_COLS = df, func, output_cols
+
+
+def _apply_to_block(bounds):
+    """Apply the shared function to a block of rows"""
+    return _SHARED_FUNC(*bounds)
+
+
+def _apply_to_chunk(bounds):
+    """Return the shared function applied to rows [start, end) of the shared dataframe"""
+    start, end = bounds
+    return _SHARED_FUNC(_SHARED_DF.iloc[start:end])
+
+
+def _run_on_chunk(bounds):
+    """Run the shared function on rows [start, end) of the shared dataframe"""
+    start, end = bounds
+    df_chunk = _SHARED_DF.iloc[start:end].copy()
+    result = _SHARED_FUNC(df_chunk)
+    if result is None:
+        result = df_chunk
+    output_cols = _SHARED_OUTPUT_COLS
+    if output_cols is None:
+        output_cols = [col for col in result.columns if col not in _SHARED_DF.columns]
+    return result[output_cols]
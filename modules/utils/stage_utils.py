@@ -0,0 +1,112 @@
+"""Utilities for checkpointing pipeline stages"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+from utils.constants import DATA_DIR
+
+STAGE_DIR = "pipeline_stages"
+
+
+def get_file_fingerprint(paths):
+    """Get a cheap fingerprint of files or directories based on their size and mtime
+
+    Parameters
+    ----------
+    paths: list[str]
+        paths relative to DATA_DIR. Missing paths are fingerprinted as missing.
+
+    Returns
+    -------
+    dict
+        a map of path to (size, mtime)
+
+    """
+    fingerprint = {}
+    for path in paths:
+        full_path = os.path.join(DATA_DIR, path)
+        if os.path.exists(full_path):
+            stat = os.stat(full_path)
+            fingerprint[path] = (stat.st_size, stat.st_mtime)
+        else:
+            fingerprint[path] = None
+    return fingerprint
+
+
+def get_stage_key(prev_key, stage, params):
+    """Get a key for a stage's artifact from its inputs and parameters
+
+    Parameters
+    ----------
+    prev_key: str
+        key of the previous stage's artifact, or "" for the first stage
+    stage: str
+        name of the stage
+    params: dict
+        json-serializable parameters and input fingerprints of the stage
+
+    Returns
+    -------
+    str
+        an md5 hex digest
+
+    """
+    payload = json.dumps([prev_key, stage, params], sort_keys=True, default=str)
+    return hashlib.md5(payload.encode()).hexdigest()
+
+
+def get_stage_path(stage, key):
+    """Get the path of the artifact for the given stage and key"""
+    return os.path.join(DATA_DIR, STAGE_DIR, f"{stage}-{key}.pkl")
+
+
+def has_stage_artifact(stage, key):
+    """Returns whether the artifact for the given stage and key exists"""
+    return os.path.exists(get_stage_path(stage, key))
+
+
+def load_stage_artifact(stage, key):
+    """Load the artifact for the given stage and key
+
+    Raises
+    ------
+    FileNotFoundError
+        if the stage has not been run with these inputs
+
+    """
+    path = get_stage_path(stage, key)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No artifact for stage {stage} at {path}. Run that stage first.")
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def save_stage_artifact(stage, key, artifact):
+    """Save the artifact for the given stage and key
+
+    Artifacts of the same stage with other keys are removed, since they are
+    out of date and can be large.
+
+    """
+    path = get_stage_path(stage, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    for old_path in glob.glob(os.path.join(DATA_DIR, STAGE_DIR, f"{stage}-*.pkl")):
+        if old_path != path:
+            logging.info(f"Removing stale artifact {old_path}")
+            os.remove(old_path)
+
+
+def remove_stage_artifacts(stages):
+    """Remove every artifact of the given stages"""
+    for stage in stages:
+        for path in glob.glob(os.path.join(DATA_DIR, STAGE_DIR, f"{stage}-*.pkl")):
+            logging.info(f"Removing artifact {path}")
+            os.remove(path)
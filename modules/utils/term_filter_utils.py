@@ -0,0 +1,57 @@
+"""Utilities for finding mentions of a list of terms in papers"""
+import re
+
+import pandas as pd
+
+COVID_TERMS = ["covid", "coronavirus", "sars-cov-2", "corona", "wuhan"]
+
+
+class TermFilter(object):
+
+    """
+    Finds mentions of a list of terms in text columns.
+
+    The terms are compiled once into a single pattern, so each column is
+    lowercased and scanned once no matter how many terms there are.
+    """
+
+    def __init__(self, terms):
+        """
+        :param terms: terms to look for. Matching is case-insensitive.
+        """
+        self.terms = [term.lower() for term in terms]
+        # longest terms first so that overlapping terms match as much as possible
+        self.pattern = re.compile(
+            "|".join(re.escape(term) for term in sorted(self.terms, key=len, reverse=True))
+        )
+        self._match_to_terms = {}
+
+    def contains(self, df, col):
+        """Returns a flag if the given column mentions any of the terms"""
+        return df[col].str.lower().str.contains(self.pattern, na=False)
+
+    def match(self, df, cols):
+        """Find which terms each row mentions in any of the given columns
+
+        :param df: source data
+        :param cols: columns to look for terms in, e.g. title, abstract and text
+        :return: a boolean Series of whether any term matched, and a Series of
+            the sorted list of matched terms for each row
+        """
+        matched_terms = [set() for _ in range(len(df))]
+        for col in cols:
+            for i, matches in enumerate(df[col].str.lower().str.findall(self.pattern)):
+                if isinstance(matches, list):
+                    for match in matches:
+                        matched_terms[i].update(self._get_terms(match))
+        is_match = pd.Series([len(terms) > 0 for terms in matched_terms], index=df.index)
+        return is_match, pd.Series([sorted(terms) for terms in matched_terms], index=df.index)
+
+    def _get_terms(self, match):
+        """Get the terms contained in a matched string"""
+        if match not in self._match_to_terms:
+            self._match_to_terms[match] = [term for term in self.terms if term in match]
+        return self._match_to_terms[match]
+
+
+COVID_FILTER = TermFilter(COVID_TERMS)
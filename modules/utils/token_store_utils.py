@@ -0,0 +1,376 @@
+"""Utilities for storing tokenized papers, so each paper is only tokenized once"""
+import hashlib
+import logging
+import os
+import pickle
+
+import nltk
+import numpy as np
+
+from utils.constants import DATA_DIR
+from utils.parallel_utils import imap_dataframe
+
+TOKEN_STORE_DIR = "token_store"
+TOKEN_FIELDS = ["title", "abstract", "text"]
+
+_TOKENS_FILE = "tokens.bin"
+_SENTENCES_FILE = "sentences.bin"
+_VOCAB_FILE = "vocab.pkl"
+_INDEX_FILE = "index.pkl"
+# token start, token end, char start and char end of each sentence
+_SENTENCE_COLS = 4
+# share of sentences no longer referenced by the index above which the store is compacted
+COMPACT_DEAD_SHARE = 0.5
+
+
+def _get_sentence_tokenizer():
+    """Get the punkt tokenizer used by nltk.sent_tokenize"""
+    if hasattr(nltk.tokenize, "PunktTokenizer"):
+        return nltk.tokenize.PunktTokenizer("english")
+    return nltk.data.load("tokenizers/punkt/english.pickle")
+
+
+def tokenize_text(text, sentence_tokenizer=None):
+    """Split a text into sentences and word tokens
+
+    Gives the same sentences as nltk.sent_tokenize, and tokenizes each of them
+    with nltk.word_tokenize.
+
+    Parameters
+    ----------
+    text: str
+        text to tokenize
+    sentence_tokenizer: PunktSentenceTokenizer
+        tokenizer for sentences. Loaded if None.
+
+    Returns
+    -------
+    list[tuple], list[list[str]]
+        the (start, end) character span of each sentence and its tokens
+
+    """
+    if not isinstance(text, str) or len(text) == 0:
+        return [], []
+    sentence_tokenizer = sentence_tokenizer or _get_sentence_tokenizer()
+    spans = list(sentence_tokenizer.span_tokenize(text))
+    tokens = [nltk.word_tokenize(text[start:end], preserve_line=True) for start, end in spans]
+    return spans, tokens
+
+
+def get_text_hash(text):
+    """Get a hash of a text. Missing texts hash like empty ones"""
+    return hashlib.md5((text if isinstance(text, str) else "").encode()).hexdigest()
+
+
+def _tokenize_docs(df, fields):
+    """Tokenize the given fields of each paper in the chunk"""
+    sentence_tokenizer = _get_sentence_tokenizer()
+    docs = []
+    for field in fields:
+        for cord_uid, text, text_hash in zip(df["cord_uid"], df[field], df[f"{field}_hash"]):
+            spans, tokens = tokenize_text(text, sentence_tokenizer)
+            docs.append((cord_uid, field, text_hash, spans, tokens))
+    return docs
+
+
+class TokenStore(object):
+
+    """
+    Sentence boundaries and token ids of papers, in memory-mapped arrays.
+
+    Each field of a paper (e.g. its title or text) is a doc made of sentences.
+    Token ids of all docs are appended to one int32 array, and each sentence
+    is a row of token and character offsets in a second array. An index maps
+    (cord_uid, field, text hash) to the doc's range of sentences, so rows that
+    share a cord_uid but not a text are stored side by side, and a doc is only
+    tokenized again when its text changes. Docs replaced by a new text are
+    dropped from the index, and the arrays are compacted once most of their
+    sentences are dead. Tokens keep their case, so each stage can normalize
+    them itself.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :param directory: directory of the store. Defaults to TOKEN_STORE_DIR in DATA_DIR.
+        """
+        self.directory = directory or os.path.join(DATA_DIR, TOKEN_STORE_DIR)
+        self._vocab = None
+        self._index = None
+        self._tokens = None
+        self._sentences = None
+
+    @property
+    def vocab(self):
+        """Array of the token of each id"""
+        if self._vocab is None:
+            path = os.path.join(self.directory, _VOCAB_FILE)
+            tokens = []
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    tokens = pickle.load(f)
+            self._vocab = np.array(tokens, dtype=object)
+        return self._vocab
+
+    @property
+    def index(self):
+        """Map of (cord_uid, field, text hash) to (first sentence, end sentence)"""
+        if self._index is None:
+            path = os.path.join(self.directory, _INDEX_FILE)
+            self._index = {}
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    self._index = pickle.load(f)
+        return self._index
+
+    def _load_array(self, name, dtype, n_cols=None):
+        """Memory-map one of the arrays of the store"""
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.zeros((0, n_cols) if n_cols else 0, dtype=dtype)
+        array = np.memmap(path, dtype=dtype, mode="r")
+        return array.reshape(-1, n_cols) if n_cols else array
+
+    @property
+    def tokens(self):
+        """Token ids of all sentences"""
+        if self._tokens is None:
+            self._tokens = self._load_array(_TOKENS_FILE, np.int32)
+        return self._tokens
+
+    @property
+    def sentences(self):
+        """Token and character offsets of all sentences"""
+        if self._sentences is None:
+            self._sentences = self._load_array(_SENTENCES_FILE, np.int64, _SENTENCE_COLS)
+        return self._sentences
+
+    def load(self):
+        """Load the vocab, index and arrays now, e.g. before forking workers that share them"""
+        self.vocab, self.index, self.tokens, self.sentences
+        return self
+
+    def has_doc(self, cord_uid, field, text):
+        """Whether the doc is stored from this text"""
+        return (cord_uid, field, get_text_hash(text)) in self.index
+
+    def add_docs(self, df, fields=TOKEN_FIELDS, n_cores=None):
+        """Tokenize and store the docs that are missing or whose text changed
+
+        Stored docs of the papers in df whose text is no longer in df are
+        dropped, and the store is compacted once most of it is dead.
+
+        Parameters
+        ----------
+        df: DataFrame
+            papers with a cord_uid column and a column for each field
+        fields: list[str]
+            columns to tokenize
+        n_cores: int
+            number of cores to tokenize with. Defaults to the number of available CPUs.
+
+        Returns
+        -------
+        int
+            number of papers that were tokenized
+
+        """
+        df_docs = df[["cord_uid"] + fields].copy()
+        is_missing = np.zeros(len(df_docs), dtype=bool)
+        live_keys = set()
+        for field in fields:
+            df_docs[f"{field}_hash"] = [get_text_hash(text) for text in df_docs[field]]
+            keys = [(cord_uid, field, text_hash)
+                    for cord_uid, text_hash in zip(df_docs["cord_uid"], df_docs[f"{field}_hash"])]
+            live_keys.update(keys)
+            is_missing |= np.array([key not in self.index for key in keys], dtype=bool)
+        papers = set(df_docs["cord_uid"])
+        dead_keys = [
+            key for key in self.index
+            if key[0] in papers and key[1] in fields and key not in live_keys
+        ]
+        df_docs = df_docs[is_missing].drop_duplicates(
+            subset=["cord_uid"] + [f"{field}_hash" for field in fields])
+        if len(df_docs) == 0 and len(dead_keys) == 0:
+            return 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        vocab = self.vocab.tolist()
+        index = dict(self.index)
+        for key in dead_keys:
+            del index[key]
+        n_sentences = len(self.sentences)
+        if len(df_docs) > 0:
+            logging.info(f"Tokenizing {len(df_docs)} papers into the token store")
+            n_sentences = self._append_docs(df_docs, fields, vocab, index, n_cores)
+
+        # the index is written last, so docs are only visible once their arrays are complete
+        self._save_pickle(vocab, _VOCAB_FILE)
+        self._save_pickle(index, _INDEX_FILE)
+        self._vocab, self._index, self._tokens, self._sentences = None, None, None, None
+
+        n_live = sum(end - first for first, end in index.values())
+        if n_sentences > 0 and 1 - n_live / n_sentences > COMPACT_DEAD_SHARE:
+            self.compact()
+        return len(df_docs)
+
+    def _append_docs(self, df_docs, fields, vocab, index, n_cores):
+        """Tokenize the docs and append them to the arrays, adding them to vocab and index
+
+        Returns the number of sentences in the store afterwards.
+        """
+        token_to_id = {token: i for i, token in enumerate(vocab)}
+        n_tokens = len(self.tokens)
+        n_sentences = len(self.sentences)
+        weight_col = "text" if "text" in fields else fields[0]
+        with open(os.path.join(self.directory, _TOKENS_FILE), "ab") as f_tokens, \
+                open(os.path.join(self.directory, _SENTENCES_FILE), "ab") as f_sentences:
+            for docs in imap_dataframe(
+                    df_docs, lambda df_chunk: _tokenize_docs(df_chunk, fields),
+                    n_cores=n_cores, weight_col=weight_col):
+                token_ids, sentence_rows = [], []
+                for cord_uid, field, text_hash, spans, tokens in docs:
+                    # the other fields of a changed paper, or a copy of a duplicated paper
+                    if (cord_uid, field, text_hash) in index:
+                        continue
+                    first_sentence = n_sentences + len(sentence_rows)
+                    for (char_start, char_end), sentence_tokens in zip(spans, tokens):
+                        token_start = n_tokens + len(token_ids)
+                        for token in sentence_tokens:
+                            token_id = token_to_id.get(token)
+                            if token_id is None:
+                                token_id = token_to_id[token] = len(vocab)
+                                vocab.append(token)
+                            token_ids.append(token_id)
+                        sentence_rows.append((token_start, n_tokens + len(token_ids), char_start, char_end))
+                    index[(cord_uid, field, text_hash)] = (first_sentence, n_sentences + len(sentence_rows))
+                f_tokens.write(np.array(token_ids, dtype=np.int32).tobytes())
+                f_sentences.write(np.array(sentence_rows, dtype=np.int64).reshape(-1, _SENTENCE_COLS).tobytes())
+                n_tokens += len(token_ids)
+                n_sentences += len(sentence_rows)
+        return n_sentences
+
+    def compact(self):
+        """Rewrite the arrays with only the docs in the index, dropping dead sentences"""
+        logging.info("Compacting the token store")
+        tokens, sentences = self.tokens, self.sentences
+        index = {}
+        n_tokens, n_sentences = 0, 0
+        tokens_path = os.path.join(self.directory, _TOKENS_FILE)
+        sentences_path = os.path.join(self.directory, _SENTENCES_FILE)
+        with open(f"{tokens_path}.tmp", "wb") as f_tokens, open(f"{sentences_path}.tmp", "wb") as f_sentences:
+            for key, (first, end) in sorted(self.index.items(), key=lambda item: item[1][0]):
+                rows = np.array(sentences[first:end])
+                if len(rows) > 0:
+                    token_start, token_end = rows[0, 0], rows[-1, 1]
+                    f_tokens.write(np.asarray(tokens[token_start:token_end]).tobytes())
+                    rows[:, :2] += n_tokens - token_start
+                    f_sentences.write(rows.tobytes())
+                    n_tokens += token_end - token_start
+                index[key] = (n_sentences, n_sentences + len(rows))
+                n_sentences += len(rows)
+        self._tokens, self._sentences = None, None
+        del tokens, sentences
+        os.replace(f"{tokens_path}.tmp", tokens_path)
+        os.replace(f"{sentences_path}.tmp", sentences_path)
+        self._save_pickle(index, _INDEX_FILE)
+        self._index = None
+
+    def _save_pickle(self, obj, name):
+        """Atomically save an object to the store's directory"""
+        path = os.path.join(self.directory, name)
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(obj, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _get_sentence_rows(self, cord_uid, field, text):
+        """Get the offsets of the sentences of a doc, or None if it isn't stored"""
+        doc = self.index.get((cord_uid, field, get_text_hash(text)))
+        if doc is None:
+            return None
+        return self.sentences[doc[0]:doc[1]]
+
+    def get_token_ids(self, cord_uid, field, text):
+        """Get the token ids of a doc, sentence by sentence
+
+        Parameters
+        ----------
+        cord_uid: str
+            id of the paper
+        field: str
+            field of the paper, e.g. text
+        text: str
+            text of the doc, which picks the stored version of it
+
+        Returns
+        -------
+        list[array]
+            token ids of each sentence, or None if the doc isn't stored
+
+        """
+        rows = self._get_sentence_rows(cord_uid, field, text)
+        if rows is None:
+            return None
+        return [self.tokens[start:end] for start, end in rows[:, :2]]
+
+    def get_doc_token_ids(self, cord_uid, field, text):
+        """Get the token ids of a whole doc as one array, or None if it isn't stored"""
+        rows = self._get_sentence_rows(cord_uid, field, text)
+        if rows is None:
+            return None
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return self.tokens[rows[0, 0]:rows[-1, 1]]
+
+    def get_sentences(self, cord_uid, field, text, vocab=None):
+        """Get the tokens of each sentence of a doc
+
+        Parameters
+        ----------
+        cord_uid: str
+            id of the paper
+        field: str
+            field of the paper, e.g. text
+        text: str
+            text of the doc, which picks the stored version of it
+        vocab: array
+            token of each id, e.g. a lowercased version of vocab. Defaults to vocab.
+
+        Returns
+        -------
+        list[list[str]]
+            tokens of each sentence, or None if the doc isn't stored
+
+        """
+        token_ids = self.get_token_ids(cord_uid, field, text)
+        if token_ids is None:
+            return None
+        vocab = self.vocab if vocab is None else vocab
+        return [vocab[ids].tolist() for ids in token_ids]
+
+    def get_sentence_texts(self, cord_uid, field, text):
+        """Get the text of each sentence of a doc, like nltk.sent_tokenize
+
+        Parameters
+        ----------
+        cord_uid: str
+            id of the paper
+        field: str
+            field of the paper, e.g. text
+        text: str
+            text of the doc. Tokenized on the fly if the doc isn't stored or
+            was stored from a different text.
+
+        Returns
+        -------
+        list[str]
+            the sentences
+
+        """
+        if not isinstance(text, str):
+            return []
+        rows = self._get_sentence_rows(cord_uid, field, text)
+        if rows is None:
+            spans, _ = tokenize_text(text)
+        else:
+            spans = rows[:, 2:]
+        return [text[start:end] for start, end in spans]
@@ -0,0 +1,130 @@
+"""Utilities for counting topic terms in many fields in a single pass"""
+import re
+from collections import Counter
+
+import numpy as np
+
+# a topic regex made only of alternatives like "prefix[a-z]*", e.g. "(diagno[a-z]*)|(test[a-z]*)"
+_PREFIX_TOPIC_RE = re.compile(r"[\s(]*[a-z]+\[a-z\]\*[\s)]*(?:\|[\s(]*[a-z]+\[a-z\]\*[\s)]*)*")
+_PREFIX_RE = re.compile(r"([a-z]+)\[a-z\]\*")
+_WORD_RE = re.compile(r"[a-z]+")
+
+
+def get_topic_prefixes(regex):
+    """Get the prefixes of a topic regex made only of "prefix[a-z]*" alternatives
+
+    For such a regex the match starting at a word runs to the end of the word,
+    so the number of matches in a text equals the number of words (runs of a-z)
+    that contain one of the prefixes. This lets all topics be counted from a
+    single tokenization of the text.
+
+    Parameters
+    ----------
+    regex: str
+        topic regex
+
+    Returns
+    -------
+    list[str]
+        the prefixes, or None if the regex has any other form
+
+    """
+    if _PREFIX_TOPIC_RE.fullmatch(regex) is None:
+        return None
+    return _PREFIX_RE.findall(regex)
+
+
+class TopicCounter(object):
+
+    """
+    Counts the matches of many topic regexes in lowercased texts.
+    """
+
+    def __init__(self, topic_regexes):
+        """
+        :param topic_regexes: list of topic regexes, in the order of the count matrix
+        """
+        self.topic_regexes = topic_regexes
+        self.topic_prefixes = [get_topic_prefixes(regex) for regex in topic_regexes]
+        # topics that can't be counted from words fall back to a regex count
+        self.regex_topics = [
+            (i, re.compile(regex)) for i, (regex, prefixes)
+            in enumerate(zip(topic_regexes, self.topic_prefixes)) if prefixes is None
+        ]
+        self._word_to_topics = {}
+
+    def _get_word_topics(self, word):
+        """Get the indices of the topics whose prefixes occur in the word"""
+        topics = self._word_to_topics.get(word)
+        if topics is None:
+            topics = tuple(
+                i for i, prefixes in enumerate(self.topic_prefixes)
+                if prefixes is not None and any(prefix in word for prefix in prefixes)
+            )
+            self._word_to_topics[word] = topics
+        return topics
+
+    def count(self, text):
+        """Count the matches of each topic in one lowercased text
+
+        Parameters
+        ----------
+        text: str
+            lowercased text. Missing values count as no matches.
+
+        Returns
+        -------
+        array
+            number of matches of each topic
+
+        """
+        counts = np.zeros(len(self.topic_regexes), dtype=np.int32)
+        if not isinstance(text, str):
+            return counts
+        for word, n in Counter(_WORD_RE.findall(text)).items():
+            for i in self._get_word_topics(word):
+                counts[i] += n
+        for i, regex in self.regex_topics:
+            counts[i] = len(regex.findall(text))
+        return counts
+
+    def count_matrix(self, fields):
+        """Count the matches of each topic in each field of each doc
+
+        Parameters
+        ----------
+        fields: list[Series]
+            lowercased texts of each field, e.g. title, abstract and text
+
+        Returns
+        -------
+        array
+            counts with shape (docs, topics, fields)
+
+        """
+        n_docs = len(fields[0]) if len(fields) > 0 else 0
+        counts = np.zeros((n_docs, len(self.topic_regexes), len(fields)), dtype=np.int32)
+        for j, texts in enumerate(fields):
+            for i, text in enumerate(texts):
+                counts[i, :, j] = self.count(text)
+        return counts
+
+
+def get_topic_lists(is_topic, topic_names):
+    """Get the list of topics of each doc
+
+    Parameters
+    ----------
+    is_topic: array
+        boolean array with shape (docs, topics)
+    topic_names: list[str]
+        name of each topic
+
+    Returns
+    -------
+    list[list[str]]
+        names of the topics of each doc, in the order of topic_names
+
+    """
+    topic_names = np.asarray(topic_names, dtype=object)
+    return [topic_names[row].tolist() for row in is_topic]
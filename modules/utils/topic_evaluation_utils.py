@@ -1,31 +1,173 @@
 import numpy as np
-import random
-from scipy.spatial.distance import cdist, cosine
+import pandas as pd
 
-CORPUS_BASELINE = 0.5022927110761003 # this is the baseline for df_covid_with_text
 
-def get_average_pairwise_distance(df, n=1000):
+def get_topic_cohesion(embeddings, groups, rows=None, chunk_rows=50000):
+    """Get how closely the embeddings of each group of papers cluster together
+
+    Embeddings are L2-normalized and summed per group in one pass over the
+    rows, so the cost is O(n * d) and memory stays bounded for memory-mapped
+    embeddings. For unit vectors with mean m, the average cosine distance over
+    all pairs (i, j) is exactly 1 - |m|^2, and the average cosine distance to
+    the group's centroid is 1 - |m|. Papers with all-zero embeddings are
+    skipped.
+
+    Parameters
+    ----------
+    embeddings: ndarray
+        (n_docs x n_dims) embedding matrix, e.g. a memory-mapped array
+    groups: DataFrame
+        boolean membership of each paper (row) in each group (column)
+    rows: array
+        row in embeddings of each row of groups. Defaults to the first rows of embeddings.
+    chunk_rows: int
+        number of rows to normalize at a time
+
+    Returns
+    -------
+    DataFrame
+        for each group, the number of papers, the average pairwise cosine
+        distance and the average cosine distance to the centroid. Smaller
+        numbers mean closer together.
+
+    """
+    memberships = groups.to_numpy(dtype=np.float64)
+    rows = np.arange(len(groups)) if rows is None else np.asarray(rows)
+    sums = np.zeros((memberships.shape[1], embeddings.shape[1]), dtype=np.float64)
+    counts = np.zeros(memberships.shape[1], dtype=np.float64)
+    for start in range(0, len(rows), chunk_rows):
+        chunk = np.asarray(embeddings[rows[start:start + chunk_rows]], dtype=np.float64)
+        norms = np.linalg.norm(chunk, axis=1)
+        is_valid = norms > 0
+        unit_vectors = chunk[is_valid] / norms[is_valid, None]
+        chunk_memberships = memberships[start:start + chunk_rows][is_valid]
+        sums += chunk_memberships.T @ unit_vectors
+        counts += chunk_memberships.sum(axis=0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_norms = np.linalg.norm(sums, axis=1) / counts
+    return pd.DataFrame({
+        "n_docs": counts.astype(int),
+        "pairwise_distance": 1 - mean_norms ** 2,
+        "centroid_spread": 1 - mean_norms,
+    }, index=groups.columns)
+
+
+def get_average_pairwise_distance(df=None, embeddings=None):
     """Get average pairwise distance for a group of embeddings. Smaller number means closer together.
-    
-    With n=1000, this function is generally precise within 0.01
+
+    This is exact, see get_topic_cohesion.
 
     Parameters
     ----------
     df: DataFrame
-        input data
-    n: int
-        number of random pairs to calculate distances for
-    
+        input data with an embedding column. Only used if embeddings is None.
+    embeddings: ndarray
+        optional (n_docs x n_dims) embedding matrix to use instead of df["embedding"]
+
     Returns
     -------
     float
-        the average pairwise cosine distance between the random pairs in df
+        the average cosine distance between all pairs of papers, NaN if there are none
+
+    """
+    if embeddings is None:
+        embeddings = np.array(df["embedding"].tolist())
+    if len(embeddings) == 0:
+        return np.nan
+    cohesion = get_topic_cohesion(embeddings, pd.DataFrame({"all": np.ones(len(embeddings), dtype=bool)}))
+    return cohesion.loc["all", "pairwise_distance"]
+
+
+def load_topic_labels(path):
+    """Load hand-labelled topics, e.g. evaluation_data/topic_modeling_eval.csv
+
+    Parameters
+    ----------
+    path: str
+        path to a csv with "Cord UID" and comma-separated "Topics" columns
+
+    Returns
+    -------
+    Series
+        the set of labelled topics of each paper, indexed by cord_uid
+
+    """
+    df = pd.read_csv(path, dtype=str)
+    return pd.Series(
+        [set() if pd.isnull(topics) else {topic.strip() for topic in topics.split(",") if topic.strip()}
+         for topics in df["Topics"]],
+        index=df["Cord UID"].rename("cord_uid")
+    )
+
+
+def get_topic_precision_recall(predicted, labelled, topics):
+    """Get the precision and recall of predicted topics against labelled topics
+
+    Parameters
+    ----------
+    predicted: Series
+        list of predicted topics of each paper, indexed by cord_uid
+    labelled: Series
+        set of labelled topics of each paper, indexed by cord_uid. Only papers
+        in both predicted and labelled are scored.
+    topics: list[str]
+        topics to score
+
+    Returns
+    -------
+    DataFrame
+        true positives, false positives, false negatives, precision and recall
+        of each topic. Precision and recall are NaN when undefined.
+
+    """
+    cord_uids = labelled.index.intersection(predicted.index)
+    rows = []
+    for topic in topics:
+        is_predicted = np.array([topic in predicted[cord_uid] for cord_uid in cord_uids], dtype=bool)
+        is_labelled = np.array([topic in labelled[cord_uid] for cord_uid in cord_uids], dtype=bool)
+        tp = int((is_predicted & is_labelled).sum())
+        fp = int((is_predicted & ~is_labelled).sum())
+        fn = int((~is_predicted & is_labelled).sum())
+        rows.append({
+            "topic": topic, "tp": tp, "fp": fp, "fn": fn,
+            "precision": tp / (tp + fp) if tp + fp > 0 else np.nan,
+            "recall": tp / (tp + fn) if tp + fn > 0 else np.nan,
+        })
+    return pd.DataFrame(rows).set_index("topic")
+
+
+def get_topic_agreement(is_topic_a, is_topic_b):
+    """Get how often two topic engines agree, with engine a as the reference
+
+    Parameters
+    ----------
+    is_topic_a: DataFrame
+        boolean topics of each paper (row) from the reference engine, one column per topic
+    is_topic_b: DataFrame
+        boolean topics from the other engine, with the same index and columns
+
+    Returns
+    -------
+    DataFrame
+        for each topic, the share of papers labelled by each engine, the share
+        of papers where they agree, Cohen's kappa, and the precision and
+        recall of engine b against engine a
 
     """
-    l1 = range(len(df))
-    l2 = range(len(df))
-    distances = []
-    for i in range(n):
-        i1, i2 = random.choice(l1), random.choice(l2)
-        distances.append(cosine(df["embedding"].iloc[i1], df["embedding"].iloc[i2]))
-    return np.mean(distances)
\ No newline at end of file
+    rows = []
+    for topic in is_topic_a.columns:
+        a = is_topic_a[topic].to_numpy(dtype=bool)
+        b = is_topic_b[topic].to_numpy(dtype=bool)
+        agreement = (a == b).mean()
+        expected = a.mean() * b.mean() + (1 - a.mean()) * (1 - b.mean())
+        rows.append({
+            "topic": topic,
+            "share_a": a.mean(),
+            "share_b": b.mean(),
+            "agreement": agreement,
+            "kappa": (agreement - expected) / (1 - expected) if expected < 1 else np.nan,
+            "precision": (a & b).sum() / b.sum() if b.sum() > 0 else np.nan,
+            "recall": (a & b).sum() / a.sum() if a.sum() > 0 else np.nan,
+        })
+    return pd.DataFrame(rows).set_index("topic")
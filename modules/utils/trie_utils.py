@@ -0,0 +1,64 @@
+"""Utilities for matching many literal strings at once"""
+import re
+
+
+def build_trie_regex(words):
+    """Build a regex that matches any of the given words
+
+    The words are merged into a trie and the regex follows its structure,
+    e.g. ["abc", "abd", "ab"] becomes "ab[cd]?". At each position the regex
+    engine only follows the branch for the next character instead of trying
+    every word, so matching stays fast with thousands of words. Words are
+    matched literally, and the longest word wins when several start at the same
+    position.
+
+    Parameters
+    ----------
+    words: list[str]
+        literal strings to match
+
+    Returns
+    -------
+    str
+        the regex. Matches nothing if there are no words.
+
+    """
+    trie = {}
+    for word in words:
+        if len(word) == 0:
+            continue
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = True
+    if len(trie) == 0:
+        return "(?!)"
+    return _trie_to_regex(trie)
+
+
+def _trie_to_regex(node):
+    """Convert a trie node to a regex"""
+    chars = sorted(char for char in node if char != "")
+    if len(chars) == 0:
+        return ""
+
+    # branches that end right after one character can share a character class
+    leaves = [re.escape(char) for char in chars if list(node[char].keys()) == [""]]
+    alternatives = [
+        re.escape(char) + _trie_to_regex(node[char])
+        for char in chars if list(node[char].keys()) != [""]
+    ]
+    if len(leaves) == 1:
+        alternatives.append(leaves[0])
+    elif len(leaves) > 1:
+        alternatives.append("[" + "".join(leaves) + "]")
+
+    if len(alternatives) > 1:
+        pattern, is_atomic = "(?:" + "|".join(alternatives) + ")", True
+    else:
+        pattern, is_atomic = alternatives[0], len(leaves) > 0
+
+    if "" in node:
+        # a word ends here, so the rest is optional. Greedy, so the longer word is preferred
+        return (pattern if is_atomic else "(?:" + pattern + ")") + "?"
+    return pattern
@@ -1,6 +1,5 @@
 """General web utilities"""
 import hashlib
-import nltk
 import numpy as np
 import os
 import pandas as pd
@@ -14,6 +13,8 @@ from s3fs.core import S3FileSystem
 
 import topic_modeling
 from utils.constants import *
+from utils.embedding_utils import load_embedding_matrix
+from utils.token_store_utils import TokenStore
 from utils.topic_evaluation_utils import *
 
 
@@ -36,7 +37,7 @@ def get_publish_dates(df):
     return pd.to_datetime(df["publish_date"]).astype(np.int64) / int(1e6)
 
 
-def get_sample_sentences(df, regex):
+def get_sample_sentences(df, regex, store=None):
     """Get sample sentences that fit the regular expression
 
     Parameters
@@ -45,6 +46,9 @@ def get_sample_sentences(df, regex):
         dataframe for which to get sample sentences
     regex: str
         regex to match sentences on
+    store: TokenStore
+        store with the sentence boundaries of the texts. Defaults to the token
+        store in DATA_DIR. Texts that aren't stored are split on the fly.
 
     Returns
     -------
@@ -53,24 +57,54 @@ def get_sample_sentences(df, regex):
 
     """
     compiled_re = re.compile(regex)
+    store = store or TokenStore()
 
-    def extract_sentences(text):
+    def extract_sentences(cord_uid, text):
         sents_to_return = []
-        sentences = nltk.sent_tokenize(text)
+        sentences = store.get_sentence_texts(cord_uid, "text", text)
         for sent in sentences:
             if compiled_re.search(sent.lower()) is not None:
                 sents_to_return.append(sent)
         return sents_to_return
-    return df["text"].apply(extract_sentences)
+    return pd.Series(
+        [extract_sentences(cord_uid, text) for cord_uid, text in zip(df["cord_uid"], df["text"])],
+        index=df.index
+    )
 
 
-def get_data_for_web(df):
+def get_corpus_baseline(cord_uids):
+    """Get the average pairwise distance between the embeddings of all papers in the corpus
+
+    Parameters
+    ----------
+    cord_uids: Series
+        cord_uids of the papers in the corpus. Papers without an embedding are skipped.
+
+    Returns
+    -------
+    float
+        the average pairwise cosine distance, which topics are compared against
+
+    """
+    embeddings, cord_uid_to_row = load_embedding_matrix()
+    rows = cord_uids[cord_uids.isin(cord_uid_to_row)].map(cord_uid_to_row).to_numpy()
+    groups = pd.DataFrame({"corpus": np.ones(len(rows), dtype=bool)})
+    return get_topic_cohesion(embeddings, groups, rows=rows).loc["corpus", "pairwise_distance"]
+
+
+def get_data_for_web(df, text_loader=None, baseline=None):
     """Get a baseline object to save for the website
 
     Parameters
     ----------
     df: DataFrame
         dataframe to save
+    text_loader: function
+        if df has no text column, a function that accepts cord_uids and returns
+        their texts indexed by cord_uid. Only used for the recent papers.
+    baseline: float
+        average pairwise distance of the whole corpus, from get_corpus_baseline.
+        Defaults to that of df, so df should be the whole corpus if it's not given.
 
     Returns
     -------
@@ -85,13 +119,31 @@ def get_data_for_web(df):
     date_idx = pd.date_range(datetime.today().date() + timedelta(days=-60), datetime.today().date())
 
     to_dump = {"raw": df}
+    embeddings, cord_uid_to_row = load_embedding_matrix()
+    store = TokenStore()
+
+    # cohesion of every topic, and of all papers as the baseline if needed, in one pass over the embeddings
+    has_embedding = df["cord_uid"].isin(cord_uid_to_row).to_numpy()
+    groups = pd.DataFrame({
+        topic: (df[f"topic_{topic}"] == True).to_numpy()[has_embedding]
+        for topic in topic_modeling.TOPICS.keys()
+    })
+    if baseline is None:
+        groups["corpus"] = True
+    cohesion = get_topic_cohesion(
+        embeddings, groups, rows=df.loc[has_embedding, "cord_uid"].map(cord_uid_to_row).to_numpy())
+    if baseline is None:
+        baseline = cohesion.loc["corpus", "pairwise_distance"]
 
     # get per-topic data
     for topic, params in topic_modeling.TOPICS.items():
         df_topic = df[df[f"topic_{topic}"]]
         df_recent = df_topic.iloc[0:10]
+        if "text" not in df_recent.columns:
+            df_recent = df_recent.assign(
+                text=df_recent["cord_uid"].map(text_loader(df_recent["cord_uid"])))
         df_recent.loc[:, "sample_sentences"] = get_sample_sentences(
-            df_recent, params["regex"])
+            df_recent, params["regex"], store=store)
         
         # get publish dates as a histogram for display on web
         # gets publish dates for last 60 days
@@ -100,8 +152,9 @@ def get_data_for_web(df):
         publish_date_distribution = list(zip(publish_dates.index.astype("int64")//(10**6), publish_dates))
         to_dump[topic] = {
             "distances": {
-                "cluster": get_average_pairwise_distance(df_topic),
-                "baseline": CORPUS_BASELINE
+                "cluster": cohesion.loc[topic, "pairwise_distance"],
+                "centroid_spread": cohesion.loc[topic, "centroid_spread"],
+                "baseline": baseline
             },
             "recent_papers": df_recent.reset_index().to_dict("records"),
             "publish_dates": publish_date_distribution
@@ -161,6 +214,9 @@ def load_web_data_aws(key):
 def save_data_elasticsearch(df):
     """Save data to elasticsearch
 
+    Embeddings are read from the embedding matrix one paper at a time, as
+    they are submitted.
+
     Parameters
     ----------
     df: DataFrame
@@ -170,7 +226,8 @@ def save_data_elasticsearch(df):
     es = Elasticsearch(ES_URL)
     cols_to_index = ES_COL_TO_TYPE.keys()
     print("Indexing", cols_to_index)
-    df_nona = df[cols_to_index].fillna("")
+    embeddings, cord_uid_to_row = load_embedding_matrix()
+    df_nona = df[[col for col in cols_to_index if col != "embedding"]].fillna("")
     df_nona["authors"] = df_nona["authors"].str.split(";")
     df_nona["journal"] = df_nona["journal"].str.split(";")
     df_nona["url"] = df_nona["url"].str.split(";").apply(lambda urls: [url.strip() for url in urls if not "api.elsevier.com" in url])
@@ -179,7 +236,10 @@ def save_data_elasticsearch(df):
     batch = []
     for i,row in df_nona.iterrows():
         batch.append({"index": {"_index": ES_INDEX, "_id": row["cord_uid"]}})
-        batch.append(row[cols_to_index].to_dict())
+        doc = row.to_dict()
+        embedding_row = cord_uid_to_row.get(row["cord_uid"])
+        doc["embedding"] = [] if embedding_row is None else embeddings[embedding_row].tolist()
+        batch.append(doc)
         # submit every 200
         if len(batch) % 400 == 0:
             print(f"Submitting batch {i}")
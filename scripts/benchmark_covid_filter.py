@@ -0,0 +1,65 @@
+"""Benchmark the COVID-19 term filter against the original per-term filter"""
+import argparse
+import logging
+import os
+import sys
+import time
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+# load local libraries
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules"))
+import pandas as pd
+import covid_docs
+from utils.constants import *
+
+
+def col_contains_covid_per_term(df, col):
+    """The original filter, which lowercases and scans the column once per term"""
+    return (
+        df[col].str.lower().str.contains("covid")
+        | df[col].str.lower().str.contains("coronavirus")
+        | df[col].str.lower().str.contains("sars-cov-2")
+        | df[col].str.lower().str.contains("corona")
+        | df[col].str.lower().str.contains("wuhan")
+    )
+
+
+def _time(f, repeat):
+    """Get the best wall time of f over repeat runs, along with its last result"""
+    best = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = f()
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--nrows", type=int, default=100000, help="number of metadata rows to use")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timing runs")
+    args = parser.parse_args()
+
+    df = pd.read_csv(os.path.join(DATA_DIR, "metadata.csv"), nrows=args.nrows)
+    cols = ["title", "abstract"]
+
+    per_term_time, per_term_flag = _time(
+        lambda: (col_contains_covid_per_term(df, "title") | col_contains_covid_per_term(df, "abstract")).fillna(False),
+        args.repeat)
+    term_filter = covid_docs.TermFilter(covid_docs.COVID_TERMS)
+    contains_time, contains_flag = _time(
+        lambda: (term_filter.contains(df, "title") | term_filter.contains(df, "abstract")).fillna(False),
+        args.repeat)
+    match_time, (match_flag, matched_terms) = _time(lambda: term_filter.match(df, cols), args.repeat)
+
+    print(f"Rows: {len(df)}, terms: {len(covid_docs.COVID_TERMS)}")
+    print(f"Per-term filter:     {per_term_time:.3f}s")
+    print(f"TermFilter.contains: {contains_time:.3f}s ({per_term_time / contains_time:.1f}x)")
+    print(f"TermFilter.match:    {match_time:.3f}s ({per_term_time / match_time:.1f}x), includes matched terms")
+    print(f"Same rows kept: {per_term_flag.astype(bool).equals(contains_flag.astype(bool))}, "
+          f"{per_term_flag.astype(bool).equals(match_flag.astype(bool))}")
+    print(f"Rows kept: {int(match_flag.sum())}")
+    print(matched_terms.explode().value_counts().to_string())
@@ -0,0 +1,97 @@
+"""Benchmark the topic engines on the labelled evaluation set and a scaled synthetic corpus"""
+import argparse
+import logging
+import os
+import sys
+from functools import partial
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+# load local libraries
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules"))
+import pandas as pd
+import covid_docs
+import topic_modeling
+from utils.constants import *
+from utils.instrumentation_utils import track_stage
+from utils.topic_evaluation_utils import get_topic_precision_recall, load_topic_labels
+
+EVAL_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "evaluation_data", "topic_modeling_eval.csv")
+TEXT_COLUMNS = ["cord_uid", "title", "abstract", "text"]
+
+
+def get_topic_engines():
+    """Get the topic engines to compare, by name. Each adds a topics column to a dataframe"""
+    drug_re = topic_modeling.get_drug_regex()
+    engines = {
+        "add_topics": partial(topic_modeling.add_topics, drug_re=drug_re),
+        "add_topics_v1": topic_modeling.add_topics_v1,
+    }
+    # the embedding engine needs a classifier fit by the pipeline with --embedding-topics
+    if os.path.exists(os.path.join(DATA_DIR, topic_modeling.TOPIC_CLASSIFIER_PATH)):
+        engines["add_topics_from_embeddings"] = topic_modeling.add_topics_from_embeddings
+    return engines
+
+
+def get_synthetic_corpus(df, n_docs, seed=0):
+    """Get a corpus of n_docs papers sampled with replacement from df"""
+    df_synthetic = df.sample(n=n_docs, replace=True, random_state=seed).reset_index(drop=True)
+    df_synthetic["cord_uid"] = [f"synthetic{i}" for i in range(n_docs)]
+    return df_synthetic
+
+
+def run_engine(name, engine, df):
+    """Run a topic engine on a copy of df, measuring its throughput and peak memory"""
+    df = df.copy()
+    with track_stage(f"topics.{name}", rows_in=len(df)) as stats:
+        result = engine(df)
+        stats.add_count("docs", len(df))
+    df = df if result is None else result
+    return df.set_index("cord_uid")["topics"], stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--engines", nargs="+", help="engines to run. Defaults to all of them")
+    parser.add_argument("--synthetic-docs", type=int, default=10000,
+                        help="number of papers in the synthetic corpus, 0 to skip it")
+    args = parser.parse_args()
+
+    labelled = load_topic_labels(EVAL_PATH)
+    df_labelled = covid_docs.load_covid_data(
+        text_only=True, columns=TEXT_COLUMNS, filters=[("cord_uid", "in", list(labelled.index))])
+    missing = labelled.index.difference(df_labelled["cord_uid"])
+    if len(missing) > 0:
+        logging.info(f"{len(missing)} labelled papers are no longer in the dataset: {list(missing)}")
+
+    engines = get_topic_engines()
+    topics = list(topic_modeling.TOPICS_V4b.keys())
+    summaries = []
+    for name, engine in engines.items():
+        if args.engines and name not in args.engines:
+            continue
+        predicted, stats = run_engine(name, engine, df_labelled)
+        scores = get_topic_precision_recall(predicted, labelled, topics)
+        print(f"\n{name} on {len(df_labelled)} labelled papers")
+        print(scores.to_string(float_format="{:.2f}".format))
+        summary = {
+            "engine": name,
+            "precision": scores["tp"].sum() / max(scores["tp"].sum() + scores["fp"].sum(), 1),
+            "recall": scores["tp"].sum() / max(scores["tp"].sum() + scores["fn"].sum(), 1),
+        }
+
+        if args.synthetic_docs > 0:
+            df_synthetic = get_synthetic_corpus(df_labelled, args.synthetic_docs)
+            _, stats = run_engine(name, engine, df_synthetic)
+            summary.update({
+                "synthetic_docs": len(df_synthetic),
+                "docs_per_sec": stats.counts["docs"] / stats.wall_time,
+                "peak_rss_mb": stats.peak_rss_mb,
+            })
+        summaries.append(summary)
+
+    print("\nSummary, with precision and recall micro-averaged over topics")
+    print(pd.DataFrame(summaries).set_index("engine").to_string(float_format="{:.2f}".format))
@@ -0,0 +1,90 @@
+"""Compare the speed, memory and summaries of the full-precision and quantized SciBERT summarizers"""
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import sys
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+# load local libraries
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "modules"))
+import numpy as np
+import pandas as pd
+import torch
+import covid_docs
+import summarization
+from utils.instrumentation_utils import track_stage
+
+
+def get_model_size_mb(model):
+    """Get the size of a model's serialized weights, which counts packed quantized weights too"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def run_mode(name, texts, batch_size, threads=None, **kwargs):
+    """Select summary sentences with one summarizer mode, measuring its throughput and peak memory"""
+    if threads:
+        torch.set_num_threads(threads)
+    with track_stage(f"summaries.{name}", rows_in=len(texts)) as stats:
+        model = summarization.BertSummarizer(**kwargs)
+        selected_sentences, num_sentences = model.select_sentences(texts, batch_size=batch_size)
+        stats.add_count("docs", len(texts))
+        stats.add_count("sentences", num_sentences)
+    return selected_sentences, {
+        "docs_per_sec": stats.counts["docs"] / stats.wall_time,
+        "sentences_per_sec": stats.counts["sentences"] / stats.wall_time,
+        "peak_rss_mb": stats.peak_rss_mb,
+        "model_mb": get_model_size_mb(model.model),
+    }
+
+
+def run_mode_in_subprocess(*args, **kwargs):
+    """Run a mode in a fresh process, so its peak memory only counts its own model"""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run_mode, args, kwargs)
+
+
+def get_overlap(selected_a, selected_b):
+    """Get the mean Jaccard overlap of the sentences selected for each paper, and the share of identical summaries"""
+    overlaps = []
+    for sentences_a, sentences_b in zip(selected_a, selected_b):
+        a, b = set(sentences_a), set(sentences_b)
+        overlaps.append(len(a & b) / len(a | b) if len(a | b) > 0 else 1.0)
+    identical = [sentences_a == sentences_b for sentences_a, sentences_b in zip(selected_a, selected_b)]
+    return {"sentence_overlap": np.mean(overlaps), "identical_summaries": np.mean(identical)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sample-docs", type=int, default=200, help="number of papers to summarize")
+    parser.add_argument("--batch-size", type=int, default=summarization.SUMMARY_BATCH_SIZE,
+                        help="number of sentences in each forward pass")
+    parser.add_argument("--max-tokens", type=int, nargs="+", default=[512, 128],
+                        help="maximum number of tokens of each sentence to try in quantized mode")
+    parser.add_argument("--threads", type=int, help="number of torch threads. Defaults to torch's own setting")
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    df = covid_docs.load_covid_data(text_only=True, columns=["cord_uid", "text"])
+    df = df[df["text"].str.len() >= 1000].sample(n=args.sample_docs, random_state=0)
+    texts = df["text"].tolist()
+
+    # each mode loads its own model in its own process, so memory is measured per mode
+    baseline, stats = run_mode_in_subprocess("full_precision", texts, args.batch_size, args.threads)
+    rows = [{"mode": "full_precision", **stats, **get_overlap(baseline, baseline)}]
+    for max_tokens in args.max_tokens:
+        name = f"int8_{max_tokens}_tokens"
+        selected, stats = run_mode_in_subprocess(
+            name, texts, args.batch_size, args.threads, quantized=True, max_tokens=max_tokens)
+        rows.append({"mode": name, **stats, **get_overlap(baseline, selected)})
+
+    print(f"\nSummaries of {len(texts)} papers on {torch.get_num_threads()} threads, "
+          "with overlap measured against full precision")
+    print(pd.DataFrame(rows).set_index("mode").to_string(float_format="{:.2f}".format))
@@ -1,4 +1,5 @@
 # TODO: have code to generate and update web data
+import argparse
 import logging
 import os
 import sys
@@ -14,7 +15,29 @@ from utils.constants import *
 from utils.web_utils import save_data_elasticsearch
 
 if __name__ == "__main__":
-    covid_docs.save_covid_only_data()
+    parser = argparse.ArgumentParser(description="Refresh the processed CORD-19 papers")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="only process papers that are new or changed since the previous snapshot")
+    parser.add_argument(
+        "--stage", choices=covid_docs.PIPELINE_STAGES,
+        help="only run this stage, using the saved output of the stage before it")
+    parser.add_argument(
+        "--resume-from", choices=covid_docs.PIPELINE_STAGES,
+        help="rerun this stage and every stage after it")
+    parser.add_argument(
+        "--embedding-topics", action="store_true",
+        help="label the papers in the metadata-only data with topics from their embeddings; "
+             "papers with text keep their regex topics")
+    args = parser.parse_args()
+
+    covid_docs.save_covid_only_data(
+        incremental=args.incremental,
+        stages=[args.stage] if args.stage else None,
+        resume_from=args.resume_from,
+        embedding_topics=args.embedding_topics)
+    if args.stage is not None and args.stage != "publish":
+        sys.exit(0)
     df = covid_docs.load_covid_data(True)
     save_data_elasticsearch(df)
     covid_docs.save_drug_data()